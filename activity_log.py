@@ -0,0 +1,155 @@
+import time
+import queue
+import atexit
+import logging
+import threading
+
+from sqlalchemy import insert
+
+from extensions import db
+from models import ActivityEvent
+
+logger = logging.getLogger(__name__)
+
+# ============================================================
+# DURABLE ACTIVITY LOG
+# log_activity() (utils.py) feeds two stores. The capped list in the
+# state store drives the live dashboard view. This module keeps every
+# event in an append-only SQLite table in its own file (activity.db),
+# for history that survives restarts.
+#
+# Request threads only enqueue (put_nowait; a full queue drops the event,
+# never blocks). One writer thread inserts batches of up to BATCH_MAX
+# rows in one executemany. Each filter column has its own index. Every
+# SQLite index carries the rowid, so "ip = ? ORDER BY id DESC" walks one
+# index backwards and a week of history filters in milliseconds.
+# Rotation is a retention prune on the hourly cleanup job.
+# ============================================================
+
+BATCH_MAX      = 500
+BATCH_WINDOW_S = 0.5     # how long to wait for more events after the first
+QUEUE_MAX      = 10_000
+PAGE_DEFAULT   = 100
+PAGE_LIMIT     = 1000
+DUMP_LIMIT     = 100_000
+
+
+class ActivityWriter:
+    def __init__(self):
+        self._queue   = queue.Queue(maxsize=QUEUE_MAX)
+        self._app     = None
+        self._thread  = None
+        self.dropped  = 0
+
+    def start(self, app):
+        if self._thread is not None:
+            return
+        self._app    = app
+        self._thread = threading.Thread(target=self._run, name='activity-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, entry):
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self, timeout=2.0):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            try:
+                while len(batch) < BATCH_MAX:
+                    nxt = self._queue.get(timeout=BATCH_WINDOW_S)
+                    if nxt is None:
+                        self._flush(batch)
+                        return
+                    batch.append(nxt)
+            except queue.Empty:
+                pass
+            self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            with self._app.app_context():
+                db.session.execute(insert(ActivityEvent), batch)
+                db.session.commit()
+        except Exception:
+            logger.exception(f"Activity writer: failed to persist {len(batch)} events")
+
+
+activity_writer = ActivityWriter()
+
+
+# ============================================================
+# QUERIES  — must be called within an active Flask application context
+# ============================================================
+
+def _serialize(e):
+    return {'id': e.id, 'time': e.time, 'ip': e.ip, 'action': e.action,
+            'path': e.path, 'func': e.func, 'result': e.result}
+
+
+def _edge_id(condition, *order):
+    return (db.session.query(ActivityEvent.id).filter(condition)
+            .order_by(*order).limit(1).scalar())
+
+
+def query_activity(ip=None, action=None, path=None, since=None, until=None,
+                   before_id=None, limit=PAGE_DEFAULT):
+    """
+    Events newest first, filtered by exact `ip` / `action`, `path` prefix and
+    [since, until) unix seconds. Keyset pagination: pass the last id seen
+    as `before_id`. Returns (entries, has_more).
+    """
+    q = ActivityEvent.query
+    if ip:
+        q = q.filter(ActivityEvent.ip == ip)
+    if action:
+        q = q.filter(ActivityEvent.action == action)
+    if path:
+        # Range instead of LIKE: SQLite's LIKE is case-insensitive and skips the index
+        q = q.filter(ActivityEvent.path >= path, ActivityEvent.path < path + '\uffff')
+    # Ids grow with time, so time bounds become id bounds (one index seek
+    # each). The query then stays on the primary key or the ip/action/path
+    # index, walked newest first, instead of sorting a whole time range.
+    if since is not None:
+        first = _edge_id(ActivityEvent.time >= since, ActivityEvent.time.asc(), ActivityEvent.id.asc())
+        if first is None:
+            return [], False
+        q = q.filter(ActivityEvent.id >= first, ActivityEvent.time >= since)
+    if until is not None:
+        last = _edge_id(ActivityEvent.time < until, ActivityEvent.time.desc(), ActivityEvent.id.desc())
+        if last is None:
+            return [], False
+        q = q.filter(ActivityEvent.id <= last, ActivityEvent.time < until)
+    if before_id:
+        q = q.filter(ActivityEvent.id < before_id)
+
+    rows = q.order_by(ActivityEvent.id.desc()).limit(limit + 1).all()
+    return [_serialize(r) for r in rows[:limit]], len(rows) > limit
+
+
+def activity_actions():
+    """Distinct action names, for the dashboard filter."""
+    rows = db.session.query(ActivityEvent.action).distinct().order_by(ActivityEvent.action)
+    return [a for (a,) in rows]
+
+
+def prune_activity(max_age_days):
+    """Delete events older than `max_age_days` (0 keeps everything)."""
+    if not max_age_days:
+        return 0
+    cutoff  = int(time.time() - max_age_days * 86400)
+    removed = ActivityEvent.query.filter(ActivityEvent.time < cutoff).delete()
+    db.session.commit()
+    return removed
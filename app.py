@@ -1,166 +1,247 @@
 import os
 import sys
+import json
 import secrets
 import logging
 from datetime import timedelta
 import argparse
 
 from flask import Flask
-from apscheduler.schedulers.background import BackgroundScheduler
 
-from extensions import db, socketio
+import metrics
+import profiling
+import compression
+import sqlite_store
+import transfer_stats
+from extensions import db, socketio, state
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # ============================================================
-# APP SETUP
+# APP FACTORY
+# create_app() only builds the app: no argv, no scheduler, no network.
+# main() is the server entry point (python app.py) and adds those.
+# Heavy optional libraries load where they are used: Pillow on the first
+# thumbnail, psutil on the sampler thread, zeroconf on the mDNS thread.
+#
+# Extensions and background writers are module-level singletons, so
+# build one app per process.
 # ============================================================
 
-app = Flask(__name__)
-
-# Argument Parsing
-parser = argparse.ArgumentParser(description='LocalShare Flask App')
-parser.add_argument('--port', '-p', type=int, default=80, help='Port to run the server on')
-parser.add_argument('folder', nargs='?', default=None, help='Custom upload folder')
-args = parser.parse_args()
-
-custom_folder = args.folder
-port = args.port
-
-if custom_folder:
-    if not os.path.isdir(custom_folder):
-        print(f"Error: Directory '{custom_folder}' does not exist.")
-        sys.exit(1)
-    app.config['UPLOAD_FOLDER']   = os.path.abspath(custom_folder)
-    app.config['CLEANUP_ENABLED'] = False
-else:
-    app.config['UPLOAD_FOLDER']   = 'uploads'
-    app.config['CLEANUP_ENABLED'] = True
-
-app.config['SQLALCHEMY_DATABASE_URI']        = 'sqlite:///database.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['MAX_CONTENT_LENGTH']             = 10_000 * 1024 * 1024  # 10 GB
-
-# ============================================================
-# AUTH CONFIG
-# ============================================================
-
-_SECRET_KEY     = os.environ.get('SECRET_KEY')
-_ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'admin123')
-
-if not _SECRET_KEY:
-    _SECRET_KEY = secrets.token_hex(32)
-    logger.warning(
-        "SECRET_KEY not set — using a randomly generated key. "
-        "Sessions will be invalidated on every restart. "
-        "Set SECRET_KEY as an environment variable for persistence."
-    )
-
-if _ADMIN_PASSWORD == 'admin123':
-    logger.warning(
-        "\n" + "=" * 62 +
-        "\n  WARNING: Default admin password in use!" +
-        "\n  Set ADMIN_PASSWORD as an environment variable before" +
-        "\n  exposing this server to your network." +
-        "\n" + "=" * 62
-    )
-
-app.config['SECRET_KEY']                 = _SECRET_KEY
-app.config['ADMIN_PASSWORD']             = _ADMIN_PASSWORD  # read by routes/auth.py
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)
-
-# ============================================================
-# EXTENSIONS
-# ============================================================
-
-db.init_app(app)
-socketio.init_app(app, cors_allowed_origins='*', async_mode='threading')
-
-# ============================================================
-# BLUEPRINTS
-# ============================================================
-
-# Importing watch also registers the @socketio.on('join_watch') handler
-from routes.files import files_bp
-from routes.chat  import chat_bp
-from routes.auth  import auth_bp
-from routes.dashboard  import dashboard_bp
-from routes.watch import (watch_bp,
-                          watch_sessions, watch_lock,
-                          viewers_data,   viewers_lock,
-                          client_last_update, client_update_lock)
-
-app.register_blueprint(files_bp)
-app.register_blueprint(chat_bp)
-app.register_blueprint(auth_bp)
-app.register_blueprint(dashboard_bp)
-app.register_blueprint(watch_bp)
-
-# ============================================================
-# CONTEXT PROCESSOR
-# Context processors are app-level — they must be registered on
-# the app itself to inject into templates from all blueprints.
-# ============================================================
-
-from utils import is_admin
+def create_app(folder=None, config=None):
+    """
+    `folder`: serve this existing directory instead of ./uploads (cleanup off).
+    `config`: overrides applied last, e.g. a test SQLALCHEMY_DATABASE_URI.
+    """
+    app = Flask(__name__)
+
+    if folder:
+        app.config['UPLOAD_FOLDER']   = os.path.abspath(folder)
+        app.config['CLEANUP_ENABLED'] = False
+    else:
+        app.config['UPLOAD_FOLDER']   = 'uploads'
+        app.config['CLEANUP_ENABLED'] = True
+
+    app.config['SQLALCHEMY_DATABASE_URI']        = 'sqlite:///database.db'
+    app.config['SQLALCHEMY_BINDS']               = {'activity': 'sqlite:///activity.db'}
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['MAX_CONTENT_LENGTH']             = 10_000 * 1024 * 1024  # 10 GB
+
+    # ============================================================
+    # RETENTION CONFIG  (only applied when CLEANUP_ENABLED — see retention.py)
+    # ============================================================
+
+    _max_bytes = os.environ.get('RETENTION_MAX_BYTES')
+
+    app.config['RETENTION_MAX_AGE_HOURS'] = float(os.environ.get('RETENTION_MAX_AGE_HOURS', 24))
+    app.config['RETENTION_MAX_BYTES']     = int(_max_bytes) if _max_bytes else None
+    app.config['RETENTION_FOLDERS']       = json.loads(os.environ.get('RETENTION_FOLDERS', '{}'))
+    app.config['RETENTION_DRY_RUN']       = os.environ.get('RETENTION_DRY_RUN', '') == '1'
+    app.config['ACTIVITY_RETENTION_DAYS'] = float(os.environ.get('ACTIVITY_RETENTION_DAYS', 30))  # pruned in every mode
+
+    # ============================================================
+    # SHARED STATE  (see state_backend.py — 'local' unless running several workers)
+    # ============================================================
+
+    app.config['STATE_BACKEND'] = os.environ.get('STATE_BACKEND', 'local')
+
+    # ============================================================
+    # PROFILING  (slow-request capture — see profiling.py; 0 disables)
+    # ============================================================
+
+    app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 1000))
+
+    # ============================================================
+    # AUTH CONFIG
+    # ============================================================
+
+    _SECRET_KEY     = os.environ.get('SECRET_KEY')
+    _ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'admin123')
+
+    if not _SECRET_KEY:
+        _SECRET_KEY = secrets.token_hex(32)
+        logger.warning(
+            "SECRET_KEY not set — using a randomly generated key. "
+            "Sessions will be invalidated on every restart. "
+            "Set SECRET_KEY as an environment variable for persistence."
+        )
+
+    if _ADMIN_PASSWORD == 'admin123':
+        logger.warning(
+            "\n" + "=" * 62 +
+            "\n  WARNING: Default admin password in use!" +
+            "\n  Set ADMIN_PASSWORD as an environment variable before" +
+            "\n  exposing this server to your network." +
+            "\n" + "=" * 62
+        )
+
+    app.config['SECRET_KEY']                 = _SECRET_KEY
+    app.config['ADMIN_PASSWORD']             = _ADMIN_PASSWORD  # read by routes/auth.py
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)
+
+    app.config.update(config or {})
+
+    # ============================================================
+    # EXTENSIONS
+    # ============================================================
+
+    sqlite_store.init_app(app)   # before db: engine pool options, WAL pragmas, single writer
+    db.init_app(app)
+    state.init_app(app)
+    metrics.init_app(app)
+    profiling.init_app(app)
+    compression.init_app(app)      # after metrics, so request latency includes compressing
+    transfer_stats.init_app(app)   # before socketio, so Socket.IO traffic bypasses the meter
+    socketio.init_app(app, cors_allowed_origins='*', async_mode='threading',
+                      **state.socketio_options())
+
+    # ============================================================
+    # BLUEPRINTS
+    # ============================================================
+
+    # Importing watch also registers the @socketio.on('join_watch') handler
+    from routes.files import files_bp
+    from routes.chat  import chat_bp
+    from routes.auth  import auth_bp
+    from routes.dashboard  import dashboard_bp
+    from routes.watch import watch_bp
+
+    app.register_blueprint(files_bp)
+    app.register_blueprint(chat_bp)
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(dashboard_bp)
+    app.register_blueprint(watch_bp)
+
+    # ============================================================
+    # CONTEXT PROCESSOR
+    # Context processors are app-level — they must be registered on
+    # the app itself to inject into templates from all blueprints.
+    # ============================================================
+
+    from utils import is_admin
+
+    @app.context_processor
+    def inject_auth_status():
+        """Makes admin_mode available in every template automatically."""
+        return dict(admin_mode=is_admin())
+
+    return app
+
+
+def init_storage(app):
+    """Create the upload folder and database tables, and bring older databases up to date."""
+    from models import upgrade_schema
+
+    os.makedirs(app.instance_path, exist_ok=True)
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    with app.app_context():
+        db.create_all()
+        upgrade_schema()
 
-@app.context_processor
-def inject_auth_status():
-    """Makes admin_mode available in every template automatically."""
-    return dict(admin_mode=is_admin())
 
 # ============================================================
 # SCHEDULER
 # ============================================================
 
-from utils import cleanup_old_files, cleanup_watch_sessions, cleanup_rate_limits, start_virtual_mdns
+def start_scheduler(app):
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    from utils import cleanup_old_chat
+    from retention import run_retention, flush_access_times
+    from activity_log import prune_activity
+    from routes.watch import rooms
+    from state_backend import NODE_ID
+    from storage_stats import storage, RECONCILE_HOURS
+
+    def _cleanup_files():
+        # With several workers sharing a state backend, only one runs the sweep per hour
+        if not state.set_nx('jobs:cleanup', NODE_ID, ttl=55 * 60):
+            with app.app_context():
+                flush_access_times()
+            return
+        with app.app_context():
+            # Only delete files if cleanup is enabled (i.e., using default 'uploads' folder)
+            if app.config.get('CLEANUP_ENABLED', True):
+                run_retention()
+            else:
+                flush_access_times()
+            # Always clean up old chat messages and activity history regardless of directory mode
+            cleanup_old_chat()
+            prune_activity(app.config['ACTIVITY_RETENTION_DAYS'])
+
+    def _flush_access_times():
+        with app.app_context():
+            flush_access_times()
+
+    def _reconcile_storage(startup=False):
+        # Periodic runs are claimed by one worker; at startup each worker counts once
+        if startup or state.set_nx('jobs:storage', NODE_ID, ttl=(RECONCILE_HOURS - 0.5) * 3600):
+            storage.reconcile(app.config['UPLOAD_FOLDER'])
+
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(_cleanup_files, 'interval', hours=1)
+    scheduler.add_job(_flush_access_times, 'interval', minutes=1)
+    scheduler.add_job(rooms.sweep, 'interval', minutes=15)
+    scheduler.add_job(_reconcile_storage, 'interval', hours=RECONCILE_HOURS)
+    scheduler.add_job(_reconcile_storage, kwargs={'startup': True})   # once, now
+    scheduler.start()
+    return scheduler
 
-def _cleanup_files():
-    with app.app_context():
-        cleanup_old_files()
-
-scheduler = BackgroundScheduler()
-scheduler.add_job(_cleanup_files, 'interval', hours=1)
-scheduler.add_job(
-    lambda: cleanup_watch_sessions(watch_sessions, watch_lock, viewers_data, viewers_lock),
-    'interval', minutes=15,
-)
-scheduler.add_job(
-    lambda: cleanup_rate_limits(client_last_update, client_update_lock),
-    'interval', minutes=5,
-)
-scheduler.start()
 
 # ============================================================
 # ENTRYPOINT
 # ============================================================
 
-if __name__ == '__main__':
-    os.makedirs('instance', exist_ok=True)
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='LocalShare Flask App')
+    parser.add_argument('--port', '-p', type=int, default=80, help='Port to run the server on')
+    parser.add_argument('folder', nargs='?', default=None, help='Custom upload folder')
+    args = parser.parse_args(argv)
 
-    with app.app_context():
-        db.create_all()
+    if args.folder and not os.path.isdir(args.folder):
+        print(f"Error: Directory '{args.folder}' does not exist.")
+        sys.exit(1)
 
-    import socket as _socket
-    s = _socket.socket(_socket.AF_INET, _socket.SOCK_DGRAM)
-    try:
-        s.connect(('8.8.8.8', port))
-        local_ip = s.getsockname()[0]
-    except Exception:
-        local_ip = '127.0.0.1'
-    finally:
-        s.close()
+    app = create_app(args.folder)
+    init_storage(app)
+    start_scheduler(app)
 
     # --- TRICK mDNS USING ZEROCONF ---
-    zeroconf, service_info, machine_ip = start_virtual_mdns(hostname="share", port=port)
+    # Announced from a background thread; the server is up before it finishes
+    from utils import MDNSAnnouncer
+    mdns = MDNSAnnouncer(hostname="share", port=args.port)
+    mdns.start()
 
-    print(f"Press CTRL+C to quit. Running on port {port}")
+    print(f"Press CTRL+C to quit. Running on port {args.port}")
 
     try:
-        socketio.run(app, host='0.0.0.0', port=port)
+        # Werkzeug's threaded server is the one this app is built for (async_mode='threading');
+        # without the flag Flask-SocketIO refuses to start when there is no TTY (Docker, services)
+        socketio.run(app, host='0.0.0.0', port=args.port, allow_unsafe_werkzeug=True)
     finally:
-        logger.info("De-registering broadcast parameters from local subnet routing tables...")
-        zeroconf.unregister_service(service_info)
-        zeroconf.close()
+        mdns.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import os
+import time
+import struct
+import tarfile
+import zlib
+import logging
+
+from upload_stream import TEMP_PREFIXES
+
+logger = logging.getLogger(__name__)
+
+# ============================================================
+# STREAMING FOLDER ARCHIVES  (ZIP store-mode / TAR)
+# Archives are generated on the fly while being sent — no temp files, and
+# memory stays at one read buffer regardless of folder size. Since neither
+# format compresses here, the exact byte length is known before the first
+# byte goes out, so browsers get a real Content-Length and progress bar.
+# ============================================================
+
+READ_CHUNK = 1024 * 1024
+
+
+class ArchiveEntry:
+    __slots__ = ('path', 'arcname', 'size', 'mtime')
+
+    def __init__(self, path, arcname, size, mtime):
+        self.path    = path
+        self.arcname = arcname
+        self.size    = size
+        self.mtime   = mtime
+
+
+def collect_entries(root, prefix):
+    """
+    Walk `root` and return ArchiveEntry objects (sorted, regular files only,
+    symlinks skipped) with archive names rooted at `prefix`.
+    """
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames
+                             if not os.path.islink(os.path.join(dirpath, d)))
+        rel_dir = os.path.relpath(dirpath, root)
+        for name in sorted(filenames):
+            if name.startswith(TEMP_PREFIXES):   # never ship in-flight temp files
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path, follow_symlinks=False)
+            except OSError:
+                continue
+            if not os.path.isfile(path) or os.path.islink(path):
+                continue
+            rel     = name if rel_dir == '.' else os.path.join(rel_dir, name)
+            arcname = f'{prefix}/{rel}'.replace('\\', '/')
+            entries.append(ArchiveEntry(path, arcname, st.st_size, st.st_mtime))
+    return entries
+
+
+def _read_exact(entry):
+    """
+    Yield exactly entry.size bytes of the file. Unbuffered 1 MiB reads go
+    straight from the page cache into the yielded bytes object — one copy,
+    no userspace buffer in between. If the file shrank since it was listed,
+    the tail is zero-filled so the announced Content-Length still holds.
+    """
+    remaining = entry.size
+    try:
+        with open(entry.path, 'rb', buffering=0) as f:
+            while remaining > 0:
+                chunk = f.read(min(READ_CHUNK, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    except OSError as e:
+        logger.warning(f"Archive: could not read {entry.path}: {e}")
+
+    if remaining > 0:
+        logger.warning(f"Archive: {entry.path} changed while streaming — zero-filling {remaining} bytes")
+        while remaining > 0:
+            n = min(READ_CHUNK, remaining)
+            remaining -= n
+            yield bytes(n)
+
+
+# ---------- ZIP ----------
+
+_ZIP64_LIMIT = 0xFFFFFFFF
+_FLAGS       = 0x0808   # bit 3: sizes/CRC in data descriptor, bit 11: UTF-8 names
+
+
+def _dos_datetime(mtime):
+    t = time.localtime(max(mtime, 315532800))   # DOS epoch is 1980-01-01
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def _zip_local_header(name, zip64, dtime, ddate):
+    extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0) if zip64 else b''
+    size  = _ZIP64_LIMIT if zip64 else 0
+    return struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, _FLAGS, 0,
+                       dtime, ddate, 0, size, size, len(name), len(extra)) + name + extra
+
+
+def _zip_descriptor(crc, size, zip64):
+    if zip64:
+        return struct.pack('<IIQQ', 0x08074b50, crc, size, size)
+    return struct.pack('<IIII', 0x08074b50, crc, size, size)
+
+
+def _zip_central_header(name, size, crc, offset, dtime, ddate):
+    zip64_fields = []
+    if size >= _ZIP64_LIMIT:
+        zip64_fields += [size, size]
+    if offset >= _ZIP64_LIMIT:
+        zip64_fields.append(offset)
+    extra = (struct.pack('<HH', 0x0001, 8 * len(zip64_fields)) +
+             struct.pack(f'<{len(zip64_fields)}Q', *zip64_fields)) if zip64_fields else b''
+    version = 45 if zip64_fields else 20
+    return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version,
+                       _FLAGS, 0, dtime, ddate, crc,
+                       min(size, _ZIP64_LIMIT), min(size, _ZIP64_LIMIT),
+                       len(name), len(extra), 0, 0, 0, 0o100644 << 16,
+                       min(offset, _ZIP64_LIMIT)) + name + extra
+
+
+def _zip_end(count, cd_offset, cd_size):
+    out = b''
+    if count >= 0xFFFF or cd_offset >= _ZIP64_LIMIT or cd_size >= _ZIP64_LIMIT:
+        zip64_eocd_offset = cd_offset + cd_size
+        out += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+                           count, count, cd_size, cd_offset)
+        out += struct.pack('<IIQI', 0x07064b50, 0, zip64_eocd_offset, 1)
+    out += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0,
+                       min(count, 0xFFFF), min(count, 0xFFFF),
+                       min(cd_size, _ZIP64_LIMIT), min(cd_offset, _ZIP64_LIMIT), 0)
+    return out
+
+
+def zip_length(entries):
+    """Exact byte length of zip_stream(entries), computed from metadata only."""
+    offset  = 0
+    cd_size = 0
+    for e in entries:
+        name   = e.arcname.encode('utf-8')
+        zip64  = e.size >= _ZIP64_LIMIT
+        local  = 30 + len(name) + (20 if zip64 else 0)
+        desc   = 24 if zip64 else 16
+        n64    = (2 if zip64 else 0) + (1 if offset >= _ZIP64_LIMIT else 0)
+        cd_size += 46 + len(name) + (4 + 8 * n64 if n64 else 0)
+        offset += local + e.size + desc
+    return offset + cd_size + len(_zip_end(len(entries), offset, cd_size))
+
+
+def zip_stream(entries):
+    """Yield a store-mode (uncompressed), ZIP64-aware archive of `entries`."""
+    offset  = 0
+    central = []   # (name, size, crc, offset, dtime, ddate) — small per entry
+
+    for e in entries:
+        name         = e.arcname.encode('utf-8')
+        zip64        = e.size >= _ZIP64_LIMIT
+        dtime, ddate = _dos_datetime(e.mtime)
+
+        header = _zip_local_header(name, zip64, dtime, ddate)
+        yield header
+
+        crc = 0
+        for chunk in _read_exact(e):
+            crc = zlib.crc32(chunk, crc)
+            yield chunk
+
+        desc = _zip_descriptor(crc, e.size, zip64)
+        yield desc
+
+        central.append((name, e.size, crc, offset, dtime, ddate))
+        offset += len(header) + e.size + len(desc)
+
+    cd_offset = offset
+    cd_size   = 0
+    for rec in central:
+        hdr = _zip_central_header(*rec)
+        cd_size += len(hdr)
+        yield hdr
+
+    yield _zip_end(len(central), cd_offset, cd_size)
+
+
+# ---------- TAR ----------
+
+def _tar_header(e):
+    info       = tarfile.TarInfo(e.arcname)
+    info.size  = e.size
+    info.mtime = int(e.mtime)
+    info.mode  = 0o644
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def _tar_padding(size):
+    return (-size) % tarfile.BLOCKSIZE
+
+
+def tar_length(entries):
+    """Exact byte length of tar_stream(entries)."""
+    total = 2 * tarfile.BLOCKSIZE
+    for e in entries:
+        total += len(_tar_header(e)) + e.size + _tar_padding(e.size)
+    return total
+
+
+def tar_stream(entries):
+    """Yield an uncompressed POSIX (pax) tar archive of `entries`."""
+    for e in entries:
+        yield _tar_header(e)
+        yield from _read_exact(e)
+        pad = _tar_padding(e.size)
+        if pad:
+            yield bytes(pad)
+    yield bytes(2 * tarfile.BLOCKSIZE)
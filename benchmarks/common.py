@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import statistics
+import subprocess
+
+# ============================================================
+# BENCHMARK HELPERS
+# Every benchmark writes one JSON report: what ran, on what, and a
+# summary (min / median / p95 / max) per measurement. Keep the keys
+# stable so reports from two versions can be diffed.
+# ============================================================
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def summarize(samples, unit='s'):
+    ordered = sorted(samples)
+    return {
+        'unit':   unit,
+        'n':      len(ordered),
+        'min':    ordered[0],
+        'median': statistics.median(ordered),
+        'p95':    ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'max':    ordered[-1],
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_report(name, results, out=None, params=None):
+    """Print the report as JSON, or write it to `out`. Returns the report dict."""
+    report = {
+        'benchmark': name,
+        'revision':  git_revision(),
+        'python':    platform.python_version(),
+        'platform':  platform.platform(),
+        'time':      int(time.time()),
+        'params':    params or {},
+        'results':   results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if out:
+        with open(out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return report
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def python_env():
+    """Environment for child processes: repo importable, quiet defaults."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    env.setdefault('SECRET_KEY', 'benchmark')
+    env.setdefault('ADMIN_PASSWORD', 'benchmark')
+    return env
+
+
+def run_python(code, cwd=None):
+    """Run `code` in a fresh interpreter and return its stdout."""
+    return subprocess.run([sys.executable, '-c', code], cwd=cwd, env=python_env(),
+                          capture_output=True, text=True, check=True).stdout
@@ -0,0 +1,275 @@
+"""
+Hot-path benchmarks against a synthetic library.
+
+  browse      /browse on the root, a wide flat folder, a deep leaf and an
+              image-only folder: the first (cold) view registers the files,
+              then repeated warm views
+  stream      /stream/<id> with N concurrent readers issuing 1 MiB Range
+              requests at random offsets, over real HTTP
+  thumbnails  /thumbnail/<id>: cold (decode + scale + encode) and warm (cached)
+  stats       MetricsSampler.sample() and GET /api/stats
+  chat        /chat/messages newest page, deep scrollback and since-polling
+              over a large history
+  cleanup     run_retention() over a large, half-expired catalog
+
+    python benchmarks/hot_paths.py --files 100000 --out hot_paths.json
+    python benchmarks/hot_paths.py --only browse,stream
+
+Everything runs in a temporary directory: library, databases, thumbnails.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+import http.client
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import summarize, write_report, free_port
+from benchmarks.library import make_library
+
+SUITES       = ('browse', 'stream', 'thumbnails', 'stats', 'chat', 'cleanup')
+ADMIN        = {'REMOTE_ADDR': '127.0.0.1'}
+RANGE_BYTES  = 1024 * 1024
+
+
+def _timed(fn, runs):
+    samples = []
+    for _ in range(runs):
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    return samples
+
+
+def _get_ok(client, url, **kwargs):
+    r = client.get(url, **kwargs)
+    if r.status_code != 200:
+        raise RuntimeError(f'GET {url} → {r.status_code}')
+    r.get_data()
+    r.close()
+    return r
+
+
+def _file_id(app, stored_name):
+    from models import File
+    with app.app_context():
+        return File.query.filter_by(stored_name=stored_name).first().id
+
+
+def _bulk_insert(model, rows, chunk=10_000):
+    from sqlalchemy import insert
+    from extensions import db
+    from sqlite_store import writer
+    for i in range(0, len(rows), chunk):
+        writer.run(lambda part: db.session.execute(insert(model), part), rows[i:i + chunk])
+
+
+# ============================================================
+# SUITES
+# ============================================================
+
+def bench_browse(app, lib, args):
+    client, results = app.test_client(), {}
+    for name, path in lib['paths'].items():
+        url = f'/browse?path={path}'
+        t = time.perf_counter()
+        _get_ok(client, url)
+        cold = time.perf_counter() - t
+        results[name] = {'cold_s': cold, 'warm': summarize(_timed(lambda: _get_ok(client, url), args.runs))}
+    return results
+
+
+def _range_reader(port, path, size, deadline, out):
+    conn  = http.client.HTTPConnection('127.0.0.1', port)
+    rng   = random.Random()
+    got   = 0
+    lat   = []
+    while time.perf_counter() < deadline:
+        start = rng.randrange(0, size - RANGE_BYTES)
+        t = time.perf_counter()
+        conn.request('GET', path, headers={'Range': f'bytes={start}-{start + RANGE_BYTES - 1}'})
+        r = conn.getresponse()
+        got += len(r.read())
+        lat.append(time.perf_counter() - t)
+    conn.close()
+    out.append((got, lat))
+
+
+def bench_stream(app, lib, args):
+    from werkzeug.serving import make_server
+
+    port   = free_port()
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    results = {}
+    try:
+        video = lib['videos'][0]
+        path  = f'/stream/{_file_id(app, video)}'
+        size  = os.path.getsize(os.path.join(app.config['UPLOAD_FOLDER'], video))
+        for readers in args.readers:
+            out, deadline = [], time.perf_counter() + args.stream_seconds
+            threads = [threading.Thread(target=_range_reader, args=(port, path, size, deadline, out))
+                       for _ in range(readers)]
+            started = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - started
+            total   = sum(got for got, _ in out)
+            latency = [x for _, lat in out for x in lat]
+            results[f'readers_{readers}'] = {
+                'mib_per_s':   total / elapsed / (1024 * 1024),
+                'requests':    len(latency),
+                'latency':     summarize(latency),
+            }
+    finally:
+        server.shutdown()
+    return results
+
+
+def bench_thumbnails(app, lib, args):
+    import shutil
+    from routes.files import THUMBNAIL_DIR
+    from models import File
+
+    if not lib['images']:
+        return {'skipped': 'Pillow is not installed'}
+    with app.app_context():
+        ids = [f.id for f in File.query.filter(File.stored_name.like('images/%'))]
+    shutil.rmtree(THUMBNAIL_DIR, ignore_errors=True)
+
+    client = app.test_client()
+    cold   = _timed_each(client, [f'/thumbnail/{i}' for i in ids])
+    warm   = _timed_each(client, [f'/thumbnail/{i}' for i in ids])
+    return {'images': len(ids), 'cold': summarize(cold), 'warm': summarize(warm)}
+
+
+def _timed_each(client, urls):
+    samples = []
+    for url in urls:
+        t = time.perf_counter()
+        _get_ok(client, url)
+        samples.append(time.perf_counter() - t)
+    return samples
+
+
+def bench_stats(app, lib, args):
+    from metrics_sampler import sampler
+
+    client = app.test_client()
+    sampler.sample()   # prime psutil's CPU counters and the network baseline
+    return {
+        'sample':    summarize(_timed(sampler.sample, args.runs)),
+        'api_stats': summarize(_timed(lambda: _get_ok(client, '/api/stats', environ_base=ADMIN), args.runs)),
+    }
+
+
+def bench_chat(app, lib, args):
+    from models import ChatMessage
+
+    now  = datetime.utcnow()
+    rows = [{'sender_ip': f'10.0.{i % 250}.{i % 200}', 'content': f'message {i} ' + 'x' * (i % 80),
+             'timestamp': now - timedelta(seconds=args.chat - i)} for i in range(args.chat)]
+    _bulk_insert(ChatMessage, rows)
+
+    client = app.test_client()
+    middle = args.chat // 2
+    return {
+        'messages':   args.chat,
+        'newest':     summarize(_timed(lambda: _get_ok(client, '/chat/messages'), args.runs)),
+        'scrollback': summarize(_timed(lambda: _get_ok(client, f'/chat/messages?before={middle}'), args.runs)),
+        'since':      summarize(_timed(lambda: _get_ok(client, f'/chat/messages?since={args.chat - 20}'), args.runs)),
+    }
+
+
+def bench_cleanup(app, lib, args):
+    from models import File
+    from retention import run_retention
+
+    # Rows only: files that are not on disk are skipped by the unlink, not the DB work
+    now  = datetime.utcnow()
+    rows = [{'original_name': f'old_{i}.mkv', 'stored_name': f'catalog/old_{i}.mkv',
+             'file_size': 1024 * (i % 1000 + 1),
+             'upload_time': now - timedelta(hours=48 if i % 2 else 1)} for i in range(args.catalog)]
+    _bulk_insert(File, rows)
+
+    with app.app_context():
+        t = time.perf_counter()
+        report = run_retention(dry_run=False)
+        elapsed = time.perf_counter() - t
+    return {'catalog': args.catalog, 'evicted': len(report['evicted']), 'seconds': elapsed}
+
+
+BENCHES = {
+    'browse': bench_browse, 'stream': bench_stream, 'thumbnails': bench_thumbnails,
+    'stats': bench_stats, 'chat': bench_chat, 'cleanup': bench_cleanup,
+}
+
+
+# ============================================================
+# ENTRYPOINT
+# ============================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=10_000, help='library size (10k–500k)')
+    parser.add_argument('--flat', type=int, default=None, help='entries in the widest folder')
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--fanout', type=int, default=6)
+    parser.add_argument('--images', type=int, default=50)
+    parser.add_argument('--runs', type=int, default=20, help='warm repetitions per measurement')
+    parser.add_argument('--readers', default='1,4,16', help='concurrent stream readers, comma-separated')
+    parser.add_argument('--stream-seconds', type=float, default=5.0)
+    parser.add_argument('--chat', type=int, default=200_000, help='chat history size')
+    parser.add_argument('--catalog', type=int, default=100_000, help='extra catalog rows for cleanup')
+    parser.add_argument('--only', default=','.join(SUITES))
+    parser.add_argument('--out', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+    args.readers = [int(n) for n in args.readers.split(',')]
+    suites = [s for s in args.only.split(',') if s]
+    for s in suites:
+        if s not in BENCHES:
+            parser.error(f'unknown suite {s!r}; choose from {", ".join(SUITES)}')
+
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('ADMIN_PASSWORD', 'benchmark')
+
+    with tempfile.TemporaryDirectory(prefix='localshare-bench-') as tmp:
+        os.chdir(tmp)   # thumbnails and any relative paths stay in here
+        lib_root = os.path.join(tmp, 'library')
+        lib = make_library(lib_root, files=args.files, flat=args.flat, depth=args.depth,
+                           fanout=args.fanout, images=args.images)
+
+        import app as app_module
+        app = app_module.create_app(lib_root, config={
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp}/database.db',
+            'SQLALCHEMY_BINDS':        {'activity': f'sqlite:///{tmp}/activity.db'},
+            'SLOW_REQUEST_MS':         0,
+        })
+        app_module.init_storage(app)
+
+        results = {'library': {k: v for k, v in lib.items() if k != 'paths'}}
+        if 'browse' in suites:   # first, while every folder is still unregistered
+            results['browse'] = bench_browse(app, lib, args)
+
+        # Register the rest of the catalog the way a first visit would, so the other suites have ids
+        client = app.test_client()
+        for path in list(lib['paths'].values()) + ['videos']:
+            _get_ok(client, f'/browse?path={path}')
+
+        for name in suites:
+            if name != 'browse':
+                results[name] = BENCHES[name](app, lib, args)
+
+    return write_report('hot_paths', results, out=args.out, params={
+        k: v for k, v in vars(args).items() if k not in ('out', 'only')} | {'suites': suites})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Synthetic media libraries for the benchmarks.
+
+  flat/      one wide folder (the worst case for browse)
+  tree/      the rest of the files spread over a deep tree
+  images/    an image-only folder of real JPEGs (needs Pillow)
+  videos/    sparse .mp4 stand-ins: full size on paper, no disk used
+
+Bulk entries are empty files with media extensions. Browse, catalog
+registration and retention only look at names and sizes.
+"""
+import os
+import time
+
+EXTENSIONS  = ('.mkv', '.mp4', '.mp3', '.flac', '.txt', '.pdf', '.srt', '.zip')
+IMAGE_SIZE  = (1920, 1080)
+
+
+def _tree_dirs(root, depth, fanout):
+    """Leaf directories of a `fanout`-ary tree `depth` levels deep."""
+    leaves = ['']
+    for level in range(depth):
+        leaves = [os.path.join(parent, f'd{level}_{i}') for parent in leaves for i in range(fanout)]
+    for leaf in leaves:
+        os.makedirs(os.path.join(root, leaf), exist_ok=True)
+    return leaves
+
+
+def _touch(path):
+    with open(path, 'wb'):
+        pass
+
+
+def _write_images(folder, count):
+    try:
+        from PIL import Image
+    except ImportError:
+        return 0
+    # A gradient, so the JPEG has real content to decode and scale
+    img = Image.linear_gradient('L').resize(IMAGE_SIZE).convert('RGB')
+    for i in range(count):
+        img.save(os.path.join(folder, f'page_{i:04d}.jpg'), quality=85)
+    return count
+
+
+def make_library(root, files=10_000, flat=None, depth=4, fanout=6,
+                 images=50, videos=4, video_bytes=512 * 1024 * 1024):
+    """
+    Build a library under `root` with roughly `files` entries. Returns a
+    summary with the paths the benchmarks browse ('flat', 'deep', 'images')
+    and the video stand-in file names.
+    """
+    started = time.perf_counter()
+    flat    = min(files // 5, 20_000) if flat is None else flat
+
+    flat_dir = os.path.join(root, 'flat')
+    os.makedirs(flat_dir, exist_ok=True)
+    for i in range(flat):
+        _touch(os.path.join(flat_dir, f'item_{i:06d}{EXTENSIONS[i % len(EXTENSIONS)]}'))
+
+    tree_root = os.path.join(root, 'tree')
+    leaves    = _tree_dirs(tree_root, depth, fanout)
+    rest      = max(files - flat - images - videos, 0)
+    for i in range(rest):
+        leaf = leaves[i % len(leaves)]
+        _touch(os.path.join(tree_root, leaf, f'ep_{i:06d}{EXTENSIONS[i % len(EXTENSIONS)]}'))
+
+    image_dir = os.path.join(root, 'images')
+    os.makedirs(image_dir, exist_ok=True)
+    images = _write_images(image_dir, images)
+
+    video_dir = os.path.join(root, 'videos')
+    os.makedirs(video_dir, exist_ok=True)
+    video_names = []
+    for i in range(videos):
+        name = f'movie_{i}.mp4'
+        with open(os.path.join(video_dir, name), 'wb') as f:
+            f.truncate(video_bytes)
+        video_names.append(f'videos/{name}')
+
+    # A library at rest: folders changed in the last moments are never page-cached (browse_cache.py)
+    past = time.time() - 3600
+    for folder, _, _ in os.walk(root):
+        os.utime(folder, (past, past))
+
+    return {
+        'files':     flat + rest + images + videos,
+        'flat':      flat,
+        'leaves':    len(leaves),
+        'images':    images,
+        'videos':    video_names,
+        'paths':     {'root': '', 'flat': 'flat', 'images': 'images',
+                      'deep': ('tree/' + leaves[0]).replace(os.sep, '/')},
+        'seconds':   time.perf_counter() - started,
+    }
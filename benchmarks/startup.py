@@ -0,0 +1,94 @@
+"""
+Startup time.
+
+  import_s          fresh interpreter: `import app`
+  create_app_s      create_app(): extensions, blueprints, writer threads
+  first_response_s  `python app.py -p PORT FOLDER` spawned → first HTTP 200,
+                    i.e. everything a restart costs, mDNS included
+
+    python benchmarks/startup.py [--runs 5] [--out startup.json]
+
+The server runs against a temporary custom folder, but Flask-SQLAlchemy
+keeps its database in the repo's instance/ folder, as a normal start does.
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import (REPO_ROOT, summarize, write_report, free_port,
+                               python_env, run_python)
+
+_IMPORT_PROBE = '''
+import time, json, sys
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+app.create_app()
+t2 = time.perf_counter()
+heavy = [m for m in ('PIL', 'zeroconf', 'apscheduler') if m in sys.modules]
+print(json.dumps({'import_s': t1 - t0, 'create_app_s': t2 - t1, 'heavy_loaded': heavy}))
+'''
+
+
+def measure_import(folder):
+    return json.loads(run_python(_IMPORT_PROBE, cwd=folder).strip().splitlines()[-1])
+
+
+def measure_first_response(folder, timeout=60.0):
+    port    = free_port()
+    url     = f'http://127.0.0.1:{port}/browse'
+    started = time.perf_counter()
+    proc    = subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, 'app.py'), '-p', str(port), folder],
+                               cwd=folder, env=python_env(),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError(f'server exited with {proc.returncode}')
+            try:
+                with urllib.request.urlopen(url, timeout=1) as r:
+                    if r.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.01)
+        raise RuntimeError('server did not answer in time')
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--out', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    imports, creates, firsts, heavy = [], [], [], set()
+    with tempfile.TemporaryDirectory(prefix='localshare-bench-') as folder:
+        for _ in range(args.runs):
+            probe = measure_import(folder)
+            imports.append(probe['import_s'])
+            creates.append(probe['create_app_s'])
+            heavy.update(probe['heavy_loaded'])
+            firsts.append(measure_first_response(folder))
+
+    return write_report('startup', {
+        'import_s':         summarize(imports),
+        'create_app_s':     summarize(creates),
+        'first_response_s': summarize(firsts),
+        'heavy_modules_at_create_app': sorted(heavy),
+    }, out=args.out, params={'runs': args.runs})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,450 @@
+"""
+Watch Together load generator.
+
+Starts a LocalShare server in a subprocess (temporary databases) and
+connects N simulated viewers spread over R rooms. Each socket viewer
+behaves like stream.html:
+
+  join_watch on connect, then a burst of 5 time_pings 150 ms apart and
+  one every 5 s; a heartbeat watch_action every 4 s; play / pause / seek
+  actions at --actions-per-minute per room, sent by a random viewer
+
+A share of viewers (--http-share) act like a stream.html tab whose socket
+is down. They POST heartbeats to /watch/action and poll /watch/viewers
+every 3 s.
+
+Reported:
+  broadcast_latency  action sent → watch_update received, per receiving viewer
+  ack_latency        watch_action sent → ack
+  rate_limited       share of watch_actions answered 'rate_limited'
+  server_cpu         server process CPU over the measured window, total
+                     and per connected viewer
+
+    python benchmarks/watch_load.py --clients 300 --rooms 3 --duration 30
+
+Every viewer connects from its own loopback address (127.0.x.y), because
+the server tracks viewers and rate limits by IP. That needs Linux, where
+all of 127.0.0.0/8 is local. The generator runs in one process. If its own
+CPU (load_generator_cpu) nears one core, its timings include its own
+queuing; use fewer clients per run.
+"""
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wsproto import WSConnection, ConnectionType
+from wsproto.events import (Request, AcceptConnection, RejectConnection, TextMessage,
+                            Ping, CloseConnection)
+
+from benchmarks.common import summarize, write_report, free_port, python_env
+
+HEARTBEAT_S     = 4.0    # stream.html HEARTBEAT_MS
+PING_INTERVAL_S = 5.0    # stream.html PING_INTERVAL_MS
+PING_BURST      = 5
+PING_BURST_GAP  = 0.15
+VIEWER_POLL_S   = 3.0    # stream.html polls /watch/viewers while its socket is down
+ACK_TIMEOUT_S   = 2.0    # stream.html ACK_TIMEOUT_MS
+
+_SERVER = '''
+import sys
+import app as app_module
+from extensions import socketio
+tmp, port = sys.argv[1], int(sys.argv[2])
+app = app_module.create_app(tmp, config={
+    'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp}/database.db',
+    'SQLALCHEMY_BINDS':        {'activity': f'sqlite:///{tmp}/activity.db'},
+    'SLOW_REQUEST_MS':         0,
+})
+app_module.init_storage(app)
+socketio.run(app, host='0.0.0.0', port=port, allow_unsafe_werkzeug=True)
+'''
+
+
+def client_ip(i):
+    # 127.0.0.1 is an admin address; keep viewers off it
+    return f'127.0.{1 + i // 250}.{2 + i % 250}'
+
+
+# ============================================================
+# RESULTS
+# ============================================================
+
+class Stats:
+    def __init__(self):
+        self.lock          = threading.Lock()
+        self.measuring     = False
+        self.pending       = {}    # (file_id, position) → send time of a play/pause/seek
+        self.broadcast     = []
+        self.acks          = []
+        self.http          = []
+        self.counts        = dict.fromkeys(('actions', 'heartbeats', 'rate_limited',
+                                            'updates', 'pings', 'polls', 'http_errors',
+                                            'actions_limited', 'disconnects'), 0)
+
+    def count(self, key, n=1):
+        if self.measuring:
+            with self.lock:
+                self.counts[key] += n
+
+    def sample(self, series, value):
+        if self.measuring:
+            with self.lock:
+                series.append(value)
+
+
+# ============================================================
+# SIMULATED VIEWERS
+# ============================================================
+
+class SocketViewer:
+    """A Socket.IO client over one websocket (Engine.IO v4), speaking just what stream.html uses."""
+
+    def __init__(self, idx, port, file_id, stats):
+        self.idx      = idx
+        self.ip       = client_ip(idx)
+        self.port     = port
+        self.file_id  = file_id
+        self.stats    = stats
+        self.ready    = threading.Event()
+        self.closed   = False
+        self._sock    = None
+        self._ws      = WSConnection(ConnectionType.CLIENT)
+        self._lock    = threading.Lock()
+        self._acks    = {}
+        self._ack_ids = itertools.count()
+        self._snapshot_seen = False
+        self._text    = []
+
+    def connect(self):
+        self._sock = socket.create_connection(('127.0.0.1', self.port), source_address=(self.ip, 0))
+        self._sock.sendall(self._ws.send(Request(host=f'127.0.0.1:{self.port}',
+                                                 target='/socket.io/?EIO=4&transport=websocket')))
+        threading.Thread(target=self._read, name=f'viewer-{self.idx}', daemon=True).start()
+        if not self.ready.wait(10):
+            raise RuntimeError(f'viewer {self.idx} did not connect')
+        self.emit('join_watch', {'file_id': self.file_id})
+
+    def close(self):
+        try:
+            with self._lock:
+                self.closed = True
+                self._sock.sendall(self._ws.send(CloseConnection(code=1000)))
+            self._sock.close()
+        except OSError:
+            pass
+
+    # ---------- Wire ----------
+
+    def _send(self, text):
+        with self._lock:
+            if self.closed:
+                return
+            self._sock.sendall(self._ws.send(TextMessage(data=text)))
+
+    def emit(self, event, data, on_ack=None):
+        if on_ack is None:
+            self._send('42' + json.dumps([event, data]))
+            return
+        ack_id = next(self._ack_ids)
+        self._acks[ack_id] = on_ack
+        self._send(f'42{ack_id}' + json.dumps([event, data]))
+
+    def _read(self):
+        try:
+            while not self.closed:
+                data = self._sock.recv(65536)
+                if not data:
+                    break
+                self._ws.receive_data(data)
+                for event in self._ws.events():
+                    if isinstance(event, TextMessage):
+                        self._text.append(event.data)
+                        if event.message_finished:
+                            self._packet(''.join(self._text))
+                            self._text = []
+                    elif isinstance(event, Ping):
+                        with self._lock:
+                            if self.closed:
+                                return
+                            self._sock.sendall(self._ws.send(event.response()))
+                    elif isinstance(event, (CloseConnection, RejectConnection)):
+                        return
+                    elif isinstance(event, AcceptConnection):
+                        pass
+        except OSError:
+            pass
+        finally:
+            if not self.closed:
+                self.stats.count('disconnects')
+
+    def _packet(self, pkt):
+        kind = pkt[:1]
+        if kind == '0':                     # Engine.IO open
+            self._send('40')
+        elif kind == '2':                   # Engine.IO ping
+            self._send('3')
+        elif pkt.startswith('40'):          # Socket.IO connected
+            self.ready.set()
+        elif pkt.startswith('42'):
+            name, *args = json.loads(pkt[2:])
+            self._on_event(name, args[0] if args else None)
+        elif pkt.startswith('43'):
+            body   = pkt[2:]
+            split  = body.index('[')
+            on_ack = self._acks.pop(int(body[:split]), None)
+            if on_ack is not None:
+                args = json.loads(body[split:])
+                on_ack(args[0] if args else None)
+
+    def _on_event(self, name, data):
+        if name != 'watch_update':
+            return
+        if not self._snapshot_seen:         # the room state sent on join
+            self._snapshot_seen = True
+            return
+        received = time.perf_counter()
+        with self.stats.lock:
+            sent = self.stats.pending.get((self.file_id, data.get('position')))
+        if sent is not None:
+            self.stats.count('updates')
+            self.stats.sample(self.stats.broadcast, received - sent)
+
+    # ---------- Behaviour ----------
+
+    def ping(self):
+        self.stats.count('pings')
+        self.emit('time_ping', {'t0': time.time(), 'file_id': self.file_id, 'rtt': None, 'offset': 0},
+                  on_ack=lambda r: None)
+
+    def action(self, action, position=None):
+        payload = {'action': action, 'file_id': self.file_id, 'client_time': time.time()}
+        if position is not None:
+            payload['position'] = position
+        self.stats.count('heartbeats' if action == 'heartbeat' else 'actions')
+        sent = time.perf_counter()
+        if action != 'heartbeat':
+            with self.stats.lock:
+                self.stats.pending[(self.file_id, position)] = sent
+
+        def acked(reply):
+            self.stats.sample(self.stats.acks, time.perf_counter() - sent)
+            if reply and reply.get('status') == 'rate_limited':
+                self.stats.count('rate_limited')
+                if action != 'heartbeat':
+                    self.stats.count('actions_limited')
+
+        self.emit('watch_action', payload, on_ack=acked)
+
+
+class HttpViewer:
+    """A stream.html tab with its socket down: HTTP heartbeats and /watch/viewers polling."""
+
+    def __init__(self, idx, port, file_id, stats):
+        self.ip      = client_ip(idx)
+        self.port    = port
+        self.file_id = file_id
+        self.stats   = stats
+        self._local  = threading.local()
+
+    def _request(self, method, path, body=None):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection('127.0.0.1', self.port,
+                                                                 source_address=(self.ip, 0))
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        started = time.perf_counter()
+        try:
+            conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            r = conn.getresponse()
+            r.read()
+        except (OSError, http.client.HTTPException):
+            self._local.conn = None
+            self.stats.count('http_errors')
+            return None
+        self.stats.sample(self.stats.http, time.perf_counter() - started)
+        return r.status
+
+    def heartbeat(self):
+        self.stats.count('heartbeats')
+        status = self._request('POST', f'/watch/action/{self.file_id}',
+                               {'action': 'heartbeat', 'client_time': time.time()})
+        if status == 429:
+            self.stats.count('rate_limited')
+
+    def poll(self):
+        self.stats.count('polls')
+        self._request('GET', f'/watch/viewers/{self.file_id}')
+
+
+# ============================================================
+# SCHEDULER
+# ============================================================
+
+def _drive(schedule, until, http_pool):
+    """Run (when, seq, fn, period) jobs off one heap until `until`; periodic jobs re-arm."""
+    while schedule:
+        when, seq, fn, period = heapq.heappop(schedule)
+        if when >= until:
+            break
+        delay = when - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            if isinstance(fn, tuple):       # ('http', callable): blocking, off the driver thread
+                http_pool.submit(fn[1])
+            else:
+                fn()
+        except OSError:
+            pass
+        if period:
+            heapq.heappush(schedule, (when + period() if callable(period) else when + period, seq, fn, period))
+
+
+def _start_server(tmp, port):
+    proc = subprocess.Popen([sys.executable, '-c', _SERVER, tmp, str(port)], cwd=tmp, env=python_env(),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'server exited with {proc.returncode}')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/watch/viewers/0')
+            if conn.getresponse().status == 200:
+                return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError('server did not start')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=200, help='simulated viewers, all rooms together')
+    parser.add_argument('--rooms', type=int, default=2)
+    parser.add_argument('--http-share', type=float, default=0.1, help='share of viewers without a socket')
+    parser.add_argument('--actions-per-minute', type=float, default=12, help='play/pause/seek per room')
+    parser.add_argument('--ramp', type=float, default=5.0, help='seconds to connect everyone')
+    parser.add_argument('--duration', type=float, default=30.0, help='measured seconds after the ramp')
+    parser.add_argument('--out', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    import psutil
+
+    stats     = Stats()
+    port      = free_port()
+    n_http    = int(args.clients * args.http_share)
+    viewers   = []
+    rng       = random.Random(1)
+    schedule  = []
+    seq       = itertools.count()
+    http_pool = ThreadPoolExecutor(max_workers=32)
+
+    with tempfile.TemporaryDirectory(prefix='localshare-watch-') as tmp:
+        server = _start_server(tmp, port)
+        try:
+            # --- Connect, spread over the ramp ---
+            ramp_gap = args.ramp / max(args.clients, 1)
+            for i in range(args.clients):
+                file_id = 1 + i % args.rooms
+                if i < n_http:
+                    v = HttpViewer(i, port, file_id, stats)
+                    viewers.append(v)
+                    continue
+                v = SocketViewer(i, port, file_id, stats)
+                v.connect()
+                viewers.append(v)
+                for k in range(PING_BURST):
+                    threading.Timer(k * PING_BURST_GAP, v.ping).start()
+                time.sleep(ramp_gap)
+
+            start = time.perf_counter()
+            for v in viewers:
+                offset = rng.uniform(0, HEARTBEAT_S)
+                if isinstance(v, HttpViewer):
+                    heapq.heappush(schedule, (start + offset, next(seq), ('http', v.heartbeat), HEARTBEAT_S))
+                    heapq.heappush(schedule, (start + rng.uniform(0, VIEWER_POLL_S), next(seq),
+                                              ('http', v.poll), VIEWER_POLL_S))
+                else:
+                    heapq.heappush(schedule, (start + offset, next(seq), lambda v=v: v.action('heartbeat'), HEARTBEAT_S))
+                    heapq.heappush(schedule, (start + rng.uniform(0, PING_INTERVAL_S), next(seq), v.ping, PING_INTERVAL_S))
+
+            socket_viewers = [v for v in viewers if isinstance(v, SocketViewer)]
+            if args.actions_per_minute > 0 and socket_viewers:
+                mean_gap = 60.0 / args.actions_per_minute
+                for room in range(1, args.rooms + 1):
+                    members = [v for v in socket_viewers if v.file_id == room]
+                    if not members:
+                        continue
+
+                    def room_action(members=members):
+                        action = rng.choice(('play', 'pause', 'seek'))
+                        rng.choice(members).action(action, round(rng.uniform(0, 7200), 6))
+
+                    heapq.heappush(schedule, (start + rng.expovariate(1 / mean_gap), next(seq), room_action,
+                                              lambda: rng.expovariate(1 / mean_gap)))
+
+            # --- Measure ---
+            proc, me = psutil.Process(server.pid), psutil.Process()
+            cpu0, my0 = proc.cpu_times(), me.cpu_times()
+            stats.measuring = True
+            measured_from = time.perf_counter()
+            _drive(schedule, measured_from + args.duration, http_pool)
+            elapsed = time.perf_counter() - measured_from
+            cpu1, my1 = proc.cpu_times(), me.cpu_times()
+            rss = proc.memory_info().rss
+            time.sleep(ACK_TIMEOUT_S)       # let in-flight broadcasts and acks land
+            stats.measuring = False
+        finally:
+            for v in viewers:
+                if isinstance(v, SocketViewer):
+                    v.close()
+            http_pool.shutdown(wait=False)
+            server.terminate()
+            try:
+                server.wait(5)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+    server_cpu = (cpu1.user - cpu0.user) + (cpu1.system - cpu0.system)
+    gen_cpu    = (my1.user - my0.user) + (my1.system - my0.system)
+    c          = stats.counts
+    sent       = c['actions'] + c['heartbeats']
+    socket_n   = args.clients - n_http
+    # Every socket viewer in the room gets each accepted action, the sender included
+    expected   = (c['actions'] - c['actions_limited']) * socket_n / args.rooms
+
+    return write_report('watch_load', {
+        'broadcast_latency': summarize(stats.broadcast) if stats.broadcast else None,
+        'ack_latency':       summarize(stats.acks) if stats.acks else None,
+        'http_latency':      summarize(stats.http) if stats.http else None,
+        # Counted until ACK_TIMEOUT_S after the window; a shortfall means updates queued past that
+        'deliveries':        {'received': c['updates'], 'expected': round(expected),
+                              'ratio': c['updates'] / expected if expected else None},
+        'rate_limited':      {'count': c['rate_limited'], 'of': sent,
+                              'share': c['rate_limited'] / sent if sent else 0.0},
+        'counts':            c,
+        'server_cpu':        {'seconds': server_cpu, 'cores': server_cpu / elapsed,
+                              'ms_per_s_per_viewer': server_cpu / elapsed / args.clients * 1000,
+                              'rss_bytes': rss},
+        'load_generator_cpu': {'cores': gen_cpu / elapsed},
+        'measured_seconds':  elapsed,
+    }, out=args.out, params={k: v for k, v in vars(args).items() if k != 'out'} |
+                              {'socket_viewers': socket_n, 'http_viewers': n_http})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import metrics
+from extensions import state
+
+# ============================================================
+# BROWSE PAGE CACHE
+# Rendered /browse pages, so a folder that is refreshed over and over
+# (kiosk tablets on the root) skips the scan, sort, catalog lookup and
+# Jinja render. Entries are keyed by (folder, directory mtime, index
+# version):
+#
+#  - the directory mtime changes when anything is added to, removed
+#    from or renamed in the folder, by the app or behind its back
+#  - the index version is bumped by invalidate(), which upload, delete,
+#    rename and retention call for the folders whose catalog rows they
+#    changed (an overwrite or an evicted row leaves the mtime alone)
+#
+# An entry holds the template context, which admins and guests share,
+# plus one rendered page per admin flag. Each page keeps its compressed
+# bodies and a content ETag, so a repeat view is a dict lookup and a
+# refresh with If-None-Match is a 304.
+#
+# The LRU is bounded by entry count and rendered bytes. A folder whose
+# mtime is under RACY_SECONDS old is not cached, because a change in the
+# same filesystem tick would leave the mtime unchanged. Invalidations are
+# published on the state store, so every worker drops its copies.
+# ============================================================
+
+MAX_ENTRIES  = 256
+MAX_BYTES    = 64 * 1024 * 1024   # rendered HTML, before compression
+RACY_SECONDS = 2.0
+_CHANNEL     = 'browse:invalidate'
+
+
+class Page:
+    __slots__ = ('bodies', 'etag')
+
+    def __init__(self, html):
+        data        = html.encode('utf-8')
+        self.bodies = {None: data}   # encoding → bytes, filled by compression.encoded_response
+        self.etag   = hashlib.blake2b(data, digest_size=12).hexdigest()
+
+
+class Entry:
+    __slots__ = ('context', 'pages', 'size')
+
+    def __init__(self, context):
+        self.context = context
+        self.pages   = {}            # admin flag → Page
+        self.size    = 0
+
+
+class BrowseCache:
+    def __init__(self, store, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self._store      = store
+        self._lock       = threading.Lock()
+        self._entries    = OrderedDict()   # (folder, mtime_ns, version) → Entry; LRU order
+        self._versions   = {}              # folder → bumps for that folder
+        self._generation = 0               # bumps for everything
+        self._bytes      = 0
+        store.subscribe(_CHANNEL, self._drop)
+
+    def key(self, folder, full_path):
+        """Cache key for `folder` (relative, '/'-separated), or None if it must not be cached."""
+        try:
+            mtime = os.stat(full_path).st_mtime_ns
+        except OSError:
+            return None
+        if time.time() - mtime / 1e9 < RACY_SECONDS:
+            return None
+        return folder, mtime, self._version(folder)
+
+    def _version(self, folder):
+        # Only ever grows, so a key built before an invalidation never matches again
+        return self._generation + self._versions.get(folder, 0)
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        metrics.BROWSE_CACHE.inc('hit' if entry is not None else 'miss')
+        return entry
+
+    def put(self, key, context):
+        entry = Entry(context)
+        if key is None:
+            return entry
+        with self._lock:
+            if key[2] != self._version(key[0]):
+                return entry            # invalidated while this request was building it
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[key] = entry
+            self._evict()
+        return entry
+
+    def add_page(self, key, entry, admin, html):
+        page = entry.pages[admin] = Page(html)
+        size = len(page.bodies[None])
+        with self._lock:
+            if self._entries.get(key) is entry:
+                entry.size  += size
+                self._bytes += size
+                self._evict()
+        return page
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, old = self._entries.popitem(last=False)
+            self._bytes -= old.size
+
+    # ---------- Invalidation ----------
+
+    def invalidate(self, *folders):
+        """Drop the pages for `folders` ('' is the root) in every worker; no arguments drops everything."""
+        folders = sorted({f.replace('\\', '/').strip('/') for f in folders})
+        self._drop(folders)              # now, not when pub/sub gets back to this worker
+        self._store.publish(_CHANNEL, folders)
+
+    def _drop(self, folders):
+        with self._lock:
+            if not folders:
+                self._generation += 1
+                self._entries.clear()
+                self._bytes = 0
+                return
+            for folder in folders:
+                self._versions[folder] = self._versions.get(folder, 0) + 1
+            stale = set(folders)
+            for key in [k for k in self._entries if k[0] in stale]:
+                self._bytes -= self._entries.pop(key).size
+
+
+cache = BrowseCache(state)
+
+
+def folder_of(stored_name):
+    """'Movies/2024/a.mkv' → 'Movies/2024'; files in the root → ''."""
+    return stored_name.replace('\\', '/').rpartition('/')[0]
@@ -0,0 +1,202 @@
+import io
+import os
+import re
+import zlib
+import struct
+import hashlib
+import zipfile
+import threading
+from collections import OrderedDict
+
+# ============================================================
+# COMIC ARCHIVES  (.cbz / .zip, and .cbr files that are ZIPs inside)
+# Pages are read straight out of the archive; nothing is extracted.
+# Opening an archive reads its central directory once, plus each page's
+# local header to find where its data starts. That index (names, data
+# offsets, sizes, compression) is cached per (path, mtime, size) in a
+# small LRU.
+#
+# Stored pages, the usual case because JPEG and PNG do not compress,
+# are served as a byte window of the archive with Range support.
+# Deflated pages are inflated into memory, up to MAX_PAGE_BYTES.
+#
+# When page n is served, the next PREFETCH_PAGES are hinted to the kernel
+# with posix_fadvise(WILLNEED). The disk reads them while the reader is
+# on this page, so turning the page is served from the page cache.
+# Elsewhere the hint is skipped.
+#
+# RAR archives need an unrar library, which the standard library lacks,
+# so a .cbr that is really RAR is reported as unsupported.
+# ============================================================
+
+ARCHIVE_EXTENSIONS = {'.cbz', '.cbr', '.zip'}
+PAGE_EXTENSIONS    = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.avif'}
+MAX_INDEXES        = 64
+MAX_PAGE_BYTES     = 64 * 1024 * 1024
+PREFETCH_PAGES     = 4
+
+_LOCAL_HEADER = struct.Struct('<4s5H3I2H')   # 30 bytes; the last two fields are name and extra lengths
+_LOCAL_MAGIC  = b'PK\x03\x04'
+
+
+class UnsupportedArchive(Exception):
+    pass
+
+
+def _natural_key(s):
+    return [int(t) if t.isdigit() else t.lower() for t in re.split(r'(\d+)', s)]
+
+
+class ArchivePage:
+    __slots__ = ('name', 'offset', 'size', 'compressed_size', 'deflated')
+
+    def __init__(self, name, offset, size, compressed_size, deflated):
+        self.name            = name
+        self.offset          = offset            # first byte of the entry's data in the archive
+        self.size            = size
+        self.compressed_size = compressed_size
+        self.deflated        = deflated
+
+
+class ArchiveIndex:
+    __slots__ = ('path', 'stamp', 'fingerprint', 'pages')
+
+    def __init__(self, path, stamp, pages):
+        self.path        = path
+        self.stamp       = stamp
+        self.fingerprint = hashlib.blake2b(repr(stamp).encode(), digest_size=8).hexdigest()
+        self.pages       = pages   # reading order
+
+
+def _build_index(path, stamp):
+    pages = []
+    with open(path, 'rb') as f:
+        try:
+            infos = zipfile.ZipFile(f).infolist()
+        except zipfile.BadZipFile:
+            raise UnsupportedArchive(f'{os.path.basename(path)} is not a ZIP archive') from None
+
+        for info in infos:
+            name = info.filename
+            base = name.rsplit('/', 1)[-1]
+            if (info.is_dir() or base.startswith('.') or name.startswith('__MACOSX/')
+                    or os.path.splitext(base)[1].lower() not in PAGE_EXTENSIONS
+                    or info.flag_bits & 0x1                                   # encrypted
+                    or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)):
+                continue
+            f.seek(info.header_offset)
+            header = f.read(_LOCAL_HEADER.size)
+            if len(header) < _LOCAL_HEADER.size:
+                continue
+            fields = _LOCAL_HEADER.unpack(header)
+            if fields[0] != _LOCAL_MAGIC:
+                continue
+            offset = info.header_offset + _LOCAL_HEADER.size + fields[-2] + fields[-1]
+            pages.append(ArchivePage(name, offset, info.file_size, info.compress_size,
+                                     info.compress_type == zipfile.ZIP_DEFLATED))
+
+    pages.sort(key=lambda p: _natural_key(p.name))
+    return ArchiveIndex(path, stamp, pages)
+
+
+class ArchiveIndexCache:
+    def __init__(self, max_indexes=MAX_INDEXES):
+        self.max_indexes = max_indexes
+        self._lock       = threading.Lock()
+        self._indexes    = OrderedDict()   # path → ArchiveIndex; LRU order
+
+    def get(self, path):
+        """The index for the archive at `path`, rebuilt if the file changed. Raises OSError or UnsupportedArchive."""
+        st    = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            index = self._indexes.get(path)
+            if index is not None and index.stamp == stamp:
+                self._indexes.move_to_end(path)
+                return index
+
+        index = _build_index(path, stamp)   # outside the lock: a cold index reads every local header
+        with self._lock:
+            self._indexes[path] = index
+            self._indexes.move_to_end(path)
+            while len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+        return index
+
+
+archives = ArchiveIndexCache()
+
+
+# ---------- Reading pages ----------
+
+class PageReader(io.RawIOBase):
+    """A read-only, seekable window [offset, offset + length) of a file."""
+
+    def __init__(self, path, offset, length):
+        self._f      = open(path, 'rb')
+        self._start  = offset
+        self._length = length
+        self._pos    = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self._length - self._pos)
+        if n <= 0:
+            return 0
+        self._f.seek(self._start + self._pos)
+        got = self._f.readinto(memoryview(b)[:n])
+        self._pos += got
+        return got
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        base      = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._length}[whence]
+        self._pos = max(0, min(self._length, base + pos))
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._f.close()
+        super().close()
+
+
+def read_page(index, page):
+    """The whole page as bytes (thumbnails, deflated pages)."""
+    if page.size > MAX_PAGE_BYTES:
+        raise UnsupportedArchive(f'{page.name} is over {MAX_PAGE_BYTES} bytes')
+    with open(index.path, 'rb') as f:
+        f.seek(page.offset)
+        data = f.read(page.compressed_size)
+    if page.deflated:
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        data     = inflater.decompress(data, MAX_PAGE_BYTES + 1)
+        if len(data) > MAX_PAGE_BYTES:
+            raise UnsupportedArchive(f'{page.name} inflates past {MAX_PAGE_BYTES} bytes')
+    return data
+
+
+def prefetch(index, number, count=PREFETCH_PAGES):
+    """Ask the kernel to start reading the pages after `number`."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    upcoming = index.pages[number + 1:number + 1 + count]
+    if not upcoming:
+        return
+    try:
+        fd = os.open(index.path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        for page in upcoming:
+            os.posix_fadvise(fd, page.offset, page.compressed_size, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,198 @@
+import os
+import gzip
+import hashlib
+import mimetypes
+import threading
+
+from flask import request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# ============================================================
+# RESPONSE COMPRESSION
+# Dynamic responses (browse pages, JSON APIs, chat history, VTT
+# subtitles) are compressed in an after_request hook when the body is a
+# compressible type of at least MIN_BYTES: brotli if the 'brotli'
+# package is installed and the client accepts it, otherwise gzip.
+# Levels are moderate, so a large browse page costs milliseconds.
+#
+# Static text assets are compressed once at the highest levels, on a
+# thread started with the app, and served from memory. url_for('static')
+# appends ?v=<content hash>. A request carrying the current hash is
+# cached for a year as immutable, so the player scripts come from the
+# browser cache on repeat visits. Any other request revalidates by
+# ETag and honours Range, as send_file did. An asset edited on disk is
+# reloaded, with a new hash, on its next request.
+#
+# Streams, ranges, archives and send_file responses pass through
+# untouched: they are streamed or direct_passthrough, and media does
+# not compress.
+# ============================================================
+
+MIN_BYTES      = 1024
+GZIP_LEVEL     = 6
+BROTLI_QUALITY = 5
+STATIC_MAX_AGE = 365 * 86400
+COMPRESSIBLE   = {'text/html', 'text/css', 'text/plain', 'text/vtt', 'text/javascript',
+                  'application/javascript', 'application/json', 'image/svg+xml'}
+ENCODINGS      = ('br', 'gzip') if brotli is not None else ('gzip',)   # server preference on ties
+
+
+def _encode(data, encoding, best=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=9 if best else GZIP_LEVEL, mtime=0)
+
+
+def _negotiate():
+    """The client's preferred encoding among ENCODINGS, or None for identity."""
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def _compress(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _negotiate()
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_BYTES:
+        return response
+
+    response.set_data(_encode(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
+
+
+def encoded_response(bodies, mimetype, etag=None):
+    """
+    A response carrying the client's preferred encoding of bodies[None].
+    Encodings are added to `bodies` on first use, so a cached page is
+    compressed once rather than on every request. `etag` is suffixed with
+    the encoding, as the dynamic path does.
+    """
+    encoding = _negotiate() if len(bodies[None]) >= MIN_BYTES else None
+    if encoding is not None and encoding not in bodies:
+        bodies[encoding] = _encode(bodies[None], encoding)
+    resp = Response(bodies[encoding], mimetype=mimetype)
+    resp.vary.add('Accept-Encoding')
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    if etag:
+        resp.set_etag(f'{etag}-{encoding}' if encoding else etag)
+    return resp
+
+
+# ============================================================
+# STATIC ASSETS
+# ============================================================
+
+class _Asset:
+    __slots__ = ('stamp', 'mimetype', 'fingerprint', 'bodies')
+
+    def __init__(self, stamp, mimetype, fingerprint, bodies):
+        self.stamp       = stamp
+        self.mimetype    = mimetype
+        self.fingerprint = fingerprint
+        self.bodies      = bodies    # encoding (None = identity) → bytes
+
+
+class StaticAssets:
+    """Precompressed copies of the compressible files in the static folder, keyed by URL filename."""
+
+    def __init__(self):
+        self._lock   = threading.Lock()
+        self._assets = {}
+        self._paths  = {}    # filename → path on disk
+
+    def scan(self, folder):
+        for root, _, names in os.walk(folder):
+            for name in names:
+                path     = os.path.join(root, name)
+                mimetype = mimetypes.guess_type(name)[0]
+                if mimetype in COMPRESSIBLE:
+                    self._paths[os.path.relpath(path, folder).replace(os.sep, '/')] = path
+
+    def warm(self):
+        for filename in list(self._paths):
+            self.get(filename)
+
+    def get(self, filename):
+        """The asset for `filename`, (re)built if missing or changed on disk; None if not managed."""
+        path = self._paths.get(filename)
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stamp = (st.st_mtime_ns, st.st_size)
+        asset = self._assets.get(filename)
+        if asset is not None and asset.stamp == stamp:
+            return asset
+        with self._lock:
+            asset = self._assets.get(filename)
+            if asset is None or asset.stamp != stamp:
+                asset = self._assets[filename] = self._build(path, stamp)
+        return asset
+
+    @staticmethod
+    def _build(path, stamp):
+        with open(path, 'rb') as f:
+            data = f.read()
+        bodies = {None: data}
+        if len(data) >= MIN_BYTES:
+            for encoding in ENCODINGS:
+                bodies[encoding] = _encode(data, encoding, best=True)
+        return _Asset(stamp, mimetypes.guess_type(path)[0],
+                      hashlib.blake2b(data, digest_size=8).hexdigest(), bodies)
+
+
+assets = StaticAssets()
+
+
+def _fingerprint_url(endpoint, values):
+    if endpoint != 'static' or 'v' in values:
+        return
+    asset = assets.get(values.get('filename'))
+    if asset is not None:
+        values['v'] = asset.fingerprint
+
+
+def _serve_asset(asset):
+    resp = encoded_response(asset.bodies, asset.mimetype, etag=asset.fingerprint)
+    if request.args.get('v') == asset.fingerprint:
+        resp.cache_control.public    = True
+        resp.cache_control.max_age   = STATIC_MAX_AGE
+        resp.cache_control.immutable = True
+    else:
+        resp.cache_control.no_cache = True
+    # Range requests apply to the selected encoding, as with send_file
+    return resp.make_conditional(request, accept_ranges=True,
+                                 complete_length=resp.content_length)
+
+
+def init_app(app):
+    app.after_request(_compress)
+    if 'static' not in app.view_functions or not os.path.isdir(app.static_folder or ''):
+        return
+
+    send_static = app.view_functions['static']
+
+    def static(filename):
+        asset = assets.get(filename)
+        return _serve_asset(asset) if asset is not None else send_static(filename=filename)
+
+    assets.scan(app.static_folder)
+    app.view_functions['static'] = static
+    app.url_defaults(_fingerprint_url)
+    # Brotli at quality 11 takes a moment on the larger scripts; keep it off the startup path
+    threading.Thread(target=assets.warm, name='static-precompress', daemon=True).start()
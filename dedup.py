@@ -0,0 +1,243 @@
+import os
+import time
+import hashlib
+import secrets
+import threading
+import logging
+from collections import defaultdict
+
+from upload_stream import TEMP_PREFIXES
+
+logger = logging.getLogger(__name__)
+
+# ============================================================
+# CONTENT-HASH DEDUPLICATION
+# Identical content is stored once and hardlinked under every name.
+# BLAKE2b is in hashlib on every supported Python and runs near disk speed;
+# xxhash would be faster but adds a compiled dependency for no real gain
+# when the disk is the bottleneck.
+# ============================================================
+
+HASH_NAME     = 'blake2b'
+PARTIAL_BYTES = 64 * 1024          # head + tail sample for the partial pass
+READ_CHUNK    = 4 * 1024 * 1024
+MIN_DEDUP_SIZE = 64 * 1024         # tiny files aren't worth a hardlink
+
+
+def hash_file(path):
+    """Full content hash of a file on disk."""
+    h = hashlib.new(HASH_NAME)
+    with open(path, 'rb', buffering=0) as f:
+        while chunk := f.read(READ_CHUNK):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def partial_hash(path, size):
+    """Cheap fingerprint from the first and last PARTIAL_BYTES of a file."""
+    h = hashlib.new(HASH_NAME, digest_size=16)
+    with open(path, 'rb', buffering=0) as f:
+        h.update(f.read(PARTIAL_BYTES))
+        if size > 2 * PARTIAL_BYTES:
+            f.seek(size - PARTIAL_BYTES)
+            h.update(f.read(PARTIAL_BYTES))
+    return h.hexdigest()
+
+
+def link_to(dest, source):
+    """
+    Atomically replace `dest` with a hardlink to `source`.
+    Returns False (leaving `dest` untouched) when the two live on different
+    filesystems or the OS refuses the link.
+    """
+    try:
+        if os.path.samefile(dest, source):
+            return True
+    except OSError:
+        return False
+
+    tmp = os.path.join(os.path.dirname(dest), f'.dedup-{secrets.token_hex(6)}')
+    try:
+        os.link(source, tmp)
+        os.replace(tmp, dest)
+        return True
+    except OSError as e:
+        logger.info(f"Dedup: could not link {dest} -> {source}: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+
+
+def same_content(a, b):
+    """Byte-compare two files. The stored hash can be stale if a file was edited in place."""
+    with open(a, 'rb', buffering=0) as fa, open(b, 'rb', buffering=0) as fb:
+        while True:
+            ca, cb = fa.read(READ_CHUNK), fb.read(READ_CHUNK)
+            if ca != cb:
+                return False
+            if not ca:
+                return True
+
+
+def find_existing_copy(upload_folder, staged, digest, size, exclude_stored, batch=()):
+    """
+    Another file whose content is byte-identical to `staged`, or None.
+    `batch` holds paths written earlier in the same upload, tried first;
+    then File rows with the same hash and size. Candidates are compared in
+    full before being returned. Must be called within an active Flask
+    application context.
+    """
+    from models import File
+
+    rows = (File.query
+            .filter(File.content_hash == digest,
+                    File.file_size == size,
+                    File.stored_name != exclude_stored)
+            .limit(8)
+            .all())
+    for path in list(batch) + [os.path.join(upload_folder, r.stored_name) for r in rows]:
+        try:
+            if os.path.getsize(path) == size and same_content(staged, path):
+                return path
+        except OSError:
+            continue
+    return None
+
+
+# ============================================================
+# LIBRARY SCAN  — size buckets → partial hash → full hash
+# Only files that share a size are ever opened, and only those that also
+# share a head/tail fingerprint are read in full, so a terabyte library is
+# mostly a metadata walk.
+# ============================================================
+
+def find_duplicate_groups(root, min_size=MIN_DEDUP_SIZE):
+    """
+    Return [(digest, size, [abs paths…]), …] for every set of identical files
+    under `root`. Paths already hardlinked together count once.
+    """
+    by_size = defaultdict(list)
+    seen    = set()   # (st_dev, st_ino) — skip names that are already links
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for name in filenames:
+            if name.startswith(TEMP_PREFIXES):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path, follow_symlinks=False)
+            except OSError:
+                continue
+            if st.st_size < min_size or not os.path.isfile(path):
+                continue
+            key = (st.st_dev, st.st_ino)
+            if key in seen:
+                continue
+            seen.add(key)
+            by_size[st.st_size].append(path)
+
+    groups = []
+    for size, paths in by_size.items():
+        if len(paths) < 2:
+            continue
+
+        by_partial = defaultdict(list)
+        for p in paths:
+            try:
+                by_partial[partial_hash(p, size)].append(p)
+            except OSError:
+                pass
+
+        for candidates in by_partial.values():
+            if len(candidates) < 2:
+                continue
+            by_full = defaultdict(list)
+            for p in candidates:
+                try:
+                    by_full[hash_file(p)].append(p)
+                except OSError:
+                    pass
+            for digest, same in by_full.items():
+                if len(same) > 1:
+                    groups.append((digest, size, sorted(same)))
+
+    return groups
+
+
+# ============================================================
+# ADMIN JOB  — one background scan at a time, progress polled by dashboard
+# ============================================================
+
+dedupe_job = {
+    'running':     False,
+    'started':     None,
+    'finished':    None,
+    'applied':     False,
+    'groups':      0,
+    'reclaimable': 0,
+    'linked':      0,
+    'error':       None,
+}
+_dedupe_lock = threading.Lock()
+
+
+def start_dedupe_job(app, apply=False):
+    """Kick off a library scan in a daemon thread. Returns False if one is already running."""
+    with _dedupe_lock:
+        if dedupe_job['running']:
+            return False
+        dedupe_job.update(running=True, started=int(time.time()), finished=None,
+                          applied=apply, groups=0, reclaimable=0, linked=0, error=None)
+
+    threading.Thread(target=_run_dedupe, args=(app, apply),
+                     name='dedupe', daemon=True).start()
+    return True
+
+
+def _tag_hash(rels, digest):
+    """DB writer job."""
+    from models import File
+    File.query.filter(File.stored_name.in_(rels)) \
+              .update({File.content_hash: digest}, synchronize_session=False)
+
+
+def _run_dedupe(app, apply):
+    from sqlite_store import writer
+
+    try:
+        with app.app_context():
+            upload_folder = app.config['UPLOAD_FOLDER']
+            groups = find_duplicate_groups(upload_folder)
+
+            reclaimable = sum(size * (len(paths) - 1) for _, size, paths in groups)
+            linked      = 0
+            tagged      = []
+
+            for digest, size, paths in groups:
+                rels = [os.path.relpath(p, upload_folder).replace('\\', '/') for p in paths]
+                # Queued without waiting; the DB writer commits them in batches
+                tagged.append(writer.submit(_tag_hash, rels, digest))
+
+                if apply:
+                    keeper = paths[0]
+                    for dup in paths[1:]:
+                        if link_to(dup, keeper):
+                            linked += 1
+
+            for future in tagged:
+                future.result()
+
+            with _dedupe_lock:
+                dedupe_job.update(groups=len(groups), reclaimable=reclaimable, linked=linked)
+            logger.info(f"Dedup scan: {len(groups)} duplicate groups, "
+                        f"{reclaimable} bytes reclaimable, {linked} files linked")
+    except Exception as e:
+        logger.exception("Dedup scan failed")
+        with _dedupe_lock:
+            dedupe_job['error'] = str(e)
+    finally:
+        with _dedupe_lock:
+            dedupe_job.update(running=False, finished=int(time.time()))
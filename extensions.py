@@ -1,5 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
-from flask_socketio import SocketIO
+
+from metrics import InstrumentedSocketIO
+from state_backend import StateStore
 
 db = SQLAlchemy()
-socketio = SocketIO()
\ No newline at end of file
+socketio = InstrumentedSocketIO()
+state = StateStore()
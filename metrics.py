@@ -0,0 +1,265 @@
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+
+from flask import request
+from flask_socketio import SocketIO
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# ============================================================
+# PROMETHEUS METRICS
+# Counters, gauges and histograms kept in process and rendered in the
+# Prometheus text format by the admin-only /metrics route. Recording is
+# a lock and a couple of dict/list updates. Histograms find their bucket
+# by bisect and render cumulative counts only at scrape time.
+#
+# Every worker keeps its own numbers. With several workers, scrape each
+# worker's port directly, not through the proxy.
+# ============================================================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FFMPEG_BUCKETS  = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_BUCKETS   = (0, 1, 2, 5, 10, 25, 50, 100)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{v}"' for n, v in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _num(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name       = name
+        self.help       = help
+        self.labelnames = tuple(labels)
+        self._lock      = threading.Lock()
+        self._values    = {}   # label values tuple → value
+        _registry.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{_labels(self.labelnames, key)} {_num(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)   # le semantics: value <= bound
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[i]  += 1
+            entry[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        for key, entry in items:
+            running = 0
+            for bound, n in zip(self.buckets + ('+Inf',), entry[:-1]):
+                running += n
+                le = bound if bound == '+Inf' else _num(float(bound))
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, [("le", le)])} {running}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_num(entry[-1])}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {running}')
+        return lines
+
+
+def render():
+    """Every registered metric in Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# ============================================================
+# METRICS
+# ============================================================
+
+HTTP_REQUESTS = Counter('localshare_http_requests_total',
+                        'HTTP requests by endpoint, method and status.',
+                        ('endpoint', 'method', 'status'))
+HTTP_LATENCY  = Histogram('localshare_http_request_duration_seconds',
+                          'Time spent in the view until the response object is returned '
+                          '(streamed bodies are sent afterwards).',
+                          ('endpoint',))
+HTTP_BYTES    = Counter('localshare_http_response_bytes_total',
+                        'Response body bytes actually sent, by endpoint (see transfer_stats.py).',
+                        ('endpoint',))
+DB_QUERIES    = Counter('localshare_db_queries_total', 'SQL statements executed, all threads.')
+DB_PER_REQUEST = Histogram('localshare_db_queries_per_request',
+                           'SQL statements executed while handling one request.',
+                           ('endpoint',), buckets=QUERY_BUCKETS)
+DB_WRITE_BATCH = Histogram('localshare_db_write_batch_jobs',
+                           'Write jobs committed together in one transaction (sqlite_store.py).',
+                           buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+FFMPEG_SECONDS = Histogram('localshare_ffmpeg_duration_seconds',
+                           'Wall time of ffmpeg/ffprobe runs by job kind.',
+                           ('job',), buckets=FFMPEG_BUCKETS)
+FFMPEG_ACTIVE  = Gauge('localshare_ffmpeg_jobs_in_progress',
+                       'ffmpeg/ffprobe processes currently running, by job kind.',
+                       ('job',))
+BROWSE_CACHE   = Counter('localshare_browse_cache_total',
+                         'Browse page cache lookups, hit or miss (browse_cache.py).', ('result',))
+SIO_EVENTS     = Counter('localshare_socketio_events_total',
+                         'Socket.IO events received, by event name.', ('event',))
+SIO_LATENCY    = Histogram('localshare_socketio_event_duration_seconds',
+                           'Socket.IO handler run time, by event name.', ('event',))
+SIO_EMITS      = Counter('localshare_socketio_emits_total',
+                         'Socket.IO events emitted by the server, by event name.', ('event',))
+
+
+# ============================================================
+# HOOKS
+# ============================================================
+
+_tls = threading.local()   # per-request counters (threading async_mode: one request per thread)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    DB_QUERIES.inc()
+    if getattr(_tls, 'started', None) is not None:
+        _tls.queries += 1
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if started and getattr(_tls, 'started', None) is not None:
+        _tls.db_seconds += time.perf_counter() - started.pop()
+
+
+def _before_request():
+    _tls.started            = time.perf_counter()
+    _tls.queries            = 0
+    _tls.db_seconds         = 0.0
+    _tls.subprocess_seconds = 0.0
+
+
+def _after_request(response):
+    started = getattr(_tls, 'started', None)
+    if started is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    HTTP_REQUESTS.inc(endpoint, request.method, response.status_code)
+    HTTP_LATENCY.observe(time.perf_counter() - started, endpoint)
+    DB_PER_REQUEST.observe(_tls.queries, endpoint)
+    return response
+
+
+def _teardown_request(exc):
+    # After every after_request hook, so profiling can still read the counters
+    _tls.started = None
+
+
+def request_breakdown():
+    """Counters for the request running on this thread, or None outside a request."""
+    started = getattr(_tls, 'started', None)
+    if started is None:
+        return None
+    return {
+        'seconds':            time.perf_counter() - started,
+        'queries':            _tls.queries,
+        'db_seconds':         _tls.db_seconds,
+        'subprocess_seconds': _tls.subprocess_seconds,
+    }
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+
+
+@contextmanager
+def ffmpeg_job(kind):
+    """Time one ffmpeg/ffprobe run: `with ffmpeg_job('thumbnail'): subprocess.run(...)`."""
+    FFMPEG_ACTIVE.inc(kind)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        FFMPEG_ACTIVE.dec(kind)
+        FFMPEG_SECONDS.observe(elapsed, kind)
+        if getattr(_tls, 'started', None) is not None:
+            _tls.subprocess_seconds += elapsed
+
+
+class InstrumentedSocketIO(SocketIO):
+    """SocketIO that counts and times every handler and counts every emit."""
+
+    def on(self, message, namespace=None):
+        register = super().on(message, namespace)
+        if message == 'connect':
+            return register   # Flask-SocketIO retries connect handlers on TypeError
+
+        def decorator(handler):
+            @functools.wraps(handler)
+            def timed(*args):
+                SIO_EVENTS.inc(message)
+                started = time.perf_counter()
+                try:
+                    return handler(*args)
+                finally:
+                    SIO_LATENCY.observe(time.perf_counter() - started, message)
+            register(timed)
+            return handler
+        return decorator
+
+    def emit(self, event, *args, **kwargs):
+        SIO_EMITS.inc(event)
+        return super().emit(event, *args, **kwargs)
@@ -0,0 +1,269 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+
+from extensions import socketio
+from utils import human_readable_size, recent_activity
+from transfer_stats import transfers, WINDOWS
+from upload_stream import TEMP_PREFIXES
+
+logger = logging.getLogger(__name__)
+
+# ============================================================
+# DASHBOARD METRICS SAMPLER
+# One thread per worker builds the dashboard snapshot every
+# SAMPLE_INTERVAL seconds and pushes it to the admin Socket.IO room.
+# /api/stats returns the latest snapshot. Open dashboards only read;
+# ten tabs cost the same as one, and the network rate is always diffed
+# over one clean interval.
+#
+# The thumbnail scan and the orphan diff (a full DB read against
+# os.listdir) run once every SLOW_EVERY samples, and only while a
+# dashboard is attached to this worker.
+# ============================================================
+
+SAMPLE_INTERVAL = 4       # seconds
+HISTORY_LEN     = 900     # network samples kept — one hour
+SLOW_EVERY      = 15      # slow metrics: once a minute
+DEMAND_TIMEOUT  = 60      # /api/stats keeps slow metrics fresh this long
+SLOW_REQUESTS_SHOWN = 20  # listed on the dashboard
+ADMIN_ROOM      = 'admin_stats'
+
+
+class MetricsSampler:
+    def __init__(self):
+        self._lock       = threading.Lock()
+        self._wake       = threading.Event()
+        self._stopped    = False
+        self._thread     = None
+        self._app        = None
+        self._proc       = None    # psutil.Process, created on the sampler thread
+        self._net_last   = None    # (counters, served total, time) of the previous sample
+        self._history    = deque(maxlen=HISTORY_LEN)
+        self._latest     = None
+        self._slow       = {'thumb_count': 0, 'thumb_size': 0, 'orphan_count': 0}
+        self._slow_due   = True
+        self._transfers  = None
+        self._samples    = 0
+        self._demand_at  = 0.0
+
+    def start(self, app):
+        if self._thread is not None:
+            return
+        self._app    = app
+        self._thread = threading.Thread(target=self._run, name='metrics-sampler', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=2.0):
+        if self._thread is None:
+            return
+        self._stopped = True
+        self._wake.set()
+        self._thread.join(timeout)
+
+    # ---------- Reads ----------
+
+    def latest(self):
+        """Most recent snapshot with the full network history, or None before the first sample."""
+        self._demand_at = time.time()
+        with self._lock:
+            if self._latest is None:
+                return None
+            snap = dict(self._latest)
+            snap['network'] = dict(snap['network'], history=list(self._history))
+            return snap
+
+    def refresh(self):
+        """Resample now, slow metrics included (after an ops action changed them)."""
+        self._slow_due = True
+        self._wake.set()
+
+    # ---------- Sampling ----------
+
+    def _run(self):
+        next_at = time.monotonic()
+        while not self._stopped:
+            try:
+                snap = self.sample()
+                if self._watchers():
+                    socketio.emit('dashboard_stats', snap, to=ADMIN_ROOM, ignore_queue=True)
+            except Exception:
+                logger.exception("Metrics sample failed")
+
+            # Fixed cadence: schedule off the previous deadline, not the end of this sample
+            next_at = max(next_at + SAMPLE_INTERVAL, time.monotonic())
+            self._wake.wait(next_at - time.monotonic())
+            if self._wake.is_set():
+                self._wake.clear()
+                next_at = time.monotonic()
+
+    def _watchers(self):
+        # Only sockets on this worker; the emit is local too (ignore_queue),
+        # so each worker's dashboards see that worker's process stats.
+        return next(socketio.server.manager.get_participants('/', ADMIN_ROOM), None) is not None
+
+    def sample(self):
+        """Build one snapshot, store it as the latest and return it (network carries only the new point)."""
+        import psutil   # here, not at import: keeps app startup light
+        now = time.time()
+        if self._proc is None:
+            self._proc = psutil.Process()
+
+        # --- LocalShare process stats (not system-wide) ---
+        # cpu_percent(interval=None) returns usage since the previous call,
+        # i.e. over one SAMPLE_INTERVAL. Divide by cpu_count() → % of total capacity.
+        cpu_norm  = round(self._proc.cpu_percent(interval=None) / psutil.cpu_count(), 1)
+        ram_proc  = self._proc.memory_info().rss
+        ram_total = psutil.virtual_memory().total
+        uptime    = now - self._proc.create_time()
+
+        # --- Network throughput (system-wide, rate since the previous sample) ---
+        # `served` is what LocalShare itself sent (transfer_stats), unlike the
+        # system-wide counters.
+        net_now, served_now = psutil.net_io_counters(), transfers.total
+        if self._net_last is None:
+            upload_bps = download_bps = served_bps = 0
+        else:
+            net_prev, served_prev, prev_time = self._net_last
+            net_dt       = max(now - prev_time, 0.001)
+            upload_bps   = max((net_now.bytes_sent - net_prev.bytes_sent) / net_dt, 0)
+            download_bps = max((net_now.bytes_recv - net_prev.bytes_recv) / net_dt, 0)
+            served_bps   = (served_now - served_prev) / net_dt
+        self._net_last = (net_now, served_now, now)
+        point = {'t': int(now), 'up': round(upload_bps), 'down': round(download_bps),
+                 'served': round(served_bps)}
+
+        # --- Storage: running totals kept by storage_stats (no directory walk) ---
+        from storage_stats import storage
+        upload_folder = self._app.config['UPLOAD_FOLDER']
+        library       = storage.snapshot()
+        try:
+            disk_info = psutil.disk_usage(upload_folder)
+            disk_total, disk_free, disk_percent = disk_info.total, disk_info.free, disk_info.percent
+        except OSError:
+            disk_total = disk_free = disk_percent = 0
+
+        # --- Active viewers, across every worker sharing the state backend ---
+        from routes.watch import rooms
+        room_map    = rooms.all_viewers(now)
+        viewer_list = []
+        for file_id, viewers in room_map.items():
+            for v in viewers:
+                viewer_list.append({
+                    'ip':      v['ip'].replace('::ffff:', ''),
+                    'file_id': file_id,
+                    'latency': round(v['latency'], 1),
+                    'device':  v['device'] or 'Unknown Device',
+                })
+
+        # --- Slow ops metrics ---
+        self._samples += 1
+        wanted = self._watchers() or now - self._demand_at < DEMAND_TIMEOUT
+        if self._slow_due or (wanted and self._samples % SLOW_EVERY == 0):
+            self._slow_due = False
+            self._slow = self._sample_slow(upload_folder)
+        if wanted or self._transfers is None:
+            self._transfers = self._sample_transfers(now)
+
+        # Last duplicate scan (runs in its own thread; this is just a dict copy)
+        from dedup import dedupe_job
+        import profiling
+        logs = recent_activity()
+
+        snap = {
+            'system': {
+                'cpu':       cpu_norm,
+                'ram_used':  ram_proc,
+                'ram_total': ram_total,
+                'uptime':    int(uptime),
+            },
+            'storage': {
+                'used_hr': human_readable_size(library['bytes']),
+                'files':   library['count'],
+                'ready':   library['ready'],
+                'folders': [dict(f, size_hr=human_readable_size(f['bytes']))
+                            for f in library['folders']],
+                'free_hr': human_readable_size(disk_free),
+                'total_hr': human_readable_size(disk_total),
+                'percent': disk_percent,
+            },
+            'network': {
+                'upload_bps':   point['up'],
+                'download_bps': point['down'],
+                'served_bps':   point['served'],
+                'sample':       point,
+            },
+            'transfers': self._transfers,
+            'ops': {
+                'thumb_count':   self._slow['thumb_count'],
+                'thumb_size_hr': human_readable_size(self._slow['thumb_size']),
+                'log_count':     len(logs),
+                'orphan_count':  self._slow['orphan_count'],
+                'room_count':    len(room_map),
+                'peer_count':    len(viewer_list),
+                'dedupe':        dict(dedupe_job),
+                'profile':       profiling.profiler.status(),
+                'tracing':       profiling.trace_status(),
+            },
+            'viewers': viewer_list,
+            'logs':    logs,
+            'slow':    profiling.slow_requests()[:SLOW_REQUESTS_SHOWN],
+            'sampled_at': now,
+        }
+        with self._lock:
+            self._history.append(point)
+            self._latest = snap
+        return snap
+
+    def _sample_transfers(self, now):
+        """Top files/clients/endpoints per window, with file ids resolved to names."""
+        from models import File
+
+        windows = {name: transfers.top(seconds, now=now) for name, seconds in WINDOWS.items()}
+        ids = {row['key'] for w in windows.values() for row in w['files']}
+        names = {}
+        if ids:
+            with self._app.app_context():
+                names = dict(File.query.with_entities(File.id, File.original_name)
+                             .filter(File.id.in_(ids)))
+        for w in windows.values():
+            for row in w['files']:
+                row['name'] = names.get(row['key'], f"#{row['key']}")
+        return windows
+
+    def _sample_slow(self, upload_folder):
+        from routes.files import THUMBNAIL_DIR
+        from models import File
+
+        # Thumbnail cache
+        thumb_count, thumb_size = 0, 0
+        try:
+            for entry in os.scandir(THUMBNAIL_DIR):
+                try:
+                    thumb_size += entry.stat().st_size
+                    thumb_count += 1
+                except OSError:
+                    pass
+        except OSError:
+            pass
+
+        # Orphan files — only meaningful in uploads (cleanup-enabled) mode
+        orphan_count = 0
+        if self._app.config.get('CLEANUP_ENABLED', False):
+            try:
+                with self._app.app_context():
+                    db_names = {name for (name,) in File.query.with_entities(File.stored_name)}
+                # Same rule as ops_clean_orphans: in-flight temp files are not orphans
+                disk_names   = {n for n in os.listdir(upload_folder) if not n.startswith(TEMP_PREFIXES)}
+                orphan_count = len(disk_names - db_names)
+            except Exception:
+                pass
+
+        return {'thumb_count': thumb_count, 'thumb_size': thumb_size, 'orphan_count': orphan_count}
+
+
+sampler = MetricsSampler()
@@ -8,10 +8,52 @@ class File(db.Model):
     stored_name   = db.Column(db.String(255), nullable=False)
     upload_time   = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     file_size     = db.Column(db.Integer, nullable=False)
+    content_hash  = db.Column(db.String(128), nullable=True, index=True)
+    last_accessed = db.Column(db.DateTime, nullable=True, index=True)
 
 
 class ChatMessage(db.Model):
     id         = db.Column(db.Integer, primary_key=True)
     sender_ip  = db.Column(db.String(45), nullable=False)
     content    = db.Column(db.Text, nullable=False)
-    timestamp  = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
\ No newline at end of file
+    timestamp  = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ActivityEvent(db.Model):
+    """Durable activity log (activity_log.py). Its own SQLite file, so history never contends with file writes."""
+    __bind_key__ = 'activity'
+
+    id     = db.Column(db.Integer, primary_key=True)
+    time   = db.Column(db.Integer, nullable=False, index=True)   # unix seconds
+    ip     = db.Column(db.String(45), nullable=False, index=True)
+    action = db.Column(db.String(64), nullable=False, index=True)
+    path   = db.Column(db.Text, nullable=False, index=True)
+    func   = db.Column(db.String(64), nullable=False)
+    result = db.Column(db.Text, nullable=False)
+
+
+# Columns added after the first release. db.create_all() never alters an
+# existing table, so older database.db files get them via ALTER TABLE.
+_ADDED_COLUMNS = {
+    'file': [
+        ('content_hash', 'VARCHAR(128)'),
+        ('last_accessed', 'DATETIME'),
+    ],
+}
+
+_ADDED_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS ix_file_content_hash ON file (content_hash)',
+    'CREATE INDEX IF NOT EXISTS ix_file_last_accessed ON file (last_accessed)',
+]
+
+
+def upgrade_schema():
+    """Must be called within an active Flask application context, after create_all()."""
+    with db.engine.begin() as conn:
+        for table, columns in _ADDED_COLUMNS.items():
+            existing = {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info({table})')}
+            for name, ddl in columns:
+                if name not in existing:
+                    conn.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {name} {ddl}')
+        for stmt in _ADDED_INDEXES:
+            conn.exec_driver_sql(stmt)
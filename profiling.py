@@ -0,0 +1,284 @@
+import os
+import sys
+import time
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+
+from flask import request
+
+import metrics
+from extensions import state
+
+logger = logging.getLogger(__name__)
+
+# ============================================================
+# PROFILING
+# Three admin tools, all per worker:
+#
+#  - Profile sessions: a stack sampler reads every thread's stack
+#    (sys._current_frames) every PROFILE_INTERVAL for N seconds. The
+#    result is a folded-stacks file ("a;b;c 42" per line) that
+#    flamegraph.pl or speedscope.app open directly. Sampling costs
+#    nothing between samples, so this is safe on a busy server.
+#
+#  - Slow requests: a watchdog samples the stack of any request running
+#    longer than half the threshold. When a request ends over SLOW_REQUEST_MS,
+#    its time split (DB, subprocess, the rest), audited filesystem calls
+#    and hottest stacks go into a capped list in the state store.
+#
+#  - tracemalloc: start tracing, then take snapshots. Each reports the
+#    allocation sites that grew most since the previous snapshot and
+#    since the first, to chase RSS growth seen on the dashboard.
+# ============================================================
+
+PROFILE_INTERVAL    = 0.005   # seconds between stack samples
+PROFILE_MAX_SECONDS = 300
+WATCHDOG_TICK       = 0.05
+SLOW_KEY            = 'slow_requests'
+SLOW_KEEP           = 50
+SLOW_TOP_STACKS     = 5
+TRACE_FRAMES        = 25
+TRACE_TOP           = 25
+
+# Audit events counted as filesystem calls (os.stat and friends are not audited)
+FS_EVENTS = {
+    'open', 'os.listdir', 'os.scandir', 'os.remove', 'os.rename', 'os.mkdir',
+    'os.rmdir', 'os.link', 'os.symlink', 'os.truncate', 'os.utime', 'os.chmod',
+    'shutil.copyfile', 'shutil.copytree', 'shutil.move', 'shutil.rmtree',
+}
+
+_SKIP_FILES = (os.sep + 'threading.py', os.sep + 'socketserver.py')
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+def fold_stack(frame):
+    """'outer;…;inner:line' — root first, as flamegraph tools expect."""
+    leaf   = f'{_frame_label(frame)}:{frame.f_lineno}'
+    labels = [leaf]
+    frame  = frame.f_back
+    while frame is not None:
+        if not frame.f_code.co_filename.endswith(_SKIP_FILES):
+            labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+# ============================================================
+# PROFILE SESSIONS
+# ============================================================
+
+class StackProfiler:
+    def __init__(self):
+        self._lock    = threading.Lock()
+        self._thread  = None
+        self._stacks  = Counter()
+        self._status  = {'running': False, 'started': None, 'seconds': 0, 'samples': 0}
+
+    def start(self, seconds):
+        seconds = max(1, min(int(seconds), PROFILE_MAX_SECONDS))
+        with self._lock:
+            if self._status['running']:
+                return False
+            self._stacks = Counter()
+            self._status = {'running': True, 'started': int(time.time()),
+                            'seconds': seconds, 'samples': 0}
+            self._thread = threading.Thread(target=self._run, args=(seconds,),
+                                            name='stack-profiler', daemon=True)
+            self._thread.start()
+        return True
+
+    def status(self):
+        with self._lock:
+            return dict(self._status, stacks=len(self._stacks))
+
+    def folded(self):
+        """The last session's samples, heaviest stacks first."""
+        with self._lock:
+            return ''.join(f'{stack} {n}\n' for stack, n in self._stacks.most_common())
+
+    def _run(self, seconds):
+        me       = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        samples  = 0
+        while time.monotonic() < deadline:
+            frames = sys._current_frames()
+            folded = [fold_stack(f) for tid, f in frames.items() if tid != me]
+            with self._lock:
+                self._stacks.update(folded)
+            samples += 1
+            time.sleep(PROFILE_INTERVAL)
+        with self._lock:
+            self._status.update(running=False, samples=samples)
+        logger.info(f"Profile session finished: {samples} samples over {seconds}s")
+
+
+profiler = StackProfiler()
+
+
+# ============================================================
+# SLOW REQUESTS
+# ============================================================
+
+_inflight      = {}   # thread id → {'started', 'fs_ops', 'stacks'}
+_inflight_lock = threading.Lock()
+_threshold     = 0.0
+_watchdog      = None
+
+
+def _audit(event, args):
+    if event in FS_EVENTS:
+        record = _inflight.get(threading.get_ident())
+        if record is not None:
+            record['fs_ops'] += 1
+
+
+def _watch():
+    while True:
+        time.sleep(WATCHDOG_TICK)
+        cutoff = time.perf_counter() - _threshold / 2
+        with _inflight_lock:
+            slow = [(tid, r) for tid, r in _inflight.items() if r['started'] < cutoff]
+        if not slow:
+            continue
+        frames = sys._current_frames()
+        with _inflight_lock:
+            for tid, record in slow:
+                frame = frames.get(tid)
+                if frame is not None:
+                    record['stacks'][fold_stack(frame)] += 1
+
+
+def _before_request():
+    record = {'started': time.perf_counter(), 'fs_ops': 0, 'stacks': Counter()}
+    with _inflight_lock:
+        _inflight[threading.get_ident()] = record
+
+
+def _after_request(response):
+    with _inflight_lock:
+        record = _inflight.pop(threading.get_ident(), None)
+    timing = metrics.request_breakdown()
+    if record is None or timing is None or timing['seconds'] < _threshold:
+        return response
+
+    db, sub = timing['db_seconds'], timing['subprocess_seconds']
+    state.lpush_capped(SLOW_KEY, {
+        'time':          int(time.time()),
+        'method':        request.method,
+        'path':          request.full_path.rstrip('?'),
+        'endpoint':      request.endpoint or 'unmatched',
+        'status':        response.status_code,
+        'ms':            round(timing['seconds'] * 1000, 1),
+        'db_ms':         round(db * 1000, 1),
+        'db_queries':    timing['queries'],
+        'subprocess_ms': round(sub * 1000, 1),
+        'other_ms':      round(max(timing['seconds'] - db - sub, 0) * 1000, 1),
+        'fs_ops':        record['fs_ops'],
+        'stacks':        [{'stack': s, 'samples': n}
+                          for s, n in record['stacks'].most_common(SLOW_TOP_STACKS)],
+        'sample_ms':     WATCHDOG_TICK * 1000,
+    }, SLOW_KEEP)
+    return response
+
+
+def _teardown_request(exc):
+    with _inflight_lock:
+        _inflight.pop(threading.get_ident(), None)
+
+
+def slow_requests():
+    """Captured slow requests, newest first."""
+    return state.lrange(SLOW_KEY)
+
+
+def clear_slow_requests():
+    state.delete(SLOW_KEY)
+
+
+def init_app(app):
+    """Install slow-request capture if SLOW_REQUEST_MS > 0 (timings come from metrics)."""
+    global _threshold, _watchdog
+    threshold_ms = app.config.get('SLOW_REQUEST_MS', 0)
+    if not threshold_ms or _watchdog is not None:
+        return
+    _threshold = threshold_ms / 1000
+    sys.addaudithook(_audit)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    _watchdog = threading.Thread(target=_watch, name='slow-request-watchdog', daemon=True)
+    _watchdog.start()
+
+
+# ============================================================
+# TRACEMALLOC
+# ============================================================
+
+# Only the baseline (first) and the latest snapshot are kept; snapshots are large
+_trace      = {'baseline': None, 'previous': None, 'taken': []}
+_trace_lock = threading.Lock()
+
+
+def _stat_dict(stat):
+    frame = stat.traceback[0]
+    return {
+        'where':      f'{frame.filename}:{frame.lineno}',
+        'size':       stat.size,
+        'size_diff':  getattr(stat, 'size_diff', stat.size),
+        'count':      stat.count,
+        'count_diff': getattr(stat, 'count_diff', stat.count),
+    }
+
+
+def trace_status():
+    with _trace_lock:
+        taken = list(_trace['taken'])
+    current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+    return {'tracing': tracemalloc.is_tracing(), 'snapshots': taken,
+            'traced': current, 'peak': peak}
+
+
+def trace_start():
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACE_FRAMES)
+    return trace_status()
+
+
+def trace_stop():
+    tracemalloc.stop()
+    with _trace_lock:
+        _trace.update(baseline=None, previous=None, taken=[])
+    return trace_status()
+
+
+def trace_snapshot():
+    """
+    Snapshot traced allocations. Returns the top growth since the previous
+    snapshot and since the baseline (the first one), by source line.
+    Starts tracing first if needed; the first snapshot is only a baseline.
+    """
+    trace_start()
+    snap = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    with _trace_lock:
+        previous, baseline = _trace['previous'], _trace['baseline']
+        _trace['previous'] = snap
+        _trace['baseline'] = baseline or snap
+        _trace['taken'].append(int(time.time()))
+
+    report = {**trace_status(),
+              'top': [_stat_dict(s) for s in snap.statistics('lineno')[:TRACE_TOP]]}
+    if previous is not None:
+        report['since_previous'] = [_stat_dict(s) for s in
+                                    snap.compare_to(previous, 'lineno')[:TRACE_TOP]]
+        report['since_baseline'] = [_stat_dict(s) for s in
+                                    snap.compare_to(baseline, 'lineno')[:TRACE_TOP]]
+    return report
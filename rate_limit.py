@@ -0,0 +1,114 @@
+import math
+import time
+import functools
+import threading
+from collections import OrderedDict
+
+from flask import request, jsonify
+
+# ============================================================
+# TOKEN-BUCKET RATE LIMITING
+# One bucket per (limiter, key): `burst` tokens, refilled at `rate` per
+# second, one token per request. A check is O(1) under a lock held for a
+# few dict operations.
+#
+# Expiry needs no sweeper. A bucket left idle for burst/rate seconds is
+# full again, so it is the same as having no entry at all. Locally,
+# buckets sit in an LRU capped at MAX_KEYS, and a flood of new keys only
+# evicts the quietest ones. With a shared STATE_BACKEND the buckets live
+# in the store as TTL keys, so every worker enforces the same limit.
+# ============================================================
+
+MAX_KEYS = 10_000   # per limiter, local mode
+
+
+class TokenBucket:
+    def __init__(self, name, rate, burst, max_keys=MAX_KEYS):
+        """`rate` tokens per second, up to `burst` banked."""
+        self.name     = name
+        self.rate     = float(rate)
+        self.burst    = float(burst)
+        self.max_keys = max_keys
+        self._lock    = threading.Lock()
+        self._buckets = OrderedDict()   # key → [tokens, last_refill]; LRU order
+
+    def take(self, key, now=None):
+        """Spend a token. Returns 0.0 if allowed, else seconds until one is available."""
+        from extensions import state
+        if state.shared:
+            return state.take_token(f'rl:{self.name}:{key}', self.rate, self.burst)
+
+        now = now or time.time()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.rate
+
+    def reset(self, key):
+        """Forget `key`'s bucket, so its next request starts from a full burst."""
+        from extensions import state
+        if state.shared:
+            state.delete(f'rl:{self.name}:{key}')
+            return
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def _client_ip():
+    return request.remote_addr or 'unknown'
+
+
+def _too_many(wait):
+    resp = jsonify({'status': 'rate_limited', 'retry_after': round(wait, 2)})
+    resp.status_code = 429
+    resp.headers['Retry-After'] = str(math.ceil(wait))
+    return resp
+
+
+# ---------- Decorators ----------
+
+def limit_route(bucket, key=_client_ip, methods=None, on_limit=_too_many):
+    """
+    Rate-limit a Flask view. `key()` is called inside the request; only
+    `methods` (default: all) spend tokens. `on_limit(wait)` builds the
+    response for a rejected request — JSON 429 with Retry-After by default.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(*args, **kwargs):
+            if methods is None or request.method in methods:
+                wait = bucket.take(key())
+                if wait:
+                    return on_limit(wait)
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def limit_event(bucket, key=lambda data: _client_ip(),
+                on_limit=lambda wait: {'status': 'rate_limited', 'retry_after': round(wait, 2)}):
+    """Rate-limit a Socket.IO handler. `key(data)` sees the event payload; a
+    rejected event returns `on_limit(wait)` as its ack."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapped(data=None, *args):
+            wait = bucket.take(key(data))
+            if wait:
+                return on_limit(wait)
+            return handler(data, *args)
+        return wrapped
+    return decorator
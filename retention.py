@@ -0,0 +1,239 @@
+import os
+import threading
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# ============================================================
+# RETENTION ENGINE
+# Policies: max age (by upload time), a total byte quota enforced by
+# evicting least-recently-accessed files first, and per-folder overrides
+# keyed by path prefix. Deletions run in bounded batches, each its own
+# short job on the DB writer (sqlite_store.py), so the SQLite write lock
+# is never held for the whole sweep.
+# ============================================================
+
+BATCH_SIZE = 200
+
+
+# ---------- Access tracking ----------
+# Stream/download requests only touch this dict; the timestamps are written
+# to File.last_accessed in one batch by flush_access_times(). A range-request
+# heavy video would otherwise cost a DB write per chunk request.
+
+_pending_access: dict[int, datetime] = {}
+_access_lock = threading.Lock()
+
+
+def record_access(file_id: int) -> None:
+    with _access_lock:
+        _pending_access[file_id] = datetime.utcnow()
+
+
+def flush_access_times() -> int:
+    """Must be called within an active Flask application context."""
+    from sqlite_store import writer
+
+    global _pending_access
+    with _access_lock:
+        pending, _pending_access = _pending_access, {}
+
+    if not pending:
+        return 0
+
+    writer.run(_write_access_times, pending)
+    return len(pending)
+
+
+def _write_access_times(pending):
+    """DB writer job."""
+    from sqlalchemy import update, bindparam
+    from extensions import db
+    from models import File
+
+    # Core UPDATE … WHERE id = ?, executemany: ids deleted since they were
+    # recorded match no row, where the ORM bulk-by-primary-key form raises
+    table = File.__table__
+    db.session.execute(update(table)
+                       .where(table.c.id == bindparam('fid'))
+                       .values(last_accessed=bindparam('ts')),
+                       [{'fid': fid, 'ts': ts} for fid, ts in pending.items()])
+
+
+# ---------- Policy ----------
+
+class RetentionPolicy:
+    __slots__ = ('max_age', 'quota_exempt')
+
+    def __init__(self, max_age_hours=None, quota_exempt=False):
+        self.max_age      = timedelta(hours=max_age_hours) if max_age_hours else None
+        self.quota_exempt = quota_exempt
+
+
+def load_policies(config):
+    """
+    Build (default_policy, [(prefix, policy), …]) from app config.
+    Folder overrides are matched longest-prefix-first against stored_name.
+    """
+    default = RetentionPolicy(config.get('RETENTION_MAX_AGE_HOURS'))
+    folders = []
+    for prefix, opts in (config.get('RETENTION_FOLDERS') or {}).items():
+        prefix = prefix.strip('/').replace('\\', '/')
+        folders.append((prefix + '/', RetentionPolicy(
+            opts.get('max_age_hours', config.get('RETENTION_MAX_AGE_HOURS')),
+            opts.get('quota_exempt', False),
+        )))
+    folders.sort(key=lambda item: len(item[0]), reverse=True)
+    return default, folders
+
+
+def _policy_for(stored_name, default, folders):
+    for prefix, policy in folders:
+        if stored_name.startswith(prefix):
+            return policy
+    return default
+
+
+def _quota_size(default, folders):
+    """SQL expression for File.file_size, or 0 for files under a quota-exempt policy."""
+    from sqlalchemy import case
+    from models import File
+
+    # Longest prefix first, as in _policy_for
+    whens = [(File.stored_name.startswith(prefix, autoescape=True),
+              0 if policy.quota_exempt else File.file_size)
+             for prefix, policy in folders]
+    otherwise = 0 if default.quota_exempt else File.file_size
+    return case(*whens, else_=otherwise) if whens else otherwise
+
+
+# ---------- Engine ----------
+
+def _evict(rows, upload_folder, reason, dry_run, report):
+    """Unlink one batch of (id, stored_name, size) and drop their rows in one short commit."""
+    from sqlite_store import writer
+    from storage_stats import storage
+    from browse_cache import cache as browse_cache, folder_of
+
+    ids = []
+    for fid, stored_name, size in rows:
+        logger.info(f"Retention{' (dry run)' if dry_run else ''}: evict {stored_name} "
+                    f"[{reason}, {size} bytes]")
+        report['evicted'].append({'path': stored_name, 'size': size, 'reason': reason})
+        report['freed'] += size
+        ids.append(fid)
+        if dry_run:
+            continue
+        path = os.path.join(upload_folder, stored_name)
+        try:
+            on_disk = os.path.getsize(path)
+            os.remove(path)
+            storage.file_removed(stored_name, on_disk)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Retention: could not remove {stored_name}: {e}")
+
+    if not dry_run and ids:
+        writer.run(_delete_rows, ids)
+        browse_cache.invalidate(*{folder_of(stored_name) for _, stored_name, _ in rows})
+
+
+def _delete_rows(ids):
+    """DB writer job."""
+    from models import File
+    File.query.filter(File.id.in_(ids)).delete(synchronize_session=False)
+
+
+def run_retention(dry_run=None):
+    """
+    Apply the configured retention policies to the File catalog.
+    Must be called within an active Flask application context.
+    Returns a report dict: {'dry_run', 'evicted': [...], 'freed'}.
+    """
+    from flask import current_app
+    from sqlalchemy import func
+    from extensions import db
+    from models import File
+
+    config        = current_app.config
+    upload_folder = config.get('UPLOAD_FOLDER', 'uploads')
+    dry_run       = config.get('RETENTION_DRY_RUN', False) if dry_run is None else dry_run
+    report        = {'dry_run': dry_run, 'evicted': [], 'freed': 0}
+
+    flush_access_times()
+
+    default, folders = load_policies(config)
+    now     = datetime.utcnow()
+    evicted = set()
+
+    # --- Pass 1: max age — keyset-paged over the catalog by id ---
+    min_age = [p.max_age for p in [default] + [p for _, p in folders] if p.max_age]
+    if min_age:
+        oldest_allowed = now - min(min_age)
+        last_id, batch = 0, []
+        while True:
+            page = (File.query
+                    .with_entities(File.id, File.stored_name, File.file_size, File.upload_time)
+                    .filter(File.id > last_id, File.upload_time < oldest_allowed)
+                    .order_by(File.id)
+                    .limit(BATCH_SIZE)
+                    .all())
+            if not page:
+                break
+            last_id = page[-1].id
+            for row in page:
+                policy = _policy_for(row.stored_name, default, folders)
+                if policy.max_age and row.upload_time < now - policy.max_age:
+                    batch.append((row.id, row.stored_name, row.file_size))
+            if len(batch) >= BATCH_SIZE:
+                _evict(batch, upload_folder, 'age', dry_run, report)
+                evicted.update(fid for fid, _, _ in batch)
+                batch = []
+        if batch:
+            _evict(batch, upload_folder, 'age', dry_run, report)
+            evicted.update(fid for fid, _, _ in batch)
+
+    # --- Pass 2: byte quota — evict least-recently-accessed first ---
+    # Hardlinked duplicates each count at full size here, so the quota is
+    # conservative: it may evict slightly more than strictly necessary.
+    max_bytes = config.get('RETENTION_MAX_BYTES')
+    if max_bytes:
+        # Usage counts only the files the quota can evict
+        total = db.session.query(func.coalesce(func.sum(_quota_size(default, folders)), 0)).scalar()
+        if dry_run:
+            # Age-pass rows are still in the table
+            total -= sum(e['size'] for e in report['evicted']
+                         if not _policy_for(e['path'], default, folders).quota_exempt)
+        last_used = func.coalesce(File.last_accessed, File.upload_time)
+        offset    = 0
+
+        while total > max_bytes:
+            page = (File.query
+                    .with_entities(File.id, File.stored_name, File.file_size)
+                    .order_by(last_used, File.id)
+                    .offset(offset)
+                    .limit(BATCH_SIZE)
+                    .all())
+            if not page:
+                break
+            batch = []
+            for row in page:
+                if total <= max_bytes:
+                    break
+                if row.id in evicted:
+                    continue
+                if _policy_for(row.stored_name, default, folders).quota_exempt:
+                    continue
+                batch.append((row.id, row.stored_name, row.file_size))
+                total -= row.file_size
+            _evict(batch, upload_folder, 'quota', dry_run, report)
+            evicted.update(fid for fid, _, _ in batch)
+            # Deleted rows drop out of the ordering; kept rows must be skipped
+            offset += len(page) - (0 if dry_run else len(batch))
+
+    if report['evicted']:
+        logger.info(f"Retention{' (dry run)' if dry_run else ''}: "
+                    f"{len(report['evicted'])} files, {report['freed']} bytes")
+    return report
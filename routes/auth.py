@@ -1,32 +1,27 @@
 import hmac
-import time
-from collections import defaultdict
 
 from flask import (Blueprint, render_template, request,
                    redirect, url_for, session, current_app)
 
 from utils import is_admin, log_activity
+from rate_limit import TokenBucket, limit_route
 
 auth_bp = Blueprint('auth', __name__)
 
 # ============================================================
-# RATE LIMITER  (in-memory, per-IP)
+# RATE LIMITER  (per-IP: 10 failed logins, refilled over 5 minutes)
+# Every POST spends a token before the password is checked, so a locked
+# out client never reaches the comparison; a successful login resets the
+# bucket, so only failures accumulate.
 # ============================================================
 
-_login_attempts: dict[str, list[float]] = defaultdict(list)
-_LOGIN_MAX = 10
-_LOGIN_WIN = 300   # 5 minutes
+LOGIN_ATTEMPTS = TokenBucket('login', rate=10 / 300, burst=10)
 
 
-def _is_rate_limited(ip: str) -> bool:
-    now  = time.time()
-    hits = [t for t in _login_attempts[ip] if now - t < _LOGIN_WIN]
-    _login_attempts[ip] = hits
-    return len(hits) >= _LOGIN_MAX
-
-
-def _record_attempt(ip: str) -> None:
-    _login_attempts[ip].append(time.time())
+def _login_limited(wait):
+    log_activity(request.remote_addr, 'Login', '/login', 'login', 'Rate limited')
+    return render_template('login.html',
+                           error=f'Too many attempts — try again in {int(wait // 60) + 1} min.'), 429
 
 
 # ============================================================
@@ -34,6 +29,7 @@ def _record_attempt(ip: str) -> None:
 # ============================================================
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
+@limit_route(LOGIN_ATTEMPTS, methods=('POST',), on_limit=_login_limited)
 def login():
     if is_admin():
         return redirect(url_for('files.browse'))
@@ -44,20 +40,16 @@ def login():
         ip             = request.remote_addr
         admin_password = current_app.config['ADMIN_PASSWORD']
 
-        if _is_rate_limited(ip):
-            error = 'Too many failed attempts — try again in 5 minutes.'
-            log_activity(ip, 'Login', '/login', 'login', 'Rate limited')
+        password = request.form.get('password', '')
+        if hmac.compare_digest(password, admin_password):
+            session.permanent   = True
+            session['is_admin'] = True
+            LOGIN_ATTEMPTS.reset(ip or 'unknown')
+            log_activity(ip, 'Login', '/login', 'login', 'Success')
+            return redirect(url_for('files.browse'))
         else:
-            password = request.form.get('password', '')
-            if hmac.compare_digest(password, admin_password):
-                session.permanent   = True
-                session['is_admin'] = True
-                log_activity(ip, 'Login', '/login', 'login', 'Success')
-                return redirect(url_for('files.browse'))
-            else:
-                _record_attempt(ip)
-                error = 'Incorrect password.'
-                log_activity(ip, 'Login', '/login', 'login', 'Failed')
+            error = 'Incorrect password.'
+            log_activity(ip, 'Login', '/login', 'login', 'Failed')
 
     return render_template('login.html', error=error)
 
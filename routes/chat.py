@@ -1,10 +1,220 @@
+import queue
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+
 from flask import Blueprint, render_template, request
+from flask_socketio import join_room, emit
 
-from extensions import db
+from extensions import db, socketio, state
 from models import ChatMessage
+from rate_limit import TokenBucket, limit_route
+from sqlite_store import writer
+
+logger = logging.getLogger(__name__)
 
 chat_bp = Blueprint('chat', __name__)
 
+CHAT_ROOM = 'chat'
+
+# Per-IP: one message a second, bursts of 5
+CHAT_SENDS = TokenBucket('chat_send', rate=1, burst=5)
+
+# Hard cap on any history response, HTTP or socket backfill
+PAGE_DEFAULT = 50
+PAGE_LIMIT   = 100
+
+# --- Recent-message ring ---
+# Newest RING_SIZE messages, primed from the DB on first use. Joining tabs
+# are backfilled from here without a query; only a client that has been
+# away longer than the ring covers falls through to the DB. Every worker
+# keeps its own ring, fed from the state store's pub/sub so it also sees
+# messages committed by other workers.
+CHAT_COMMITTED = 'chat:committed'
+CHAT_RESET     = 'chat:reset'
+
+RING_SIZE   = 200
+_ring       = deque(maxlen=RING_SIZE)
+_ring_lock  = threading.Lock()
+_ring_ready = False
+
+
+def _serialize(m):
+    return {
+        'id': m.id,
+        'sender': f'{m.sender_ip}:',
+        'content': m.content,
+        'timestamp': m.timestamp.isoformat(),
+    }
+
+
+def _prime_ring():
+    """Load the newest messages into the ring once. Caller holds _ring_lock."""
+    global _ring_ready
+    if _ring_ready:
+        return
+    newest = (ChatMessage.query
+              .order_by(ChatMessage.id.desc())
+              .limit(RING_SIZE)
+              .all())
+    _ring.extend(_serialize(m) for m in reversed(newest))
+    _ring_ready = True
+
+
+def _on_committed(payloads):
+    with _ring_lock:
+        # A concurrent _prime_ring() may already have loaded these rows
+        if not _ring_ready:
+            return
+        last, late = (_ring[-1]['id'] if _ring else 0), []
+        for p in payloads:
+            if p['id'] > last:
+                _ring.append(p)
+                last = p['id']
+            else:
+                late.append(p)
+        if late:
+            # Another worker's batch committed first but was delivered after ours
+            known  = {m['id'] for m in _ring}
+            oldest = _ring[0]['id']
+            merged = sorted(list(_ring) + [p for p in late
+                                           if p['id'] not in known and p['id'] > oldest],
+                            key=lambda m: m['id'])
+            _ring.clear()
+            _ring.extend(merged)
+
+
+def _on_reset(_):
+    global _ring_ready
+    with _ring_lock:
+        _ring.clear()
+        _ring_ready = False
+
+
+state.subscribe(CHAT_COMMITTED, _on_committed)
+state.subscribe(CHAT_RESET, _on_reset)
+
+
+# ============================================================
+# WRITE-BEHIND PERSISTENCE
+# chat_send only enqueues. One writer thread drains the queue, commits up
+# to BATCH_MAX messages per transaction, then pushes the committed rows
+# (now with ids) to every worker's ring and out to the chat room. A watch-party
+# burst becomes a handful of short commits instead of one per message.
+# ============================================================
+
+BATCH_MAX      = 64
+BATCH_WINDOW_S = 0.05   # how long to wait for more messages after the first
+
+
+def _insert_messages(batch):
+    """DB writer job: insert one batch, return the rows serialized (ids assigned by the flush)."""
+    rows = [ChatMessage(sender_ip=ip, content=text, timestamp=ts) for ip, text, ts in batch]
+    db.session.add_all(rows)
+    db.session.flush()
+    return [_serialize(r) for r in rows]
+
+
+class ChatWriter:
+    def __init__(self):
+        self._queue  = queue.Queue()
+        self._app    = None
+        self._thread = None
+
+    def start(self, app):
+        if self._thread is not None:
+            return
+        self._app    = app
+        self._thread = threading.Thread(target=self._run, name='chat-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, sender_ip, content):
+        self._queue.put((sender_ip, content, datetime.utcnow()))
+
+    def stop(self, timeout=2.0):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            try:
+                while len(batch) < BATCH_MAX:
+                    nxt = self._queue.get(timeout=BATCH_WINDOW_S)
+                    if nxt is None:
+                        self._flush(batch)
+                        return
+                    batch.append(nxt)
+            except queue.Empty:
+                pass
+            self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            payloads = writer.run(_insert_messages, batch)
+        except Exception:
+            logger.exception(f"Chat writer: failed to persist {len(batch)} messages")
+            return
+
+        state.publish(CHAT_COMMITTED, payloads)
+
+        for payload in payloads:
+            socketio.emit('chat_message', payload, room=CHAT_ROOM)
+
+
+chat_writer = ChatWriter()
+chat_bp.record_once(lambda state: chat_writer.start(state.app))
+
+
+# ============================================================
+# HISTORY  — keyset pagination, never unbounded
+# ============================================================
+
+def _clamp_limit(limit):
+    return max(1, min(limit or PAGE_DEFAULT, PAGE_LIMIT))
+
+
+def _newest(limit, before_id=None):
+    """Newest `limit` messages (older than before_id if given), oldest-first."""
+    if before_id is None:
+        # limit <= PAGE_LIMIT < RING_SIZE, so the ring always holds the newest page
+        with _ring_lock:
+            _prime_ring()
+            return list(_ring)[-limit:], len(_ring) > limit
+
+    rows = (ChatMessage.query
+            .filter(ChatMessage.id < before_id)
+            .order_by(ChatMessage.id.desc())
+            .limit(limit + 1)
+            .all())
+    return [_serialize(m) for m in reversed(rows[:limit])], len(rows) > limit
+
+
+def _since(since_id, limit):
+    """Up to `limit` messages newer than since_id, oldest-first."""
+    with _ring_lock:
+        _prime_ring()
+        # The ring is complete for anything newer than the message just
+        # before its oldest entry; older cursors need the DB.
+        if not _ring or len(_ring) < RING_SIZE or since_id >= _ring[0]['id'] - 1:
+            newer = [m for m in _ring if m['id'] > since_id]
+            return newer[:limit], len(newer) > limit
+
+    rows = (ChatMessage.query
+            .filter(ChatMessage.id > since_id)
+            .order_by(ChatMessage.id.asc())
+            .limit(limit + 1)
+            .all())
+    return [_serialize(m) for m in rows[:limit]], len(rows) > limit
+
 
 @chat_bp.route('/chat')
 def chat():
@@ -12,6 +222,7 @@ def chat():
 
 
 @chat_bp.route('/chat/send', methods=['POST'])
+@limit_route(CHAT_SENDS)
 def chat_send():
     data = request.get_json()
     if not data or not data.get('message'):
@@ -21,31 +232,47 @@ def chat_send():
     if not msg:
         return {'status': 'ok'}
 
-    db.session.add(ChatMessage(
-        sender_ip=request.remote_addr or 'unknown',
-        content=msg,
-    ))
-    db.session.commit()
+    chat_writer.submit(request.remote_addr or 'unknown', msg)
     return {'status': 'ok'}
 
 
 @chat_bp.route('/chat/messages')
 def chat_messages():
-    since_id = request.args.get('since', type=int, default=0)
-    messages = (
-        ChatMessage.query
-        .filter(ChatMessage.id > since_id)
-        .order_by(ChatMessage.id.asc())
-        .all()
-    )
-    return {
-        'messages': [
-            {
-                'id': m.id,
-                'sender': f'{m.sender_ip}:',
-                'content': m.content,
-                'timestamp': m.timestamp.isoformat(),
-            }
-            for m in messages
-        ]
-    }
\ No newline at end of file
+    """
+    ?before=<id>  → the page of older messages just before that id (scrollback)
+    ?since=<id>   → messages newer than that id (polling fallback)
+    neither       → the newest page
+    Every response is capped at PAGE_LIMIT; has_more says whether to ask again.
+    """
+    limit     = _clamp_limit(request.args.get('limit', type=int))
+    before_id = request.args.get('before', type=int)
+    since_id  = request.args.get('since', type=int, default=0)
+
+    if before_id is not None:
+        messages, has_more = _newest(limit, before_id)
+    elif since_id > 0:
+        messages, has_more = _since(since_id, limit)
+    else:
+        messages, has_more = _newest(limit)
+
+    return {'messages': messages, 'has_more': has_more}
+
+
+@socketio.on('join_chat')
+def join_chat(data):
+    since_id = (data or {}).get('since', 0)
+    if not isinstance(since_id, int):
+        since_id = 0
+
+    join_room(CHAT_ROOM)
+    if since_id > 0:
+        messages, has_more = _since(since_id, PAGE_LIMIT)
+    else:
+        messages, has_more = _newest(PAGE_DEFAULT)
+    emit('chat_backfill', {'messages': messages, 'has_more': has_more,
+                           'initial': since_id == 0})
+
+
+def reset_chat_ring():
+    """Drop every worker's ring so it re-primes from the DB (after bulk deletes)."""
+    state.publish(CHAT_RESET, None)
@@ -1,26 +1,24 @@
 import os
-import time
-import psutil
-from collections import deque
 
-from flask import Blueprint, render_template, jsonify, make_response, current_app, request
+from flask import (Blueprint, render_template, jsonify, make_response, current_app, request,
+                   Response)
+from flask_socketio import join_room
 
-from utils import admin_required, human_readable_size, activity_log, log_activity
-from routes.watch import viewers_data, viewers_lock, watch_sessions, watch_lock
+from extensions import socketio
+from utils import (admin_required, is_admin, human_readable_size, log_activity,
+                   recent_activity, clear_activity)
+from routes.watch import rooms
+from storage_stats import storage
+from upload_stream import TEMP_PREFIXES
+from metrics_sampler import sampler, ADMIN_ROOM
+from activity_log import (activity_writer, query_activity, activity_actions,
+                          PAGE_DEFAULT, PAGE_LIMIT, DUMP_LIMIT)
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
-# Grab handle to current process once at startup — avoids repeated PID lookups
-_proc = psutil.Process()
-
-# --- Network throughput tracking ---
-# psutil.net_io_counters() returns cumulative byte counters, so we diff
-# against the previous poll to get an instantaneous rate. System-wide
-# (not per-process) since there's no reliable per-process network
-# counter cross-platform.
-_net_last_counters = psutil.net_io_counters()
-_net_last_time     = time.time()
-_net_history        = deque(maxlen=30)   # ~2.5 min of samples at 4s poll interval
+# Stats are computed by one background sampler per worker (metrics_sampler.py)
+dashboard_bp.record_once(lambda state: sampler.start(state.app))
+dashboard_bp.record_once(lambda state: activity_writer.start(state.app))
 
 
 @dashboard_bp.route('/dashboard')
@@ -32,148 +30,78 @@ def dashboard():
 @dashboard_bp.route('/api/stats')
 @admin_required
 def api_stats():
+    """Latest sampler snapshot — the fallback for dashboards without a socket."""
+    snap = sampler.latest()
+    if snap is None:   # first sample not taken yet
+        return jsonify({'status': 'starting'}), 503
+    return jsonify(snap)
 
-    # --- LocalShare process stats (not system-wide) ---
-    # cpu_percent(interval=None) is non-blocking; returns usage since last call.
-    # Divide by cpu_count() to normalise across cores → 0-100 % of total capacity.
-    cpu_raw   = _proc.cpu_percent(interval=None)
-    cpu_norm  = round(cpu_raw / psutil.cpu_count(), 1)
-
-    # RSS = physical RAM pages actually mapped by this process
-    ram_proc  = _proc.memory_info().rss
-    ram_total = psutil.virtual_memory().total   # system total for context/bar
-
-
-    uptime = time.time() - _proc.create_time()
-
-    # --- Storage: walk UPLOAD_FOLDER ---
-    upload_folder = current_app.config['UPLOAD_FOLDER']
-    total_size    = 0
-    file_count    = 0
-    for dirpath, _, filenames in os.walk(upload_folder):
-        for fname in filenames:
-            try:
-                total_size += os.path.getsize(os.path.join(dirpath, fname))
-                file_count += 1
-            except OSError:
-                pass
 
-    # --- Get hard drive storage metrics for the drive containing uploads
-    try:
-        disk_info = psutil.disk_usage(upload_folder)
-        disk_total = disk_info.total
-        disk_free = disk_info.free
-        disk_percent = disk_info.percent
-    except OSError:
-        disk_total = disk_free = disk_percent = 0
-
-    # --- Network throughput (system-wide, rate since last poll) ---
-    global _net_last_counters, _net_last_time
-
-    net_now      = psutil.net_io_counters()
-    net_now_time = time.time()
-    net_dt       = max(net_now_time - _net_last_time, 0.001)
-
-    upload_bps   = max((net_now.bytes_sent - _net_last_counters.bytes_sent) / net_dt, 0)
-    download_bps = max((net_now.bytes_recv - _net_last_counters.bytes_recv) / net_dt, 0)
-
-    _net_last_counters = net_now
-    _net_last_time     = net_now_time
-
-    _net_history.append({
-        't':    int(net_now_time),
-        'up':   round(upload_bps),
-        'down': round(download_bps),
-    })
-
-    # --- Active viewers (last seen within 30 s) ---
-    now         = time.time()
-    viewer_list = []
-    with viewers_lock:
-        for file_id, viewers in viewers_data.items():
-            for ip, info in viewers.items():
-                if now - info.get('last_seen', 0) < 30:
-                    viewer_list.append({
-                        'ip':      ip.replace('::ffff:', ''),
-                        'file_id': file_id,
-                        'latency': round(info.get('latency', 0), 1),
-                        'device': info.get('device', 'Unknown Device')
-                    })
-
-    # --- Ops-card metrics (lightweight; computed every poll) ---
-    from routes.files import THUMBNAIL_DIR
-    from extensions import db
-    from models import File
+@dashboard_bp.route('/metrics')
+@admin_required
+def prometheus_metrics():
+    """Request, DB, ffmpeg and Socket.IO metrics for this worker, Prometheus text format."""
+    import metrics
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@socketio.on('join_dashboard')
+def join_dashboard(data=None):
+    """Subscribe an admin socket to pushed snapshots; the ack carries the current one."""
+    if not is_admin():
+        return {'status': 'forbidden'}
+    join_room(ADMIN_ROOM)
+    return {'status': 'ok', 'stats': sampler.latest()}
+
+
+def _log_filters():
+    """Filters shared by /api/logs and the dump: ip, action, path prefix, since/until (unix seconds)."""
+    args = request.args
+    return {
+        'ip':     args.get('ip', '').strip() or None,
+        'action': args.get('action', '').strip() or None,
+        'path':   args.get('path', '').strip() or None,
+        'since':  args.get('since', type=int),
+        'until':  args.get('until', type=int),
+    }
 
-    # Thumbnail cache
-    thumb_count, thumb_size = 0, 0
-    if os.path.isdir(THUMBNAIL_DIR):
-        for fname in os.listdir(THUMBNAIL_DIR):
-            try:
-                thumb_size += os.path.getsize(os.path.join(THUMBNAIL_DIR, fname))
-                thumb_count += 1
-            except OSError:
-                pass
 
-    # Orphan files — only meaningful in uploads (cleanup-enabled) mode
-    orphan_count = 0
-    if current_app.config.get('CLEANUP_ENABLED', False):
-        try:
-            db_names   = {f.stored_name for f in File.query.with_entities(File.stored_name).all()}
-            disk_names = set(os.listdir(upload_folder))
-            orphan_count = len(disk_names - db_names)
-        except Exception:
-            pass
-
-    # Active watch rooms and total connected peers
-    with watch_lock:
-        room_count = len(watch_sessions)
-    with viewers_lock:
-        peer_count = sum(len(v) for v in viewers_data.values())
-
-    return jsonify({
-        'system': {
-            'cpu':       cpu_norm,
-            'ram_used':  ram_proc,
-            'ram_total': ram_total,
-            'uptime':    int(uptime),
-        },
-        'storage': {
-            'used_hr': human_readable_size(total_size),
-            'files':   file_count,
-            'free_hr': human_readable_size(disk_free),
-            'total_hr': human_readable_size(disk_total),
-            'percent': disk_percent,
-        },
-        'network': {
-            'upload_bps':   round(upload_bps),
-            'download_bps': round(download_bps),
-            'history':      list(_net_history),
-        },
-        'ops': {
-            'thumb_count':   thumb_count,
-            'thumb_size_hr': human_readable_size(thumb_size),
-            'log_count':     len(activity_log),
-            'orphan_count':  orphan_count,
-            'room_count':    room_count,
-            'peer_count':    peer_count,
-        },
-        'viewers': viewer_list,
-        'logs':    list(activity_log),
-    })
+@dashboard_bp.route('/api/logs')
+@admin_required
+def logs_query():
+    """Durable activity history, newest first. ?before_id= pages back; ?actions=1 adds the action names."""
+    limit = min(max(request.args.get('limit', type=int, default=PAGE_DEFAULT), 1), PAGE_LIMIT)
+    entries, has_more = query_activity(**_log_filters(), limit=limit,
+                                       before_id=request.args.get('before_id', type=int))
+    payload = {'entries': entries, 'has_more': has_more}
+    if request.args.get('actions', type=int) == 1:
+        payload['actions'] = activity_actions()
+    return jsonify(payload)
 
 
 @dashboard_bp.route('/api/logs/dump')
 @admin_required
 def logs_dump():
-    """Return the current activity log as a downloadable JSON file."""
+    """
+    Return the activity log as a downloadable JSON file: durable history,
+    newest first, up to DUMP_LIMIT entries matching any filters.
+    ?source=live dumps the in-memory live list instead (lost at restart).
+    """
     import json
     from datetime import datetime
 
+    filters = _log_filters()
+    live    = request.args.get('source') == 'live'
+    if live:
+        entries = recent_activity()
+    else:
+        entries, _ = query_activity(**filters, limit=DUMP_LIMIT)
     payload = {
         'exported_at': datetime.utcnow().isoformat() + 'Z',
-        'count':       len(activity_log),
-        'entries':     list(activity_log),
+        'source':      'live' if live else 'history',
+        'filters':     {k: v for k, v in filters.items() if v is not None},
+        'count':       len(entries),
+        'entries':     entries,
     }
 
     filename = f"localshare-log-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.json"
@@ -183,7 +111,7 @@ def logs_dump():
     return resp
 
 # ============================================================
-# SYSTEM OPERATIONS  — four POST endpoints, all admin-only
+# SYSTEM OPERATIONS  — POST endpoints, all admin-only
 # ============================================================
 
 @dashboard_bp.route('/admin/api/clear-thumbnails', methods=['POST'])
@@ -205,6 +133,7 @@ def ops_clear_thumbnails():
 
     log_activity(request.remote_addr, 'Purge Thumbnails', THUMBNAIL_DIR,
                  'ops_clear_thumbnails', f'{cleared} removed')
+    sampler.refresh()
     return jsonify({'status': 'ok', 'cleared': cleared,
                     'thumb_count': 0, 'thumb_size_hr': '0.00 B'})
 
@@ -212,9 +141,8 @@ def ops_clear_thumbnails():
 @dashboard_bp.route('/admin/api/flush-logs', methods=['POST'])
 @admin_required
 def ops_flush_logs():
-    """Clear the in-memory activity log ring buffer."""
-    count = len(activity_log)
-    activity_log.clear()
+    """Clear the activity log ring buffer."""
+    count = clear_activity()
     # Log the flush itself so the buffer isn't completely empty after the op
     log_activity(request.remote_addr, 'Flush Logs', '/admin/api/flush-logs',
                  'ops_flush_logs', f'{count} entries cleared')
@@ -239,11 +167,15 @@ def ops_clean_orphans():
     removed = 0
     try:
         db_names   = {f.stored_name for f in File.query.with_entities(File.stored_name).all()}
-        disk_names = set(os.listdir(upload_folder))
+        # In-flight upload and dedup temp files are not orphans
+        disk_names = {n for n in os.listdir(upload_folder) if not n.startswith(TEMP_PREFIXES)}
         orphans    = disk_names - db_names
         for fname in orphans:
+            fpath = os.path.join(upload_folder, fname)
             try:
-                os.remove(os.path.join(upload_folder, fname))
+                size = os.path.getsize(fpath)
+                os.remove(fpath)
+                storage.file_removed(fname, size)
                 removed += 1
             except OSError:
                 pass
@@ -252,6 +184,7 @@ def ops_clean_orphans():
 
     log_activity(request.remote_addr, 'Clean Orphans', upload_folder,
                  'ops_clean_orphans', f'{removed} removed')
+    sampler.refresh()
     return jsonify({'status': 'ok', 'removed': removed, 'orphan_count': 0})
 
 
@@ -262,14 +195,130 @@ def ops_reset_rooms():
     Clear all active Watch Together sessions and viewer presence records.
     Connected clients will re-sync automatically on their next action.
     """
-    with watch_lock:
-        room_count = len(watch_sessions)
-        watch_sessions.clear()
-
-    with viewers_lock:
-        peer_count = sum(len(v) for v in viewers_data.values())
-        viewers_data.clear()
+    room_count, peer_count = rooms.clear()
 
     log_activity(request.remote_addr, 'Reset Rooms', '/admin/api/reset-rooms',
                  'ops_reset_rooms', f'{room_count} rooms, {peer_count} peers cleared')
-    return jsonify({'status': 'ok', 'room_count': 0, 'peer_count': 0})
\ No newline at end of file
+    return jsonify({'status': 'ok', 'room_count': 0, 'peer_count': 0})
+
+
+@dashboard_bp.route('/admin/api/retention', methods=['POST'])
+@admin_required
+def ops_retention():
+    """
+    Run the retention engine now. ?dry_run=1 reports what would be evicted
+    without touching disk or the database.
+    """
+    if not current_app.config.get('CLEANUP_ENABLED', False):
+        return jsonify({'status': 'skipped', 'reason': 'custom folder mode'})
+
+    from retention import run_retention
+
+    dry_run = request.args.get('dry_run', type=int, default=0) == 1
+    report  = run_retention(dry_run=dry_run)
+
+    log_activity(request.remote_addr, 'Retention', current_app.config['UPLOAD_FOLDER'],
+                 'ops_retention',
+                 f"{len(report['evicted'])} {'would be ' if dry_run else ''}evicted")
+    if not dry_run:
+        sampler.refresh()
+    return jsonify({'status': 'ok', **report, 'freed_hr': human_readable_size(report['freed'])})
+
+
+@dashboard_bp.route('/admin/api/dedupe', methods=['GET', 'POST'])
+@admin_required
+def ops_dedupe():
+    """
+    POST starts a background duplicate scan of UPLOAD_FOLDER; with ?apply=1
+    duplicates are replaced by hardlinks to one copy. GET reports the last run.
+    """
+    from dedup import dedupe_job, start_dedupe_job
+
+    if request.method == 'GET':
+        return jsonify(dict(dedupe_job))
+
+    apply = request.args.get('apply', type=int, default=0) == 1
+    if not start_dedupe_job(current_app._get_current_object(), apply=apply):
+        return jsonify({'status': 'busy', 'dedupe': dict(dedupe_job)}), 409
+
+    log_activity(request.remote_addr, 'Dedupe Scan', current_app.config['UPLOAD_FOLDER'],
+                 'ops_dedupe', 'Apply' if apply else 'Dry run')
+    return jsonify({'status': 'started', 'dedupe': dict(dedupe_job)})
+
+
+# ============================================================
+# PROFILING  — admin-only, per worker (see profiling.py)
+# ============================================================
+
+@dashboard_bp.route('/admin/api/profile', methods=['GET', 'POST'])
+@admin_required
+def ops_profile():
+    """POST ?seconds=N samples every thread's stack for N seconds. GET reports progress."""
+    import profiling
+
+    if request.method == 'GET':
+        return jsonify(profiling.profiler.status())
+
+    seconds = request.args.get('seconds', type=int, default=30)
+    if not profiling.profiler.start(seconds):
+        return jsonify({'status': 'busy', 'profile': profiling.profiler.status()}), 409
+
+    log_activity(request.remote_addr, 'Profile', '/admin/api/profile',
+                 'ops_profile', f'{seconds}s')
+    sampler.refresh()
+    return jsonify({'status': 'started', 'profile': profiling.profiler.status()})
+
+
+@dashboard_bp.route('/admin/api/profile/download')
+@admin_required
+def profile_download():
+    """Last profile session as folded stacks — open in speedscope.app or flamegraph.pl."""
+    import profiling
+    from datetime import datetime
+
+    filename = f"localshare-profile-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.folded"
+    resp = make_response(profiling.profiler.folded())
+    resp.headers['Content-Type']        = 'text/plain; charset=utf-8'
+    resp.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return resp
+
+
+@dashboard_bp.route('/admin/api/slow-requests', methods=['GET', 'DELETE'])
+@admin_required
+def ops_slow_requests():
+    """Requests slower than SLOW_REQUEST_MS, newest first, with time split and hot stacks."""
+    import profiling
+
+    if request.method == 'DELETE':
+        profiling.clear_slow_requests()
+        sampler.refresh()
+        return jsonify({'status': 'ok'})
+    return jsonify({'threshold_ms': current_app.config.get('SLOW_REQUEST_MS', 0),
+                    'requests':     profiling.slow_requests()})
+
+
+@dashboard_bp.route('/admin/api/tracemalloc', methods=['GET', 'POST'])
+@admin_required
+def ops_tracemalloc():
+    """
+    POST ?action=snapshot (default) starts tracing if needed and reports the
+    top allocation growth; ?action=stop stops tracing and drops snapshots.
+    GET reports whether tracing is on.
+    """
+    import profiling
+
+    if request.method == 'GET':
+        return jsonify(profiling.trace_status())
+
+    action = request.args.get('action', 'snapshot')
+    if action == 'stop':
+        report = profiling.trace_stop()
+    elif action == 'snapshot':
+        report = profiling.trace_snapshot()
+    else:
+        return jsonify({'status': 'error', 'detail': f'unknown action {action!r}'}), 400
+
+    log_activity(request.remote_addr, 'Tracemalloc', '/admin/api/tracemalloc',
+                 'ops_tracemalloc', action.capitalize())
+    sampler.refresh()
+    return jsonify({'status': 'ok', **report})
@@ -1,6 +1,9 @@
+import io
 import os
 import re
 import hashlib
+import importlib.util
+import mimetypes
 import subprocess
 import shutil
 from urllib.parse import quote
@@ -8,10 +11,22 @@ from urllib.parse import quote
 from flask import (Blueprint, render_template, request, redirect,
                    url_for, send_file, Response, current_app, abort, jsonify)
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 
 from extensions import db
 from models import File
-from utils import human_readable_size, STREAMABLE_EXTENSIONS, admin_required, log_activity
+from utils import human_readable_size, STREAMABLE_EXTENSIONS, admin_required, is_admin, log_activity
+from upload_stream import TEMP_PREFIXES, receive_multipart
+from archive_stream import collect_entries, zip_length, zip_stream, tar_length, tar_stream
+from retention import record_access
+from dedup import HASH_NAME, MIN_DEDUP_SIZE, find_existing_copy, link_to
+from rate_limit import TokenBucket, limit_route
+from storage_stats import storage
+from metrics import ffmpeg_job
+from sqlite_store import writer
+from browse_cache import cache as browse_cache, folder_of
+from compression import encoded_response
+from comic_archive import ARCHIVE_EXTENSIONS, UnsupportedArchive, PageReader, archives, read_page, prefetch
 
 files_bp = Blueprint('files', __name__)
 
@@ -21,11 +36,8 @@ VIDEO_EXTENSIONS = {'.mp4', '.mkv', '.webm', '.ts', '.mov', '.avi', '.m4v', '.wm
 THUMBNAIL_DIR = '.thumbnails'
 FFMPEG_PATH   = shutil.which('ffmpeg')
 
-try:
-    from PIL import Image
-    PILLOW_AVAILABLE = True
-except ImportError:
-    PILLOW_AVAILABLE = False
+# Pillow is imported on the first thumbnail that has to be generated
+PILLOW_AVAILABLE = importlib.util.find_spec('PIL') is not None
 
 MIME_TYPES = {
     # Native video
@@ -65,6 +77,9 @@ PLAYER_NATIVE_AUDIO = {'.mp3', '.flac', '.wav', '.aac', '.m4a', '.m4b', '.opus',
 # pre-emptively rejected on the server side.
 PLAYER_TRY_VIDEO = PLAYER_NATIVE_VIDEO | {'.mkv', '.m4v'}
 
+# Per-IP: an upload request every 2 s, bursts of 5
+UPLOADS = TokenBucket('upload', rate=0.5, burst=5)
+
 
 # ---------- Helpers ----------
 
@@ -84,17 +99,36 @@ def _resolve_subpath(subpath):
     return '' if p == '.' else p
 
 
-def _get_or_register(rel_path, entry_name, entry_size):
-    obj = File.query.filter_by(stored_name=rel_path).first()
-    if obj is None:
-        obj = File(original_name=entry_name, stored_name=rel_path, file_size=entry_size)
-        db.session.add(obj)
-        try:
-            db.session.flush()
-        except Exception:
-            db.session.rollback()
-            obj = File.query.filter_by(stored_name=rel_path).first()
-    return obj
+REGISTER_CHUNK = 500   # stored names per IN (…) lookup
+
+
+def _lookup_files(rel_paths):
+    found = {}
+    for i in range(0, len(rel_paths), REGISTER_CHUNK):
+        chunk = rel_paths[i:i + REGISTER_CHUNK]
+        found.update((f.stored_name, f) for f in File.query.filter(File.stored_name.in_(chunk)))
+    return found
+
+
+def _insert_files(entries):
+    """Writer job: catalog the entries still unknown (another request may have added some)."""
+    known = _lookup_files([rel for rel, _, _ in entries])
+    db.session.add_all(File(original_name=name, stored_name=rel, file_size=size)
+                       for rel, name, size in entries if rel not in known)
+
+
+def _register_files(entries):
+    """
+    {rel_path: File} for [(rel_path, name, size), …]. Paths not yet in the
+    catalog are added in one write job, then read back.
+    """
+    entries = [e for e in entries if not e[1].startswith(TEMP_PREFIXES)]
+    files   = _lookup_files([rel for rel, _, _ in entries])
+    missing = [e for e in entries if e[0] not in files]
+    if missing:
+        writer.run(_insert_files, missing)
+        files.update(_lookup_files([rel for rel, _, _ in missing]))
+    return files
 
 
 # ---------- Routes ----------
@@ -118,6 +152,20 @@ def browse():
     if not os.path.isdir(full_path):
         abort(404)
 
+    # Repeat views of an unchanged folder come from the page cache (see browse_cache.py)
+    key   = browse_cache.key(safe_path, full_path)
+    entry = browse_cache.get(key) or browse_cache.put(key, _browse_context(safe_path, full_path))
+    admin = is_admin()
+    page  = entry.pages.get(admin) or browse_cache.add_page(
+        key, entry, admin, render_template('browse.html', **entry.context))
+
+    resp = encoded_response(page.bodies, 'text/html', etag=page.etag)
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+
+def _browse_context(safe_path, full_path):
+    """Scan one folder, catalog any new files, and build browse.html's context."""
     items      = []
     image_only = True
     has_files  = False
@@ -128,9 +176,12 @@ def browse():
     except PermissionError:
         abort(403)
 
-    for entry in entries:
-        rel = (os.path.join(safe_path, entry.name) if safe_path else entry.name).replace('\\', '/')
+    listing  = [(e, (os.path.join(safe_path, e.name) if safe_path else e.name).replace('\\', '/'))
+                for e in entries if not e.name.startswith(TEMP_PREFIXES)]
+    db_files = _register_files([(rel, e.name, e.stat().st_size)
+                                for e, rel in listing if not e.is_dir()])
 
+    for entry, rel in listing:
         if entry.is_dir():
             image_only = False
             items.append({'name': entry.name, 'type': 'dir', 'path': rel, 'size': ''})
@@ -140,7 +191,7 @@ def browse():
             if ext not in IMAGE_EXTENSIONS:
                 image_only = False
 
-            db_file = _get_or_register(rel, entry.name, entry.stat().st_size)
+            db_file = db_files[rel]
 
             items.append({
                 'name':          entry.name,
@@ -151,12 +202,11 @@ def browse():
                 'upload_time':   db_file.upload_time.isoformat(),
                 'streamable':    ext in STREAMABLE_EXTENSIONS,
                 'extension':     ext,
-                'has_thumbnail': ext in IMAGE_EXTENSIONS or ext in VIDEO_EXTENSIONS,
+                'has_thumbnail': ext in IMAGE_EXTENSIONS or ext in VIDEO_EXTENSIONS or ext in ARCHIVE_EXTENSIONS,
+                'readable':      ext in ARCHIVE_EXTENSIONS,
                 'file_id':       db_file.id,
             })
 
-    db.session.commit()
-
     if not has_files:
         image_only = False
 
@@ -169,8 +219,7 @@ def browse():
 
     parent_path = '/'.join(safe_path.split('/')[:-1]) if safe_path else ''
 
-    return render_template(
-        'browse.html',
+    return dict(
         items=items,
         current_path=safe_path,
         breadcrumbs=breadcrumbs,
@@ -179,61 +228,102 @@ def browse():
     )
 
 
+def _record_uploads(written):
+    """Writer job: catalog [(stored_name, original_name, size, digest), …], updating overwritten files."""
+    from datetime import datetime
+    existing = _lookup_files([w[0] for w in written])
+    for stored_name, original_name, size, digest in written:
+        row = existing.get(stored_name)
+        if row:
+            row.file_size    = size
+            row.content_hash = digest
+            row.upload_time  = datetime.utcnow()
+        else:
+            db.session.add(File(original_name=original_name, stored_name=stored_name,
+                                file_size=size, content_hash=digest))
+
+
 @files_bp.route('/upload', methods=['POST'])
 @admin_required
+@limit_route(UPLOADS)
 def upload_file():
     upload_folder = current_app.config['UPLOAD_FOLDER']
     os.makedirs(upload_folder, exist_ok=True)
 
-    safe_path = _resolve_subpath(request.form.get('path', ''))
-
-    if safe_path and not is_safe_path(upload_folder, safe_path):
-        abort(403)
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return redirect(url_for('files.browse'))
 
-    target_dir = os.path.join(upload_folder, safe_path) if safe_path else upload_folder
-    os.makedirs(target_dir, exist_ok=True)
+    # The body is parsed straight off the socket, so request.form is never
+    # touched. browse.html sends the 'path' field before any file parts;
+    # a file arriving first would land in the wrong folder, so it is refused.
+    stored_names = {}
 
-    files = request.files.getlist('file')
-    if not files or all(f.filename == '' for f in files):
-        return redirect(url_for('files.browse', path=safe_path))
-
-    for file in files:
-        if not file or not file.filename:
-            continue
+    def dest_for(filename, fields):
+        if 'path' not in fields:
+            abort(400)
+        safe_path = _resolve_subpath(fields.get('path', ''))
+        if safe_path and not is_safe_path(upload_folder, safe_path):
+            abort(403)
 
         parts = [secure_filename(p)
-                 for p in file.filename.replace('\\', '/').split('/')
+                 for p in filename.replace('\\', '/').split('/')
                  if p]
         if not parts:
-            continue
+            return None
 
         stored_name = '/'.join(([safe_path] + parts) if safe_path else parts)
-
         if not is_safe_path(upload_folder, stored_name):
-            continue
+            return None
 
         dest = os.path.join(upload_folder, stored_name)
-        os.makedirs(os.path.dirname(dest), exist_ok=True)
-        file.save(dest)
-
-        file_size = os.path.getsize(dest)
-        existing  = File.query.filter_by(stored_name=stored_name).first()
-        if existing:
-            from datetime import datetime
-            existing.file_size   = file_size
-            existing.upload_time = datetime.utcnow()
-        else:
-            db.session.add(File(
-                original_name=parts[-1],
-                stored_name=stored_name,
-                file_size=file_size,
-            ))
-
-    db.session.commit()
-    log_activity(request.remote_addr, 'Upload', safe_path or '/', 'upload_file', 'Success')
+        try:
+            replaced_size = os.path.getsize(dest)
+        except OSError:
+            replaced_size = None
+        stored_names[dest] = (stored_name, parts[-1], replaced_size)
+        return dest
+
+    fields, uploads = receive_multipart(request.stream, boundary, dest_for,
+                                        hash_name=HASH_NAME)
+    safe_path = _resolve_subpath(fields.get('path', ''))
+
+    written = []
+    batch   = {}   # (digest, size) → paths written earlier in this request
+    for up in uploads:
+        stored_name, original_name, replaced_size = stored_names[up.dest]
+        storage.file_added(stored_name, up.size, replaced_size)
+
+        # Identical content already on disk — keep one copy, hardlink the new name
+        if up.size >= MIN_DEDUP_SIZE:
+            same   = batch.setdefault((up.digest, up.size), [])
+            source = find_existing_copy(upload_folder, up.dest, up.digest, up.size, stored_name, batch=same)
+            if source and link_to(up.dest, source):
+                log_activity(request.remote_addr, 'Dedup', stored_name, 'upload_file',
+                             f'Linked to {os.path.relpath(source, upload_folder)}')
+            same.append(up.dest)
+
+        written.append((stored_name, original_name, up.size, up.digest))
+
+    if written:
+        writer.run(_record_uploads, written)
+        browse_cache.invalidate(*{folder_of(w[0]) for w in written})
+    if uploads:
+        log_activity(request.remote_addr, 'Upload', safe_path or '/', 'upload_file', 'Success')
     return redirect(url_for('files.browse', path=safe_path))
 
 
+def _delete_row(file_id):
+    """Writer job."""
+    File.query.filter_by(id=file_id).delete()
+
+
+def _rename_row(file_id, original_name, stored_name):
+    """Writer job."""
+    File.query.filter_by(id=file_id).update({File.original_name: original_name,
+                                            File.stored_name:   stored_name})
+
+
 @files_bp.route('/delete/<int:file_id>', methods=['POST'])
 @admin_required
 def delete_file(file_id):
@@ -244,11 +334,13 @@ def delete_file(file_id):
     folder = '/'.join(file.stored_name.replace('\\', '/').split('/')[:-1])
 
     if os.path.exists(file_path):
+        size = os.path.getsize(file_path)
         os.remove(file_path)
+        storage.file_removed(file.stored_name, size)
 
     log_activity(request.remote_addr, 'Delete', file.stored_name, 'delete_file', 'Success')
-    db.session.delete(file)
-    db.session.commit()
+    writer.run(_delete_row, file.id)
+    browse_cache.invalidate(folder)
 
     return redirect(url_for('files.browse', path=folder))
 
@@ -278,9 +370,9 @@ def rename_file(file_id):
 
     if os.path.exists(old_path) and not os.path.exists(new_path):
         os.rename(old_path, new_path)
-        file.original_name = safe_name
-        file.stored_name   = new_stored
-        db.session.commit()
+        storage.file_moved(file.stored_name, new_stored, os.path.getsize(new_path))
+        writer.run(_rename_row, file.id, safe_name, new_stored)
+        browse_cache.invalidate(folder)
         log_activity(request.remote_addr, 'Rename',
                      f'{old_path.split(os.sep)[-1]} → {safe_name}',
                      'rename_file', 'Success')
@@ -294,10 +386,48 @@ def download_file(file_id):
     path = os.path.join(current_app.config['UPLOAD_FOLDER'], file.stored_name)
     if not os.path.exists(path):
         return 'File not found', 404
+    record_access(file_id)
     log_activity(request.remote_addr, 'Download', file.stored_name, 'download_file', '200')
     return send_file(path, as_attachment=True, download_name=file.original_name)
 
 
+@files_bp.route('/download_folder')
+def download_folder():
+    """
+    Stream a whole directory subtree as a ZIP (store mode) or TAR, built on
+    the fly. Content-Length is computed from a metadata-only walk up front.
+    """
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    safe_path     = _resolve_subpath(request.args.get('path', ''))
+    fmt           = request.args.get('format', 'zip')
+
+    if fmt not in ('zip', 'tar'):
+        abort(400)
+    if safe_path and not is_safe_path(upload_folder, safe_path):
+        abort(403)
+
+    full_path = os.path.join(upload_folder, safe_path) if safe_path else upload_folder
+    if not os.path.isdir(full_path):
+        abort(404)
+
+    folder_name = os.path.basename(safe_path) if safe_path else 'LocalShare'
+    entries     = collect_entries(full_path, folder_name)
+
+    if fmt == 'zip':
+        length, body, mimetype = zip_length(entries), zip_stream(entries), 'application/zip'
+    else:
+        length, body, mimetype = tar_length(entries), tar_stream(entries), 'application/x-tar'
+
+    log_activity(request.remote_addr, 'Download', safe_path or '/', 'download_folder',
+                 f'{len(entries)} files ({fmt})')
+
+    encoded_filename = quote(f'{folder_name}.{fmt}')
+    resp = Response(body, mimetype=mimetype, direct_passthrough=True)
+    resp.headers['Content-Length']      = length
+    resp.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{encoded_filename}"
+    return resp
+
+
 @files_bp.route('/stream/<int:file_id>')
 def stream_file(file_id):
     file      = File.query.get_or_404(file_id)
@@ -305,6 +435,8 @@ def stream_file(file_id):
     if not os.path.exists(file_path):
         return 'File not found', 404
 
+    record_access(file_id)
+
     file_size        = os.path.getsize(file_path)
     ext              = os.path.splitext(file.original_name)[1].lower()
     mimetype         = MIME_TYPES.get(ext, 'application/octet-stream')
@@ -416,10 +548,10 @@ def _get_related_subtitles(file):
     folder_rel    = os.path.dirname(stored)             # e.g. "Series" or ""
     folder_abs    = os.path.join(upload_folder, folder_rel) if folder_rel else upload_folder
 
-    results = []
     if not os.path.isdir(folder_abs):
-        return results
+        return []
 
+    found = []
     for entry in os.scandir(folder_abs):
         if not entry.is_file():
             continue
@@ -433,10 +565,10 @@ def _get_related_subtitles(file):
            not sub_base.startswith(base_no_ext + '.') and \
            not sub_base.startswith(base_no_ext + '_'):
             continue
-        db_file = _get_or_register(rel, entry.name, entry.stat().st_size)
-        results.append({'label': entry.name, 'file_id': db_file.id})
+        found.append((rel, entry.name, entry.stat().st_size))
 
-    db.session.commit()
+    db_files = _register_files(found)
+    results  = [{'label': name, 'file_id': db_files[rel].id} for rel, name, _ in found]
     results.sort(key=lambda x: natural_sort_key(x['label']))
     return results
 
@@ -554,7 +686,8 @@ def serve_embedded_subtitle(file_id, stream_idx):
     ]
 
     try:
-        result = subprocess.run(cmd, capture_output=True, timeout=30)
+        with ffmpeg_job('subtitle'):
+            result = subprocess.run(cmd, capture_output=True, timeout=30)
     except subprocess.TimeoutExpired:
         abort(504)
 
@@ -685,20 +818,31 @@ def thumbnail(file_id):
         abort(404)
 
     ext = os.path.splitext(file.original_name)[1].lower()
-    if ext not in IMAGE_EXTENSIONS and ext not in VIDEO_EXTENSIONS:
+    if ext not in IMAGE_EXTENSIONS and ext not in VIDEO_EXTENSIONS and ext not in ARCHIVE_EXTENSIONS:
         abort(404)
 
     os.makedirs(THUMBNAIL_DIR, exist_ok=True)
     stat       = os.stat(file_path)
     thumb_hash = hashlib.md5(f"{file_path}:{stat.st_mtime}".encode()).hexdigest()
-    thumb_path = os.path.join(THUMBNAIL_DIR, thumb_hash + '.webp')
+    thumb_path = os.path.abspath(os.path.join(THUMBNAIL_DIR, thumb_hash + '.webp'))   # send_file resolves relative paths from the app root, not the cwd
 
     if os.path.exists(thumb_path):
         return send_file(thumb_path, mimetype='image/webp')
 
+    source = file_path
+    if ext in ARCHIVE_EXTENSIONS:   # the cover: first page in reading order
+        try:
+            index = archives.get(file_path)
+            if not index.pages:
+                abort(404)
+            source = io.BytesIO(read_page(index, index.pages[0]))
+        except UnsupportedArchive:
+            abort(415)
+
+    from PIL import Image
     try:
-        if ext in IMAGE_EXTENSIONS:
-            img = Image.open(file_path)
+        if ext in IMAGE_EXTENSIONS or ext in ARCHIVE_EXTENSIONS:
+            img = Image.open(source)
             try:
                 rotations = {3: 180, 6: 270, 8: 90}
                 orientation = img.getexif().get(274)
@@ -715,11 +859,12 @@ def thumbnail(file_id):
             if not FFMPEG_PATH:
                 abort(501)
             temp = os.path.join(THUMBNAIL_DIR, thumb_hash + '.jpg')
-            result = subprocess.run(
-                [FFMPEG_PATH, '-ss', '5', '-i', file_path,
-                 '-frames:v', '1', '-q:v', '2', '-y', temp],
-                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-            )
+            with ffmpeg_job('thumbnail'):
+                result = subprocess.run(
+                    [FFMPEG_PATH, '-ss', '5', '-i', file_path,
+                     '-frames:v', '1', '-q:v', '2', '-y', temp],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+                )
             if result.returncode != 0 or not os.path.exists(temp):
                 abort(500)
             img = Image.open(temp)
@@ -740,6 +885,7 @@ def raw_file(file_id):
     path = os.path.join(current_app.config['UPLOAD_FOLDER'], file.stored_name)
     if not os.path.exists(path):
         abort(404)
+    record_access(file_id)
     return send_file(path)
 
 
@@ -755,7 +901,7 @@ def reader():
     if not os.path.isdir(full_path):
         abort(404)
 
-    images = []
+    found = []
     for entry in os.scandir(full_path):
         if not entry.is_file():
             continue
@@ -763,13 +909,80 @@ def reader():
         if ext not in IMAGE_EXTENSIONS:
             continue
         rel     = (os.path.join(safe_path, entry.name) if safe_path else entry.name).replace('\\', '/')
-        db_file = _get_or_register(rel, entry.name, entry.stat().st_size)
-        images.append({'name': entry.name, 'file_id': db_file.id})
+        found.append((rel, entry.name, entry.stat().st_size))
 
-    db.session.commit()
+    db_files = _register_files(found)
+    images   = [{'name': name, 'url': url_for('files.raw_file', file_id=db_files[rel].id)}
+                for rel, name, _ in found]
     images.sort(key=lambda x: natural_sort_key(x['name']))
     return render_template('reader.html', images=images, folder=safe_path)
 
+
+# ---------- Comic archives (see comic_archive.py) ----------
+
+def _archive_index(file):
+    path = os.path.join(current_app.config['UPLOAD_FOLDER'], file.stored_name)
+    if os.path.splitext(file.original_name)[1].lower() not in ARCHIVE_EXTENSIONS:
+        abort(404)
+    try:
+        return archives.get(path)
+    except FileNotFoundError:
+        abort(404)
+    except UnsupportedArchive:
+        abort(415)
+
+
+@files_bp.route('/reader/archive/<int:file_id>')
+def reader_archive(file_id):
+    """The reader over a .cbz/.zip's pages; nothing is extracted."""
+    file  = File.query.get_or_404(file_id)
+    index = _archive_index(file)
+    record_access(file_id)
+    images = [{'name': page.name,
+               'url':  url_for('files.archive_page', file_id=file_id, number=n, v=index.fingerprint)}
+              for n, page in enumerate(index.pages)]
+    # Reading progress is keyed by the archive's path and content, not its
+    # row id (ids are reused after deletes); the back link is its folder
+    return render_template('reader.html', images=images, folder=folder_of(file.stored_name),
+                           state_key=f'archive:{file.stored_name}:{index.fingerprint}',
+                           title=os.path.splitext(file.original_name)[0])
+
+
+@files_bp.route('/archive/<int:file_id>/page/<int:number>')
+def archive_page(file_id, number):
+    """
+    One page, read at its offset inside the archive. Range requests work
+    for stored pages. URLs carry the archive's fingerprint, so a page is
+    cached as immutable until the archive changes.
+    """
+    file  = File.query.get_or_404(file_id)
+    index = _archive_index(file)
+    if not 0 <= number < len(index.pages):
+        abort(404)
+    page     = index.pages[number]
+    mimetype = mimetypes.guess_type(page.name)[0] or 'application/octet-stream'
+
+    if page.deflated:
+        try:
+            resp = Response(read_page(index, page), mimetype=mimetype)
+        except UnsupportedArchive:
+            abort(415)
+    else:
+        resp = Response(wrap_file(request.environ, PageReader(index.path, page.offset, page.size)),
+                        mimetype=mimetype, direct_passthrough=True)
+
+    resp.set_etag(f'{index.fingerprint}-{number}')
+    if request.args.get('v') == index.fingerprint:
+        resp.cache_control.public    = True
+        resp.cache_control.max_age   = 365 * 86400
+        resp.cache_control.immutable = True
+    else:
+        resp.cache_control.no_cache = True
+
+    prefetch(index, number)
+    return resp.make_conditional(request, accept_ranges=True, complete_length=page.size)
+
+
 # ============================================================
 # FILE INFO  — metadata endpoint for the info popup
 # ============================================================
@@ -786,11 +999,12 @@ def _fmt_duration(seconds):
 
 def _ffprobe(path):
     try:
-        r = subprocess.run(
-            ['ffprobe', '-v', 'quiet', '-print_format', 'json',
-             '-show_streams', '-show_format', path],
-            capture_output=True, text=True, timeout=10
-        )
+        with ffmpeg_job('probe'):
+            r = subprocess.run(
+                ['ffprobe', '-v', 'quiet', '-print_format', 'json',
+                 '-show_streams', '-show_format', path],
+                capture_output=True, text=True, timeout=10
+            )
         import json as _json
         return _json.loads(r.stdout)
     except Exception:
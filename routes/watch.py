@@ -1,159 +1,224 @@
 import time
-import threading
-from collections import defaultdict
 
 from flask import Blueprint, request
-from flask_socketio import join_room, emit
+from flask_socketio import join_room, leave_room, emit
 
-from extensions import socketio
-from utils import update_viewer_info, get_device_string
+from extensions import socketio, state
+from utils import get_device_string
+from rate_limit import TokenBucket, limit_route, limit_event
+from timer_wheel import TimerWheel
+from watch_rooms import RoomRegistry, VIEWER_TIMEOUT, viewer_info
 
 watch_bp = Blueprint('watch', __name__)
 
-# --- Session state ---
-watch_sessions  = {}
-watch_sequence  = defaultdict(int)
-watch_lock      = threading.Lock()
+# --- Session state: one WatchRoom per file, shared through the state store ---
+rooms = RoomRegistry(state)
 
-# --- Rate limiting ---
-client_last_update  = defaultdict(float)
-client_update_lock  = threading.Lock()
-RATE_LIMIT_SECONDS  = 0.5
+# --- Rate limiting (per viewer, per room): 2 actions/s, bursts of 4 ---
+WATCH_ACTIONS = TokenBucket('watch_action', rate=2, burst=4)
+
+
+# ============================================================
+# PRESENCE
+# Join/leave/latency changes are pushed to the room as deltas
+# (viewer_joined / viewer_left / viewer_latency); a joining socket gets
+# the full list once (viewers_snapshot). Socket viewers leave on
+# disconnect; socket-less viewers are expired by a timer wheel as soon as
+# their heartbeat lapses rather than on the 15-minute room sweep.
+# ============================================================
+
+def _room_name(file_id):
+    return f'watch_{file_id}'
+
+
+def _expire_viewer(key, now):
+    file_id, ip = key
+    room = rooms.get(file_id)
+    if room is None:
+        return None
+    next_deadline = room.expire_viewer(ip, now)
+    if next_deadline is None:
+        _viewer_left(room, ip, now)
+    return next_deadline
+
+
+presence = TimerWheel(_expire_viewer, name='watch-presence')
+
+
+def _viewer_joined(file_id, viewer, now):
+    presence.schedule((file_id, viewer.ip), now + VIEWER_TIMEOUT)
+    socketio.emit('viewer_joined', viewer.info(now), room=_room_name(file_id))
+
+
+def _viewer_left(room, ip, now):
+    # Another worker may still be serving a tab from the same address
+    if not room.watched_elsewhere(ip, now):
+        socketio.emit('viewer_left', {'ip': ip}, room=_room_name(room.file_id))
+
+
+def _push_latency(room, viewer, now):
+    latency = room.latency_delta(viewer, now)
+    if latency is not None:
+        socketio.emit('viewer_latency', {'ip': viewer.ip, 'latency': latency},
+                      room=_room_name(room.file_id))
+
+
+def _apply_action(file_id, client_ip, device, data, now, latency_ms=None):
+    """
+    Shared by the socket event and the HTTP route. Returns (response, status);
+    a successful play/pause/seek is broadcast to the room before returning.
+    """
+    action = data['action']
+    room   = rooms.get_or_create(file_id, now)
+    viewer, created = room.touch_viewer(client_ip, latency_ms, device, now)
+    if created:
+        _viewer_joined(file_id, viewer, now)
+    elif latency_ms is not None:
+        _push_latency(room, viewer, now)
+
+    if action == 'heartbeat':
+        room.mark_active(now)
+        return {'status': 'ok'}, 200
+
+    payload = room.apply(action, data.get('position'), now)
+    if payload is None:
+        return {'error': 'unknown action'}, 400
+
+    socketio.emit('watch_update', payload, room=_room_name(file_id))
+    return {'status': 'ok'}, 200
 
-# --- Viewer tracking ---
-viewers_data  = defaultdict(dict)
-viewers_lock  = threading.Lock()
 
 @watch_bp.route('/watch/action/<int:file_id>', methods=['POST'])
+@limit_route(WATCH_ACTIONS,
+             key=lambda: f"{request.view_args['file_id']}:{request.remote_addr}",
+             on_limit=lambda wait: ({'status': 'rate_limited'}, 429))
 def watch_action(file_id):
+    """HTTP fallback for clients without a socket; stream.html uses the event."""
     data = request.get_json()
     if not data or 'action' not in data:
         return {'error': 'missing action'}, 400
 
-    action     = data['action']
-    now        = time.time()
-    client_ip  = request.remote_addr or 'unknown'
-
-    # Compute RTT from client_time (client sends Date.now()/1000). Falls back to 0.
+    # Legacy latency estimate from client_time (client sends Date.now()/1000).
+    # It mixes one-way delay with clock skew; socket clients use time_ping instead.
+    now         = time.time()
     client_time = data.get('client_time')
     latency_ms  = round((now - client_time) * 1000) if client_time else 0
-    
-    # Register the baseline connection status
-    update_viewer_info(viewers_data, viewers_lock, file_id, client_ip, latency_ms)
-    
-    # Store the device context safely inside our active viewers dictionary
-    device_name = get_device_string()
-    with viewers_lock:
-        if file_id in viewers_data and client_ip in viewers_data[file_id]:
-            viewers_data[file_id][client_ip]['device'] = device_name
-
-    rate_key = f'{client_ip}:{file_id}'
-    with client_update_lock:
-        if now - client_last_update.get(rate_key, 0) < RATE_LIMIT_SECONDS:
-            return {'status': 'rate_limited'}, 429
-        client_last_update[rate_key] = now
-
-    with watch_lock:
-        sess = watch_sessions.get(file_id)
-        if not sess:
-            sess = {'playing': False, 'position': 0.0, 'updated_at': now,
-                    'last_action': 'pause', 'seq': 0}
-            watch_sessions[file_id] = sess
-
-        if action == 'seek':
-            sess['position']    = float(data.get('position', 0.0))
-            sess['updated_at']  = now
-            sess['last_action'] = 'seek'
-
-        elif action == 'play':
-            sess['playing']     = True
-            sess['position']    = float(data.get('position', sess['position']))
-            sess['updated_at']  = now
-            sess['last_action'] = 'play'
-
-        elif action == 'pause':
-            sess['playing']     = False
-            sess['position']    = float(data.get('position', sess['position']))
-            sess['updated_at']  = now
-            sess['last_action'] = 'pause'
-
-        elif action == 'heartbeat':
-            sess['last_active'] = now
-            return {'status': 'ok'}
-
-        else:
-            return {'error': 'unknown action'}, 400
-
-        watch_sequence[file_id] += 1
-        sess['seq']         = watch_sequence[file_id]
-        sess['last_active'] = now
-
-        payload = {
-            'playing':    sess['playing'],
-            'position':   sess['position'],
-            'updated_at': sess['updated_at'],
-            'last_action': sess['last_action'],
-            'seq':        sess['seq'],
-            'server_now': now,
-        }
-
-    socketio.emit('watch_update', payload, room=f'watch_{file_id}')
-    return {'status': 'ok'}
+
+    return _apply_action(file_id, request.remote_addr or 'unknown',
+                         get_device_string(), data, now, latency_ms)
+
+
+def _viewer_list(file_id, now):
+    return [viewer_info(v, now) for v in rooms.view(file_id).active_viewers(now)]
 
 
 @watch_bp.route('/watch/viewers/<int:file_id>')
 def watch_viewers(file_id):
-    with viewers_lock:
-        now    = time.time()
-        active = {
-            ip: info for ip, info in viewers_data.get(file_id, {}).items()
-            if now - info.get('last_seen', 0) < 30
-        }
-    return {
-        'count': len(active),
-        'viewers': [
-            {
-                'ip':             ip,
-                'latency':        round(info['latency'], 1),
-                'active_seconds': round(now - info.get('first_seen', now), 1),
-                'device': info.get('device', 'Unknown Device')
-            }
-            for ip, info in active.items()
-        ],
-    }
+    """Polled only by clients whose socket is down; others get pushed deltas."""
+    viewers = _viewer_list(file_id, time.time())
+    return {'count': len(viewers), 'viewers': viewers}
+
+
+# --- Per-connection context ---
+# The User-Agent is parsed once when a socket joins, not on every action.
+_connections = {}   # sid → (client_ip, device, file_id)
 
 
 @socketio.on('join_watch')
 def join_watch(data):
     file_id = data.get('file_id')
-    if file_id is None:
+    if not isinstance(file_id, int):
         return
 
-    join_room(f'watch_{file_id}')
     now       = time.time()
     client_ip = request.remote_addr or 'unknown'
+    device    = get_device_string()
+    previous  = _connections.get(request.sid)
+    if previous is not None and previous[2] == file_id:
+        return   # duplicate join on the same socket
+    if previous is not None:
+        leave_room(_room_name(previous[2]))
+        _leave(request.sid, now)
+
+    join_room(_room_name(file_id))
+    _connections[request.sid] = (client_ip, device, file_id)
+
+    # Register viewer immediately on join, with the socket's user-agent context
+    room = rooms.get_or_create(file_id, now)
+    viewer, created = room.connect_viewer(client_ip, device, now)
+    if created:
+        _viewer_joined(file_id, viewer, now)
+
+    emit('watch_update', room.state(now))
+    emit('viewers_snapshot', {'viewers': _viewer_list(file_id, now)})
+
+
+def _action_key(data):
+    # The joined room, never the payload: a client-chosen file_id would mint buckets at will.
+    # Matches watch_action's room:ip key, so HTTP and socket actions share a bucket.
+    conn = _connections.get(request.sid)
+    return f"{conn[2] if conn else None}:{request.remote_addr}"
+
+
+@socketio.on('watch_action')
+@limit_event(WATCH_ACTIONS, key=_action_key,
+             on_limit=lambda wait: {'status': 'rate_limited'})
+def watch_action_event(data):
+    """Play/pause/seek/heartbeat over the open socket. The return value is the client's ack."""
+    if not isinstance(data, dict) or 'action' not in data:
+        return {'error': 'missing action'}
+
+    # The room is the one this socket joined; a file_id in the payload must agree
+    conn = _connections.get(request.sid)
+    if conn is None:
+        return {'error': 'not joined'}
+    if data.get('file_id', conn[2]) != conn[2]:
+        return {'error': 'wrong room'}
+
+    body, _ = _apply_action(conn[2], conn[0], conn[1], data, time.time())
+    return body
+
+
+@socketio.on('time_ping')
+def time_ping(data):
+    """
+    NTP-style exchange. The client sends t0 (its send time) and gets back
+    t1/t2 (server receive/send). From t3 (its receive time) it derives
+        rtt    = (t3 - t0) - (t2 - t1)
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+    and keeps the min-RTT sample of a sliding window. Pings also carry the
+    client's current best estimate so the room can show real latency and
+    size the lead time for scheduled starts.
+    """
+    t1 = time.time()
+    if not isinstance(data, dict):
+        return None
+
+    # Estimates are recorded against the joined room, never one named in the payload
+    conn   = _connections.get(request.sid)
+    rtt    = data.get('rtt')
+    offset = data.get('offset')
+    if conn and data.get('file_id', conn[2]) == conn[2] and isinstance(rtt, (int, float)) \
+            and isinstance(offset, (int, float)) and 0 <= rtt < 10:
+        room   = rooms.get(conn[2])
+        viewer = room.record_clock(conn[0], float(rtt), float(offset), t1) if room else None
+        if viewer is not None:
+            _push_latency(room, viewer, t1)
+
+    return {'t0': data.get('t0'), 't1': t1, 't2': time.time()}
+
+
+def _leave(sid, now):
+    conn = _connections.pop(sid, None)
+    if conn is None:
+        return
+    client_ip, _, file_id = conn
+    room = rooms.get(file_id)
+    if room is not None and room.disconnect_viewer(client_ip, now):
+        presence.cancel((file_id, client_ip))
+        _viewer_left(room, client_ip, now)
+
 
-    # Register viewer immediately on join
-    update_viewer_info(viewers_data, viewers_lock, file_id, client_ip, 0)
-    
-    # Parse and store user-agent context for the initial socket connection
-    device_name = get_device_string()
-    with viewers_lock:
-        if file_id in viewers_data and client_ip in viewers_data[file_id]:
-            viewers_data[file_id][client_ip]['device'] = device_name
-
-    with watch_lock:
-        sess = watch_sessions.get(file_id)
-        if not sess:
-            sess = {'playing': False, 'position': 0.0, 'updated_at': now,
-                    'last_action': 'pause', 'seq': 0}
-            watch_sessions[file_id] = sess
-
-    emit('watch_update', {
-        'playing':    sess['playing'],
-        'position':   sess['position'],
-        'updated_at': sess['updated_at'],
-        'last_action': sess['last_action'],
-        'seq':        sess['seq'],
-        'server_now': now,
-    })
\ No newline at end of file
+@socketio.on('disconnect')
+def watch_disconnect(*args):
+    _leave(request.sid, time.time())
@@ -0,0 +1,147 @@
+import queue
+import atexit
+import sqlite3
+import logging
+import threading
+from concurrent.futures import Future
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+
+import metrics
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+# ============================================================
+# SQLITE STORAGE
+# Every SQLite connection (database.db and activity.db) opens in WAL mode
+# with the PRAGMAS below. In WAL, readers work from a snapshot and never
+# wait on a writer, so request threads read through a plain connection
+# pool (POOL_SIZE + MAX_OVERFLOW connections per file).
+#
+# Writes to database.db all go through one thread. Callers hand
+# writer.run() a function that uses db.session. Jobs that queue up while a
+# transaction is open are committed together in the next one (group
+# commit): one BEGIN IMMEDIATE, one COMMIT, one fsync of the WAL. With a
+# single writer per process, "database is locked" can only come from
+# another worker process, and busy_timeout absorbs that.
+#
+# activity.db keeps its own single writer (activity_log.py).
+# ============================================================
+
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous',  'NORMAL'),      # durable at checkpoints; a crash can lose only the last commits
+    ('busy_timeout', 5000),          # ms to wait on another process's write lock
+    ('cache_size',   -16384),        # KiB per connection (16 MiB)
+    ('mmap_size',    256 * 1024 * 1024),
+    ('temp_store',   'MEMORY'),
+)
+POOL_SIZE    = 10
+MAX_OVERFLOW = 20
+POOL_TIMEOUT = 30    # seconds a request waits for a free connection
+BATCH_MAX    = 256   # jobs per transaction
+
+
+@event.listens_for(Engine, 'connect')
+def _set_pragmas(dbapi_conn, connection_record):
+    if not isinstance(dbapi_conn, sqlite3.Connection):
+        return
+    for name, value in PRAGMAS:
+        dbapi_conn.execute(f'PRAGMA {name}={value}')
+
+
+def engine_options():
+    return {'pool_size': POOL_SIZE, 'max_overflow': MAX_OVERFLOW, 'pool_timeout': POOL_TIMEOUT}
+
+
+# ============================================================
+# WRITER
+# ============================================================
+
+class SQLiteWriter:
+    def __init__(self):
+        self._queue  = queue.Queue()
+        self._app    = None
+        self._thread = None
+
+    def start(self, app):
+        if self._thread is not None:
+            return
+        self._app    = app
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=5.0):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def submit(self, fn, *args):
+        """
+        Queue `fn(*args)` to run on the writer thread and return a Future for
+        its result, set once the transaction that ran it has committed. `fn`
+        writes through db.session and must not commit or roll back itself.
+        """
+        if self._thread is None:
+            raise RuntimeError("DB writer not started (sqlite_store.init_app)")
+        future = Future()
+        if threading.get_ident() == getattr(self._thread, 'ident', None):
+            future.set_result(fn(*args))   # already inside a job: join its transaction
+        else:
+            self._queue.put((fn, args, future))
+        return future
+
+    def run(self, fn, *args):
+        """submit() and wait: returns fn's result after commit, or raises its exception."""
+        return self.submit(fn, *args).result()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            # No waiting: whatever queued up during the previous commit shares this one
+            while len(batch) < BATCH_MAX:
+                try:
+                    nxt = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    self._commit(batch)
+                    return
+                batch.append(nxt)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        with self._app.app_context():
+            try:
+                db.session.execute(text('BEGIN IMMEDIATE'))
+                results = [fn(*args) for fn, args, _ in batch]
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                if len(batch) > 1:
+                    # One bad job must not sink the others: retry each on its own
+                    for job in batch:
+                        self._commit([job])
+                    return
+                logger.debug(f"DB writer: job failed: {e!r}")
+                batch[0][2].set_exception(e)
+                return
+        metrics.DB_WRITE_BATCH.observe(len(batch))
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+writer = SQLiteWriter()
+
+
+def init_app(app):
+    """Call before db.init_app(): sets the pool options and starts the writer."""
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options())
+    writer.start(app)
@@ -0,0 +1,496 @@
+import json
+import time
+import uuid
+import queue
+import socket
+import logging
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import socketio
+
+logger = logging.getLogger(__name__)
+
+# ============================================================
+# SHARED STATE / PUB-SUB BACKEND
+# Everything that has to agree across worker processes — watch playback
+# state and presence, rate-limit counters, the activity log, chat ring
+# invalidations and the Socket.IO fan-out — goes through one small store
+# API (key/value with TTL, hashes, capped lists, locks, pub/sub).
+#
+#   STATE_BACKEND=local                      in-process (default, one worker)
+#   STATE_BACKEND=unix:///tmp/localshare.sock   bundled broker (state_broker.py)
+#   STATE_BACKEND=tcp://127.0.0.1:7379          bundled broker over TCP
+#   STATE_BACKEND=redis://localhost:6379/0      any Redis-compatible server
+#
+# Values must be JSON-serializable; the local backend stores them as-is,
+# the others round-trip them through JSON.
+# ============================================================
+
+NODE_ID = uuid.uuid4().hex[:12]   # identifies this worker process in shared keys
+
+LOCK_TIMEOUT = 10      # seconds a shared lock may be held before it auto-expires
+LOCK_WAIT    = 5       # seconds to wait for a shared lock before giving up
+PURGE_EVERY  = 1024    # local backend: sweep expired keys every N TTL writes
+
+
+class LocalBackend:
+    """In-process store. Also the data structure behind state_broker.py."""
+    shared = False
+
+    def __init__(self):
+        self._lock     = threading.Lock()
+        self._data     = {}
+        self._expiry   = {}                  # key → absolute deadline
+        self._locks    = {}                  # key → threading.Lock (lock())
+        self._subs     = defaultdict(list)   # channel → [callback]
+        self._ttl_sets = 0
+
+    # --- Expiry (callers hold self._lock) ---
+
+    def _live(self, key, now):
+        deadline = self._expiry.get(key)
+        if deadline is not None and deadline <= now:
+            self._data.pop(key, None)
+            del self._expiry[key]
+            return False
+        return key in self._data
+
+    def _set_ttl(self, key, ttl, now):
+        if ttl is None:
+            self._expiry.pop(key, None)
+            return
+        self._expiry[key] = now + ttl
+        self._ttl_sets += 1
+        if self._ttl_sets >= PURGE_EVERY:
+            self._ttl_sets = 0
+            for k in [k for k, d in self._expiry.items() if d <= now]:
+                self._data.pop(k, None)
+                del self._expiry[k]
+
+    # --- Key/value ---
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key) if self._live(key, time.time()) else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = value
+            self._set_ttl(key, ttl, time.time())
+
+    def set_nx(self, key, value, ttl=None):
+        """Set only if absent (or expired). Returns True if the key was set."""
+        now = time.time()
+        with self._lock:
+            if self._live(key, now):
+                return False
+            self._data[key] = value
+            self._set_ttl(key, ttl, now)
+            return True
+
+    def take_token(self, key, rate, burst):
+        """Token bucket (see rate_limit.py). Returns 0.0 if allowed, else seconds to wait."""
+        now = time.time()
+        with self._lock:
+            tokens, last = self._data[key] if self._live(key, now) else (burst, now)
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait   = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._data[key] = [tokens, now]
+            self._set_ttl(key, burst / rate, now)   # a full bucket needs no entry
+            return wait
+
+    def delete(self, *keys):
+        # Lock objects stay: one may be held right now (WatchRoom.apply locks the
+        # key _drop_shared deletes), and a fresh one would let a second thread in.
+        # The broker and Redis keep theirs under lock:{key}, apart from the data.
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+                self._expiry.pop(key, None)
+
+    def delete_if(self, key, value):
+        """Delete key only if it still holds `value` (lock release)."""
+        with self._lock:
+            if self._live(key, time.time()) and self._data[key] == value:
+                del self._data[key]
+                self._expiry.pop(key, None)
+                return True
+            return False
+
+    # --- Hashes ---
+
+    def hset(self, key, field, value):
+        with self._lock:
+            h = self._data.get(key)
+            if not isinstance(h, dict):
+                h = self._data[key] = {}
+            h[field] = value
+
+    def hdel(self, key, *fields):
+        with self._lock:
+            h = self._data.get(key)
+            if h is None:
+                return
+            for field in fields:
+                h.pop(field, None)
+            if not h:
+                del self._data[key]
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._data.get(key) or {})
+
+    # --- Capped lists (newest first) ---
+
+    def lpush_capped(self, key, value, maxlen):
+        with self._lock:
+            items = self._data.get(key)
+            if not isinstance(items, deque) or items.maxlen != maxlen:
+                items = self._data[key] = deque(items or (), maxlen=maxlen)
+            items.appendleft(value)
+
+    def lrange(self, key):
+        with self._lock:
+            return list(self._data.get(key) or ())
+
+    # --- Locks ---
+
+    def lock(self, key, timeout=LOCK_TIMEOUT):
+        with self._lock:
+            lk = self._locks.get(key)
+            if lk is None:
+                lk = self._locks[key] = threading.Lock()
+        return lk
+
+    # --- Pub/sub (delivered synchronously in the publisher's thread) ---
+
+    def publish(self, channel, data):
+        for callback in list(self._subs.get(channel, ())):
+            try:
+                callback(data)
+            except Exception:
+                logger.exception(f"State backend: subscriber on {channel!r} failed")
+
+    def subscribe(self, channel, callback):
+        self._subs[channel].append(callback)
+
+    def unsubscribe(self, channel, callback):
+        try:
+            self._subs[channel].remove(callback)
+        except ValueError:
+            pass
+
+
+# ============================================================
+# BROKER CLIENT  — talks to state_broker.py over a Unix or TCP socket
+# Newline-delimited JSON: {"op", "args"} → {"ok": result} | {"error": msg}.
+# Requests share a small connection pool; one extra connection per
+# process carries subscriptions.
+# ============================================================
+
+def _connect(address):
+    family, target = address
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(target)
+    if family != getattr(socket, 'AF_UNIX', None):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def parse_broker_url(url):
+    parsed = urlparse(url)
+    if parsed.scheme == 'unix':
+        return socket.AF_UNIX, parsed.path
+    if parsed.scheme == 'tcp':
+        return socket.AF_INET, (parsed.hostname or '127.0.0.1', parsed.port or 7379)
+    raise ValueError(f"Unsupported broker URL: {url}")
+
+
+class _BrokerConn:
+    def __init__(self, address):
+        self.sock  = _connect(address)
+        self.rfile = self.sock.makefile('rb')
+
+    def call(self, op, args):
+        self.sock.sendall(json.dumps({'op': op, 'args': args}).encode() + b'\n')
+        line = self.rfile.readline()
+        if not line:
+            raise ConnectionError("State broker closed the connection")
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise RuntimeError(f"State broker: {reply['error']}")
+        return reply['ok']
+
+    def close(self):
+        try:
+            self.rfile.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class BrokerBackend:
+    shared = True
+
+    def __init__(self, url):
+        self.url      = url
+        self._address = parse_broker_url(url)
+        self._pool    = queue.LifoQueue()
+        self._subs    = defaultdict(list)
+        self._sub_lock   = threading.Lock()
+        self._sub_conn   = None
+        self._sub_thread = None
+
+    def _call(self, op, *args):
+        for attempt in (0, 1):
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                conn = _BrokerConn(self._address)
+            try:
+                result = conn.call(op, list(args))
+            except (OSError, ConnectionError):
+                conn.close()
+                if attempt:
+                    raise
+                continue   # stale pooled connection — retry once on a fresh one
+            self._pool.put(conn)
+            return result
+
+    def get(self, key):                     return self._call('get', key)
+    def set(self, key, value, ttl=None):    return self._call('set', key, value, ttl)
+    def set_nx(self, key, value, ttl=None): return self._call('set_nx', key, value, ttl)
+    def take_token(self, key, rate, burst): return self._call('take_token', key, rate, burst)
+    def delete(self, *keys):                return self._call('delete', *keys)
+    def delete_if(self, key, value):        return self._call('delete_if', key, value)
+    def hset(self, key, field, value):      return self._call('hset', key, field, value)
+    def hdel(self, key, *fields):           return self._call('hdel', key, *fields)
+    def hgetall(self, key):                 return self._call('hgetall', key)
+    def lrange(self, key):                  return self._call('lrange', key)
+    def publish(self, channel, data):       return self._call('publish', channel, data)
+
+    def lpush_capped(self, key, value, maxlen):
+        return self._call('lpush_capped', key, value, maxlen)
+
+    @contextmanager
+    def lock(self, key, timeout=LOCK_TIMEOUT):
+        name, token = f'lock:{key}', uuid.uuid4().hex
+        deadline = time.time() + LOCK_WAIT
+        while not self.set_nx(name, token, timeout):
+            if time.time() > deadline:
+                raise TimeoutError(f"Could not acquire shared lock {key!r}")
+            time.sleep(0.005)
+        try:
+            yield
+        finally:
+            self.delete_if(name, token)
+
+    # --- Subscriptions ---
+
+    def subscribe(self, channel, callback):
+        with self._sub_lock:
+            self._subs[channel].append(callback)
+            if self._sub_conn is not None:
+                self._send_subscribe(self._sub_conn, channel)
+            if self._sub_thread is None:
+                self._sub_thread = threading.Thread(target=self._listen, name='state-broker-sub',
+                                                    daemon=True)
+                self._sub_thread.start()
+
+    def _send_subscribe(self, conn, channel):
+        conn.sock.sendall(json.dumps({'op': 'subscribe', 'args': [channel]}).encode() + b'\n')
+
+    def _listen(self):
+        backoff = 0.5
+        while True:
+            try:
+                conn = _BrokerConn(self._address)
+                with self._sub_lock:
+                    self._sub_conn = conn
+                    for channel in self._subs:
+                        self._send_subscribe(conn, channel)
+                backoff = 0.5
+                for line in conn.rfile:
+                    msg = json.loads(line)
+                    if 'channel' not in msg:
+                        continue   # subscribe acks
+                    for callback in list(self._subs.get(msg['channel'], ())):
+                        try:
+                            callback(msg['data'])
+                        except Exception:
+                            logger.exception(f"State backend: subscriber on {msg['channel']!r} failed")
+                logger.warning("State broker subscription closed; reconnecting")
+            except OSError as e:
+                logger.warning(f"State broker unreachable ({e}); retrying in {backoff:.1f}s")
+            with self._sub_lock:
+                self._sub_conn = None
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 10)
+
+
+# ============================================================
+# REDIS  — optional; needs the `redis` package
+# ============================================================
+
+class RedisBackend:
+    shared = True
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis:// needs the 'redis' package "
+                               "(pip install redis)") from None
+        self.url     = url
+        self._r      = redis.Redis.from_url(url)
+        self._pubsub = None
+        self._pubsub_thread = None
+
+    def get(self, key):
+        raw = self._r.get(key)
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self._r.set(key, json.dumps(value), px=int(ttl * 1000) if ttl else None)
+
+    def set_nx(self, key, value, ttl=None):
+        return bool(self._r.set(key, json.dumps(value), nx=True,
+                                px=int(ttl * 1000) if ttl else None))
+
+    _TAKE_TOKEN = """
+        local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local b = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+        local tokens = math.min(burst, (tonumber(b[1]) or burst) + (now - (tonumber(b[2]) or now)) * rate)
+        local wait = 0
+        if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'last', tostring(now))
+        redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+        return tostring(wait)
+    """
+
+    def take_token(self, key, rate, burst):
+        return float(self._r.eval(self._TAKE_TOKEN, 1, key, rate, burst, time.time()))
+
+    def delete(self, *keys):
+        if keys:
+            self._r.delete(*keys)
+
+    def delete_if(self, key, value):
+        script = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+        return bool(self._r.eval(script, 1, key, json.dumps(value)))
+
+    def hset(self, key, field, value):
+        self._r.hset(key, field, json.dumps(value))
+
+    def hdel(self, key, *fields):
+        if fields:
+            self._r.hdel(key, *fields)
+
+    def hgetall(self, key):
+        return {k.decode(): json.loads(v) for k, v in self._r.hgetall(key).items()}
+
+    def lpush_capped(self, key, value, maxlen):
+        pipe = self._r.pipeline()
+        pipe.lpush(key, json.dumps(value))
+        pipe.ltrim(key, 0, maxlen - 1)
+        pipe.execute()
+
+    def lrange(self, key):
+        return [json.loads(v) for v in self._r.lrange(key, 0, -1)]
+
+    def lock(self, key, timeout=LOCK_TIMEOUT):
+        return self._r.lock(f'lock:{key}', timeout=timeout, blocking_timeout=LOCK_WAIT)
+
+    def publish(self, channel, data):
+        self._r.publish(channel, json.dumps(data))
+
+    def subscribe(self, channel, callback):
+        if self._pubsub is None:
+            self._pubsub = self._r.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{channel: lambda msg: callback(json.loads(msg['data']))})
+        if self._pubsub_thread is None:
+            self._pubsub_thread = self._pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+
+# ============================================================
+# SOCKET.IO FAN-OUT over the bundled broker
+# (Redis URLs use Flask-SocketIO's own message_queue support instead.)
+# ============================================================
+
+class BrokerManager(socketio.PubSubManager):
+    name = 'localshare-broker'
+
+    def __init__(self, backend, channel='flask-socketio', write_only=False):
+        super().__init__(channel=channel, write_only=write_only)
+        self._backend = backend
+        self._inbox   = queue.Queue()
+
+    def initialize(self):
+        if not self.write_only:
+            self._backend.subscribe(self.channel, self._inbox.put)
+        super().initialize()
+
+    def _publish(self, data):
+        self._backend.publish(self.channel, data)
+
+    def _listen(self):
+        while True:
+            yield self._inbox.get()
+
+
+# ============================================================
+# FACADE  — the `state` singleton in extensions.py
+# ============================================================
+
+def make_backend(url):
+    if not url or url == 'local':
+        return LocalBackend()
+    if url.startswith(('unix://', 'tcp://')):
+        return BrokerBackend(url)
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisBackend(url)
+    raise ValueError(f"Unknown STATE_BACKEND: {url}")
+
+
+class StateStore:
+    """
+    Starts out in-process so modules can use it at import time; init_app()
+    swaps in the configured backend and replays subscriptions made so far.
+    """
+
+    def __init__(self):
+        self._backend = LocalBackend()
+        self._subs    = []
+
+    def init_app(self, app):
+        url = app.config.get('STATE_BACKEND') or 'local'
+        self._backend = make_backend(url)
+        for channel, callback in self._subs:
+            self._backend.subscribe(channel, callback)
+        app.extensions['state'] = self
+        if self.shared:
+            logger.info(f"Shared state backend: {url} (node {NODE_ID})")
+
+    @property
+    def shared(self):
+        return self._backend.shared
+
+    def socketio_options(self):
+        """Extra socketio.init_app() kwargs so emits reach clients on every worker."""
+        if isinstance(self._backend, BrokerBackend):
+            return {'client_manager': BrokerManager(self._backend)}
+        if isinstance(self._backend, RedisBackend):
+            return {'message_queue': self._backend.url}
+        return {}
+
+    def subscribe(self, channel, callback):
+        self._subs.append((channel, callback))
+        self._backend.subscribe(channel, callback)
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
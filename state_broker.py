@@ -0,0 +1,103 @@
+"""
+Minimal shared-state broker for running several LocalShare workers without
+Redis. Every worker points STATE_BACKEND at the same address:
+
+    python state_broker.py unix:///tmp/localshare.sock
+    STATE_BACKEND=unix:///tmp/localshare.sock python app.py -p 8001
+    STATE_BACKEND=unix:///tmp/localshare.sock python app.py -p 8002
+
+State lives in one LocalBackend in this process; the wire protocol is
+newline-delimited JSON (see BrokerBackend in state_backend.py).
+"""
+import os
+import json
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+
+from state_backend import LocalBackend, parse_broker_url
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('state_broker')
+
+OPS = {'get', 'set', 'set_nx', 'take_token', 'delete', 'delete_if',
+       'hset', 'hdel', 'hgetall', 'lpush_capped', 'lrange', 'publish'}
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self._write_lock = threading.Lock()
+        self._subs       = []
+
+    def _send(self, obj):
+        data = json.dumps(obj).encode() + b'\n'
+        with self._write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def _deliver(self, channel):
+        def callback(data):
+            try:
+                self._send({'channel': channel, 'data': data})
+            except OSError:
+                pass   # subscriber went away; unsubscribed in finish()
+        return callback
+
+    def handle(self):
+        store = self.server.store
+        for line in self.rfile:
+            try:
+                req  = json.loads(line)
+                op   = req['op']
+                args = req.get('args') or []
+                if op == 'subscribe':
+                    callback = self._deliver(args[0])
+                    store.subscribe(args[0], callback)
+                    self._subs.append((args[0], callback))
+                    self._send({'ok': True})
+                elif op in OPS:
+                    self._send({'ok': getattr(store, op)(*args)})
+                else:
+                    self._send({'error': f'unknown op {op!r}'})
+            except OSError:
+                return
+            except Exception as e:
+                self._send({'error': str(e)})
+
+    def finish(self):
+        for channel, callback in self._subs:
+            self.server.store.unsubscribe(channel, callback)
+        super().finish()
+
+
+def make_server(url):
+    family, target = parse_broker_url(url)
+    if family == getattr(socket, 'AF_UNIX', None):
+        if os.path.exists(target):
+            os.remove(target)
+        server = socketserver.ThreadingUnixStreamServer(target, BrokerHandler)
+    else:
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer(target, BrokerHandler)
+    server.daemon_threads = True
+    server.store = LocalBackend()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='LocalShare shared-state broker')
+    parser.add_argument('url', nargs='?', default='unix:///tmp/localshare.sock',
+                        help='unix:///path/to.sock or tcp://host:port')
+    args = parser.parse_args()
+
+    server = make_server(args.url)
+    logger.info(f"State broker listening on {args.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
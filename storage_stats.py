@@ -0,0 +1,163 @@
+import os
+import time
+import logging
+import threading
+
+from extensions import state
+from upload_stream import TEMP_PREFIXES
+
+logger = logging.getLogger(__name__)
+
+# ============================================================
+# STORAGE ACCOUNTING
+# Total bytes, file count and per-top-level-folder sizes for
+# UPLOAD_FOLDER, kept incrementally. Upload, delete, rename and cleanup
+# code report what they changed; reading the numbers is a dict copy. A
+# slow reconcile walk, run at startup and then every few hours, catches
+# anything changed behind the app's back (files copied into a custom
+# folder, crashes between unlink and commit).
+#
+# Deltas and reconcile results go out over the state store's pub/sub, so
+# every worker's copy stays in step.
+# ============================================================
+
+RECONCILE_HOURS = 6
+TOP_FOLDERS     = 10            # folders listed on the dashboard
+YIELD_EVERY     = 2000          # reconcile: entries between GIL-releasing pauses
+
+_CHANNEL_DELTA  = 'storage:delta'
+_CHANNEL_TOTALS = 'storage:totals'
+
+
+def top_folder(rel_path):
+    """'Movies/2024/a.mkv' → 'Movies'; files in the root → ''."""
+    rel_path = rel_path.replace('\\', '/').lstrip('/')
+    return rel_path.split('/', 1)[0] if '/' in rel_path else ''
+
+
+class StorageAccountant:
+    def __init__(self, store):
+        self._store      = store
+        self._lock       = threading.Lock()
+        self._bytes      = 0
+        self._count      = 0
+        self._folders    = {}      # top-level folder → [bytes, count]
+        self._ready      = False   # False until the first reconcile finishes
+        self._reconciled = None
+        self._reconciling = threading.Lock()
+        store.subscribe(_CHANNEL_DELTA, self._apply_deltas)
+        store.subscribe(_CHANNEL_TOTALS, self._apply_totals)
+
+    # ---------- Events ----------
+
+    def file_added(self, rel_path, size, replaced_size=None):
+        """A file was written. `replaced_size` is the size of the file it overwrote, if any."""
+        if replaced_size is None:
+            self._publish([(top_folder(rel_path), size, 1)])
+        else:
+            self._publish([(top_folder(rel_path), size - replaced_size, 0)])
+
+    def file_removed(self, rel_path, size):
+        self._publish([(top_folder(rel_path), -size, -1)])
+
+    def file_moved(self, old_rel, new_rel, size):
+        old_top, new_top = top_folder(old_rel), top_folder(new_rel)
+        if old_top != new_top:
+            self._publish([(old_top, -size, -1), (new_top, size, 1)])
+
+    def _publish(self, deltas):
+        self._store.publish(_CHANNEL_DELTA, deltas)
+
+    def _apply_deltas(self, deltas):
+        with self._lock:
+            for folder, dbytes, dcount in deltas:
+                self._bytes += dbytes
+                self._count += dcount
+                entry = self._folders.setdefault(folder, [0, 0])
+                entry[0] += dbytes
+                entry[1] += dcount
+                if entry[1] <= 0:
+                    del self._folders[folder]
+
+    def _apply_totals(self, totals):
+        with self._lock:
+            self._bytes      = totals['bytes']
+            self._count      = totals['count']
+            self._folders    = {k: list(v) for k, v in totals['folders'].items()}
+            self._reconciled = totals['at']
+            self._ready      = True
+
+    # ---------- Reads ----------
+
+    def snapshot(self):
+        with self._lock:
+            top = sorted(self._folders.items(), key=lambda kv: kv[1][0], reverse=True)
+            return {
+                'bytes':      self._bytes,
+                'count':      self._count,
+                'folders':    [{'name': name or '/', 'bytes': b, 'count': c}
+                               for name, (b, c) in top[:TOP_FOLDERS]],
+                'ready':      self._ready,
+                'reconciled': self._reconciled,
+            }
+
+    # ---------- Reconcile ----------
+
+    def reconcile(self, root):
+        """
+        Walk `root` and replace the running totals with what is actually on
+        disk. os.scandir reuses the directory entry's stat where the OS
+        provides it; no file is opened. A hardlinked file (see dedup.py)
+        counts once per name but its bytes only once. Events that land
+        mid-walk may be counted twice or not at all until the next reconcile.
+        """
+        if not self._reconciling.acquire(blocking=False):
+            return None   # one already running
+        try:
+            started = time.time()
+            total, count, folders, seen = 0, 0, {}, 0
+            linked = set()   # (st_dev, st_ino) of multi-link files already sized
+            stack = [(root, '')]
+            while stack:
+                path, folder = stack.pop()
+                try:
+                    entries = list(os.scandir(path))
+                except OSError:
+                    continue
+                for entry in entries:
+                    seen += 1
+                    if seen % YIELD_EVERY == 0:
+                        time.sleep(0.001)   # let request threads in
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, folder if path != root else entry.name))
+                            continue
+                        if not entry.is_file(follow_symlinks=False) \
+                                or entry.name.startswith(TEMP_PREFIXES):
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    size = st.st_size
+                    if st.st_nlink > 1:
+                        inode = (st.st_dev, st.st_ino)
+                        if inode in linked:
+                            size = 0
+                        linked.add(inode)
+                    total += size
+                    count += 1
+                    key    = folder if path != root else ''
+                    f      = folders.setdefault(key, [0, 0])
+                    f[0]  += size
+                    f[1]  += 1
+
+            totals = {'bytes': total, 'count': count, 'folders': folders, 'at': int(time.time())}
+            self._store.publish(_CHANNEL_TOTALS, totals)
+            logger.info(f"Storage reconcile: {count} files, {total} bytes "
+                        f"in {time.time() - started:.1f}s")
+            return totals
+        finally:
+            self._reconciling.release()
+
+
+storage = StorageAccountant(state)
@@ -0,0 +1,98 @@
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ============================================================
+# HASHED TIMER WHEEL
+# O(1) schedule and re-arm for large numbers of soft deadlines (viewer
+# heartbeats, rate-limit buckets). Keys sit in one of `slots` buckets; a
+# single daemon thread advances one bucket per tick and only looks at the
+# keys in that bucket. Re-arming is lazy: touch() just moves the stored
+# deadline, and a key whose deadline moved is re-bucketed when its old
+# slot comes round instead of being moved on every touch.
+# ============================================================
+
+
+class TimerWheel:
+    def __init__(self, callback, tick=1.0, slots=64, name='timer-wheel'):
+        """
+        callback(key, now) is called from the wheel thread once a key's
+        deadline has passed. It may return a new absolute deadline to keep
+        the key alive, or None to drop it.
+        """
+        self._callback  = callback
+        self._tick      = tick
+        self._slots     = [set() for _ in range(slots)]
+        self._deadlines = {}   # key → absolute deadline
+        self._lock      = threading.Lock()
+        self._cursor    = 0
+        self._name      = name
+        self._thread    = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def _slot_for(self, deadline, now):
+        ticks = max(1, int((deadline - now) / self._tick + 0.999))
+        ticks = min(ticks, len(self._slots) - 1)
+        return (self._cursor + ticks) % len(self._slots)
+
+    def schedule(self, key, deadline):
+        """Arm (or re-arm) `key` to fire at the absolute time `deadline`."""
+        now = time.time()
+        with self._lock:
+            if key in self._deadlines:
+                self._deadlines[key] = deadline   # lazy: re-bucketed on its next tick
+                return
+            self._deadlines[key] = deadline
+            self._slots[self._slot_for(deadline, now)].add(key)
+        self._ensure_thread()
+
+    def touch(self, key, deadline):
+        """Push an armed key's deadline out. No-op for unknown keys."""
+        if key in self._deadlines:
+            self._deadlines[key] = deadline
+
+    def cancel(self, key):
+        with self._lock:
+            self._deadlines.pop(key, None)   # stale slot entry is skipped on tick
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=self._name,
+                                                    daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self._tick)
+            try:
+                self._advance(time.time())
+            except Exception:
+                logger.exception("Timer wheel tick failed")
+
+    def _advance(self, now):
+        with self._lock:
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            bucket = self._slots[self._cursor]
+            self._slots[self._cursor] = set()
+            due = []
+            for key in bucket:
+                deadline = self._deadlines.get(key)
+                if deadline is None:
+                    continue
+                if deadline > now:
+                    self._slots[self._slot_for(deadline, now)].add(key)
+                else:
+                    due.append(key)
+                    del self._deadlines[key]
+
+        # Callbacks run outside the wheel lock; they may re-arm
+        for key in due:
+            new_deadline = self._callback(key, now)
+            if new_deadline is not None:
+                self.schedule(key, new_deadline)
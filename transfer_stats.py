@@ -0,0 +1,165 @@
+import time
+import threading
+from collections import deque
+
+from flask import request
+
+import metrics
+
+# ============================================================
+# TRANSFER ACCOUNTING
+# Bytes actually written to clients, per file, per client IP and per
+# endpoint, in rolling windows. A WSGI middleware wraps the response
+# body and counts each chunk as the server pulls it. That covers
+# generators (stream, archives) and send_file under the development
+# server, so an aborted download counts only what went out.
+#
+# A body that is the server's own wsgi.file_wrapper is passed through
+# unwrapped, so servers that implement it keep their sendfile() path.
+# It is counted up front from Content-Length, which over-counts a
+# download the client abandons.
+#
+# Long responses report every FLUSH_BYTES, so a two-hour stream lands
+# in the minutes it was sent, not all at the end. Totals go into
+# minute buckets (last hour) and hour buckets (last day); a window
+# query sums at most 60 or 24 small dicts. Counts are per worker, like
+# /metrics.
+# ============================================================
+
+WINDOWS     = {'5m': 5 * 60, '1h': 3600, '24h': 86400}   # seconds
+TOP_N       = 10
+FLUSH_BYTES = 4 * 1024 * 1024
+ENVIRON_KEY = 'localshare.transfer'
+_DIMENSIONS = ('files', 'clients', 'endpoints')
+
+
+def _new_bucket():
+    return {dim: {} for dim in _DIMENSIONS}
+
+
+class TransferAccountant:
+    def __init__(self):
+        self._lock    = threading.Lock()
+        self._minutes = deque(maxlen=60)   # (minute, bucket)
+        self._hours   = deque(maxlen=24)   # (hour, bucket)
+        self.total    = 0                  # bytes since start; the dashboard diffs it for a rate
+
+    @staticmethod
+    def _bucket(ring, slot):
+        if not ring or ring[-1][0] != slot:
+            ring.append((slot, _new_bucket()))
+        return ring[-1][1]
+
+    def record(self, tag, nbytes, now=None):
+        """Count `nbytes` sent for `tag` = (endpoint, file_id or None, client ip)."""
+        endpoint, file_id, client = tag
+        now = now or time.time()
+        with self._lock:
+            self.total += nbytes
+            for ring, slot in ((self._minutes, int(now // 60)), (self._hours, int(now // 3600))):
+                bucket = self._bucket(ring, slot)
+                if file_id is not None:
+                    bucket['files'][file_id] = bucket['files'].get(file_id, 0) + nbytes
+                bucket['clients'][client]     = bucket['clients'].get(client, 0) + nbytes
+                bucket['endpoints'][endpoint] = bucket['endpoints'].get(endpoint, 0) + nbytes
+        metrics.HTTP_BYTES.inc(endpoint, amount=nbytes)
+
+    def top(self, window, n=TOP_N, now=None):
+        """Heaviest files, clients and endpoints over the last `window` seconds."""
+        now = now or time.time()
+        if window <= 3600:
+            ring, slot_len = self._minutes, 60
+        else:
+            ring, slot_len = self._hours, 3600
+        first = int((now - window) // slot_len) + 1
+
+        sums = _new_bucket()
+        with self._lock:
+            for slot, bucket in ring:
+                if slot < first:
+                    continue
+                for dim in _DIMENSIONS:
+                    acc = sums[dim]
+                    for key, b in bucket[dim].items():
+                        acc[key] = acc.get(key, 0) + b
+
+        result = {'bytes': sum(sums['endpoints'].values())}
+        for dim in _DIMENSIONS:
+            ranked = sorted(sums[dim].items(), key=lambda kv: kv[1], reverse=True)[:n]
+            result[dim] = [{'key': k, 'bytes': b} for k, b in ranked]
+        return result
+
+
+transfers = TransferAccountant()
+
+
+# ============================================================
+# METERING
+# ============================================================
+
+class _MeteredBody:
+    """Wraps a WSGI response iterable; counts bytes as the server consumes them."""
+
+    def __init__(self, body, tag):
+        self._body    = body
+        self._iter    = iter(body)
+        self._tag     = tag
+        self._pending = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = next(self._iter)
+        self._pending += len(chunk)
+        if self._pending >= FLUSH_BYTES:
+            transfers.record(self._tag, self._pending)
+            self._pending = 0
+        return chunk
+
+    def close(self):
+        if self._pending:
+            transfers.record(self._tag, self._pending)
+            self._pending = 0
+        close = getattr(self._body, 'close', None)
+        if close is not None:
+            close()
+
+
+class TransferMeter:
+    """WSGI middleware. Only responses tagged by Flask (see _tag_response) are metered."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        headers = []
+
+        def capture(status, response_headers, exc_info=None):
+            headers[:] = response_headers
+            return start_response(status, response_headers, exc_info)
+
+        body = self.wsgi_app(environ, capture)
+        tag  = environ.get(ENVIRON_KEY)
+        if tag is None:
+            return body   # Socket.IO transport or a request Flask never saw
+
+        wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(wrapper, type) and isinstance(body, wrapper):
+            length = next((v for k, v in headers if k.lower() == 'content-length'), None)
+            if length and length.isdigit():
+                transfers.record(tag, int(length))
+            return body
+        return _MeteredBody(body, tag)
+
+
+def _tag_response(response):
+    file_id = (request.view_args or {}).get('file_id')
+    client  = (request.remote_addr or 'unknown').replace('::ffff:', '')
+    request.environ[ENVIRON_KEY] = (request.endpoint or 'unmatched', file_id, client)
+    return response
+
+
+def init_app(app):
+    app.after_request(_tag_response)
+    app.wsgi_app = TransferMeter(app.wsgi_app)
@@ -0,0 +1,155 @@
+import os
+import hashlib
+import tempfile
+import logging
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.sansio.multipart import (MultipartDecoder, Field, File,
+                                       Data, Epilogue, NeedData)
+
+logger = logging.getLogger(__name__)
+
+# ============================================================
+# STREAMING UPLOAD WRITER
+# Parses multipart/form-data straight off request.stream and writes each
+# file part into its destination directory. Werkzeug's default path spools
+# every part to a temp file, then file.save() copies it again — for
+# multi-GB uploads that doubles disk writes and needs equal free temp space.
+# ============================================================
+
+READ_CHUNK   = 1024 * 1024       # bytes pulled from the socket per read
+WRITE_BUFFER = 4 * 1024 * 1024   # userspace buffer in front of each part
+FIELD_LIMIT  = 64 * 1024         # max size of a plain (non-file) form field
+
+# Names of in-flight temp files in the upload folder: UploadWriter's parts
+# and dedup.link_to's staging links. Listings, archives, catalog scans and
+# storage totals all skip them.
+TEMP_PREFIXES = ('.upload-', '.dedup-')
+
+
+class UploadResult:
+    """What a single completed file part produced on disk."""
+    __slots__ = ('filename', 'dest', 'size', 'digest')
+
+    def __init__(self, filename, dest, size, digest):
+        self.filename = filename
+        self.dest     = dest
+        self.size     = size
+        self.digest   = digest
+
+
+class UploadWriter:
+    """
+    Writes one part to a hidden temp file in the destination's own directory
+    and atomically renames it into place on commit(), so a half-received file
+    is never visible under its real name. Size and (optionally) a content hash
+    are computed on the fly — no re-read or stat afterwards.
+    """
+
+    def __init__(self, dest, hash_name=None):
+        self.dest = dest
+        fd, self.tmp_path = tempfile.mkstemp(prefix='.upload-', suffix='.part',
+                                             dir=os.path.dirname(dest))
+        self._f      = os.fdopen(fd, 'wb', buffering=WRITE_BUFFER)
+        self._hasher = hashlib.new(hash_name) if hash_name else None
+        self.size    = 0
+
+    def write(self, data):
+        self._f.write(data)
+        if self._hasher is not None:
+            self._hasher.update(data)
+        self.size += len(data)
+
+    def commit(self):
+        self._f.close()
+        os.replace(self.tmp_path, self.dest)
+        return self._hasher.hexdigest() if self._hasher is not None else None
+
+    def abort(self):
+        try:
+            self._f.close()
+        finally:
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+
+
+def receive_multipart(stream, boundary, dest_for, hash_name=None):
+    """
+    Incrementally parse a multipart body from `stream`.
+
+    dest_for(filename, fields) is called at the start of every file part with
+    the raw client filename and the plain fields received so far; it returns
+    the absolute destination path, or None to discard the part.
+
+    Returns (fields, results): a dict of plain form fields (last value wins)
+    and a list of UploadResult in arrival order. A body that ends early or
+    does not parse raises BadRequest.
+    """
+    # The decoder's own max_form_memory_size caps every buffered chunk,
+    # file data included, so the plain-field limit is enforced here instead.
+    decoder = MultipartDecoder(boundary.encode('latin-1'))
+    fields  = {}
+    results = []
+
+    writer     = None   # UploadWriter for the current file part
+    filename   = None
+    field_name = None   # name of the current plain field
+    field_buf  = []
+    field_size = 0
+
+    try:
+        while True:
+            try:
+                event = decoder.next_event()
+            except ValueError:
+                # Truncated or malformed body; the finally below discards the open part
+                raise BadRequest('Malformed or incomplete multipart body') from None
+
+            if isinstance(event, NeedData):
+                chunk = stream.read(READ_CHUNK)
+                decoder.receive_data(chunk or None)
+                continue
+
+            if isinstance(event, Epilogue):
+                break
+
+            if isinstance(event, File):
+                filename = event.filename or ''
+                dest     = dest_for(filename, fields) if filename else None
+                if dest is not None:
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    writer = UploadWriter(dest, hash_name)
+
+            elif isinstance(event, Field):
+                field_name = event.name
+                field_buf  = []
+                field_size = 0
+
+            elif isinstance(event, Data):
+                if field_name is not None:
+                    field_size += len(event.data)
+                    if field_size > FIELD_LIMIT:
+                        raise RequestEntityTooLarge()
+                    field_buf.append(event.data)
+                elif writer is not None:
+                    writer.write(event.data)
+
+                if event.more_data:
+                    continue
+
+                # End of the current part
+                if field_name is not None:
+                    fields[field_name] = b''.join(field_buf).decode('utf-8', 'replace')
+                    field_name = None
+                elif writer is not None:
+                    digest = writer.commit()
+                    results.append(UploadResult(filename, writer.dest, writer.size, digest))
+                    writer = None
+    finally:
+        if writer is not None:
+            logger.warning(f"Upload of '{filename}' interrupted — discarding partial file")
+            writer.abort()
+
+    return fields, results
@@ -2,12 +2,14 @@ import os
 import time
 import functools
 import logging
+import threading
 from datetime import datetime, timedelta
-from collections import deque
 from datetime import datetime, timedelta
 
 from flask import request, session, abort
 
+from extensions import state
+
 logger = logging.getLogger(__name__)
 
 STREAMABLE_EXTENSIONS = {'.mp4', '.mkv', '.mp3', '.flac', '.webm', '.ogg', '.m4b', '.m4a', '.ts', '.gif'}
@@ -42,22 +44,41 @@ def admin_required(f):
 
 
 # ============================================================
-# ACTIVITY LOG  (in-memory ring buffer, 100 most recent events)
+# ACTIVITY LOG  (capped list in the state store, 100 most recent events)
+# Shared by every worker when a shared STATE_BACKEND is configured.
+# Every event is also queued for the durable history in activity_log.py.
 # ============================================================
- 
-activity_log: deque = deque(maxlen=100)
- 
- 
+
+ACTIVITY_KEY = 'activity'
+ACTIVITY_MAX = 100
+
+
 def log_activity(ip: str, action: str, path: str, func: str, result: str) -> None:
-    """Prepend an event to the activity ring buffer (newest first)."""
-    activity_log.appendleft({
+    """Prepend an event to the activity log (newest first) and queue it for the durable history."""
+    from activity_log import activity_writer
+
+    entry = {
         'time':   int(time.time()),
         'ip':     ip or 'unknown',
         'action': action,
         'path':   path,
         'func':   func,
         'result': result,
-    })
+    }
+    state.lpush_capped(ACTIVITY_KEY, entry, ACTIVITY_MAX)
+    activity_writer.submit(entry)
+
+
+def recent_activity() -> list:
+    """Activity log entries, newest first."""
+    return state.lrange(ACTIVITY_KEY)
+
+
+def clear_activity() -> int:
+    """Empty the live activity list (the durable history is kept). Returns how many entries were dropped."""
+    count = len(state.lrange(ACTIVITY_KEY))
+    state.delete(ACTIVITY_KEY)
+    return count
 
 import re
 def get_device_string():
@@ -98,79 +119,28 @@ def human_readable_size(size):
     return f"{size:.2f} TB"
 
 
-def update_viewer_info(viewers_data, viewers_lock, file_id, client_ip, latency_ms):
-    with viewers_lock:
-        now = time.time()
-        viewers = viewers_data[file_id]
-        if client_ip not in viewers:
-            viewers[client_ip] = {'last_seen': now, 'latency': latency_ms, 'first_seen': now}
-        else:
-            old = viewers[client_ip]['latency']
-            viewers[client_ip]['latency'] = old * 0.7 + latency_ms * 0.3
-            viewers[client_ip]['last_seen'] = now
+def cleanup_old_chat():
+    """Must be called within an active Flask application context."""
+    from sqlite_store import writer
 
+    if writer.run(_delete_old_chat, datetime.utcnow() - timedelta(hours=24)):
+        from routes.chat import reset_chat_ring
+        reset_chat_ring()
 
-def cleanup_old_files():
-    """Must be called within an active Flask application context."""
-    from extensions import db
-    from models import File, ChatMessage
-    from flask import current_app
-
-    cutoff = datetime.utcnow() - timedelta(hours=24)
-
-    # Only delete files if cleanup is enabled (i.e., using default 'uploads' folder)
-    if current_app.config.get('CLEANUP_ENABLED', True):
-        old_files = File.query.filter(File.upload_time < cutoff).all()
-        upload_folder = current_app.config.get('UPLOAD_FOLDER', 'uploads')
-
-        for file in old_files:
-            file_path = os.path.join(upload_folder, file.stored_name)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            db.session.delete(file)
-
-    # Always clean up old chat messages regardless of directory mode
-    ChatMessage.query.filter(ChatMessage.timestamp < cutoff).delete()
-    db.session.commit()
-
-
-def cleanup_watch_sessions(watch_sessions, watch_lock, viewers_data, viewers_lock):
-    now = time.time()
-    with watch_lock:
-        expired = [fid for fid, s in watch_sessions.items()
-                   if now - s.get('last_active', 0) > 600]
-        for fid in expired:
-            del watch_sessions[fid]
-        if expired:
-            logger.info(f"Cleaned up {len(expired)} inactive watch sessions")
-
-    with viewers_lock:
-        for fid in list(viewers_data.keys()):
-            viewers = viewers_data[fid]
-            stale = [ip for ip, info in viewers.items()
-                     if now - info.get('last_seen', 0) > 30]
-            for ip in stale:
-                del viewers[ip]
-            if not viewers and fid not in watch_sessions:
-                del viewers_data[fid]
-
-
-def cleanup_rate_limits(client_last_update, client_update_lock):
-    now = time.time()
-    with client_update_lock:
-        expired = [k for k, ts in client_last_update.items() if now - ts > 60]
-        for k in expired:
-            del client_last_update[k]
-        if expired:
-            logger.info(f"Cleaned up {len(expired)} rate limit entries")
-
-
-def start_virtual_mdns(hostname="share", port=80):
+
+def _delete_old_chat(cutoff):
+    """DB writer job: returns the number of messages removed."""
+    from models import ChatMessage
+    return ChatMessage.query.filter(ChatMessage.timestamp < cutoff).delete()
+
+
+def start_virtual_mdns(hostname="share", port=80, stop=None):
     """
-    Spins up a background worker thread to broadcast a custom local domain
-    alias (e.g., http://share.local:5000) using multicast DNS (mDNS),
-    tricking local devices into finding this machine without modifying the
-    host OS computer name.
+    Broadcasts a custom local domain alias (e.g., http://share.local:5000)
+    using multicast DNS (mDNS), tricking local devices into finding this
+    machine without modifying the host OS computer name. Blocks until
+    registered; the server uses MDNSAnnouncer to run it in the background.
+    Returns None without registering if the `stop` event is already set.
     """
     # Use raw socket routing through a custom import name to bypass scoped re-import collision
     import sys
@@ -210,8 +180,61 @@ def start_virtual_mdns(hostname="share", port=80):
     # Initialize Zeroconf by strictly binding it to your local IP address interface.
     # Passing the individual IP inside a list ([local_ip]) works perfectly across ALL
     zeroconf_instance = Zeroconf(interfaces=[local_ip])
+    if stop is not None and stop.is_set():
+        zeroconf_instance.close()
+        return None
 
     logger.info(f"Registering virtual mDNS host mapping: http://{hostname}.local:{port} -> {local_ip}")
     zeroconf_instance.register_service(info)
 
-    return zeroconf_instance, info, local_ip
\ No newline at end of file
+    return zeroconf_instance, info, local_ip
+
+
+class MDNSAnnouncer:
+    """
+    Runs start_virtual_mdns() on a daemon thread, so the LAN IP probe and
+    Zeroconf's blocking register_service() never delay the server. close()
+    de-registers if the announcement got that far. If close() gives up
+    waiting, the thread withdraws its own announcement when it finishes.
+    """
+
+    def __init__(self, hostname="share", port=80):
+        self.hostname = hostname
+        self.port     = port
+        self._thread  = None
+        self._lock    = threading.Lock()
+        self._stop    = threading.Event()
+        self._result  = None   # (zeroconf, service_info, ip) once registered
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='mdns-announce', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            result = start_virtual_mdns(hostname=self.hostname, port=self.port, stop=self._stop)
+        except Exception:
+            logger.exception("mDNS announcement failed; share.local will not resolve")
+            return
+        with self._lock:
+            if not self._stop.is_set():
+                self._result = result
+                return
+        if result is not None:   # close() has already returned
+            self._withdraw(result)
+
+    def close(self, timeout=3.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._lock:
+            result, self._result = self._result, None
+        if result is not None:
+            self._withdraw(result)
+
+    @staticmethod
+    def _withdraw(result):
+        zeroconf, service_info, _ = result
+        logger.info("De-registering broadcast parameters from local subnet routing tables...")
+        zeroconf.unregister_service(service_info)
+        zeroconf.close()
\ No newline at end of file
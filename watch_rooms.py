@@ -0,0 +1,355 @@
+import time
+import threading
+import logging
+
+from state_backend import NODE_ID
+
+logger = logging.getLogger(__name__)
+
+# ============================================================
+# WATCH TOGETHER ROOM REGISTRY
+# Playback state and the viewer list live in the shared state store, so
+# every worker process sees the same room:
+#
+#   watch:rooms            hash  file_id → last activity
+#   watch:<id>:state       playing/position/updated_at/last_action/seq
+#   watch:<id>:viewers     hash  "<ip>|<node>" → viewer entry
+#
+# Each process also keeps a local WatchRoom per room it serves, holding
+# the Viewer objects for its own clients (connection counts, latency
+# throttling). Local viewer tables and the room map are copy-on-write:
+# writers swap in a new dict under the owning lock, readers just grab the
+# current reference and iterate without locking anything.
+#
+# Presence is connection-driven: a viewer with an open socket stays listed
+# until its last socket disconnects. Socket-less (HTTP fallback) viewers
+# expire VIEWER_TIMEOUT after their last heartbeat.
+# ============================================================
+
+VIEWER_TIMEOUT = 30    # seconds without a heartbeat before a socket-less viewer is stale
+ROOM_TIMEOUT   = 600   # seconds without activity before an empty room is dropped
+LATENCY_EWMA   = 0.3   # weight of the newest sample for legacy client_time latency
+LATENCY_PUSH_MS = 10   # latency change worth pushing to the room
+
+# Shared viewer entries are republished at least this often while alive and
+# ignored once older than SHARED_VIEWER_TTL — that covers a worker that
+# died without cleaning up after itself.
+REPUBLISH_INTERVAL = VIEWER_TIMEOUT / 3
+SHARED_VIEWER_TTL  = VIEWER_TIMEOUT * 2
+
+# Scheduled starts: "play at server time T" leaves enough lead for the
+# slowest viewer's one-way delay to deliver the command before T.
+PLAY_LEAD_MARGIN = 0.15   # seconds added on top of the slowest one-way delay
+PLAY_LEAD_MAX    = 1.0
+
+ROOMS_KEY = 'watch:rooms'
+
+_INITIAL_STATE = {
+    'playing':     False,
+    'position':    0.0,
+    'updated_at':  0.0,
+    'last_action': 'pause',
+    'seq':         0,
+}
+
+
+def viewer_info(entry, now):
+    """Public form of a shared viewer entry (/watch/viewers, push events)."""
+    return {
+        'ip':             entry['ip'],
+        'latency':        round(entry['latency'], 1),
+        'active_seconds': round(now - entry['first_seen'], 1),
+        'device':         entry['device'] or 'Unknown Device',
+    }
+
+
+class Viewer:
+    __slots__ = ('ip', 'first_seen', 'last_seen', 'latency', 'device', 'rtt', 'offset',
+                 'conns', 'pushed_latency', 'published_at')
+
+    def __init__(self, ip, now, latency, device):
+        self.ip             = ip
+        self.first_seen     = now
+        self.last_seen      = now
+        self.latency        = latency or 0
+        self.device         = device
+        self.rtt            = None   # seconds, from the client's clock-sync pings
+        self.offset         = None   # server clock − client clock, seconds
+        self.conns          = 0      # open sockets joined to this room from this ip
+        self.pushed_latency = self.latency
+        self.published_at   = 0.0
+
+    def alive(self, now):
+        return self.conns > 0 or now - self.last_seen < VIEWER_TIMEOUT
+
+    def entry(self):
+        return {
+            'ip':         self.ip,
+            'latency':    self.latency,
+            'rtt':        self.rtt,
+            'device':     self.device,
+            'first_seen': self.first_seen,
+            'last_seen':  self.last_seen,
+        }
+
+    def info(self, now):
+        return viewer_info(self.entry(), now)
+
+
+class WatchRoom:
+    __slots__ = ('file_id', 'key', 'store', 'lock', 'last_active', 'viewers')
+
+    def __init__(self, file_id, now, store):
+        self.file_id     = file_id
+        self.key         = f'watch:{file_id}'
+        self.store       = store
+        self.lock        = threading.Lock()   # guards the local viewer table
+        self.last_active = now
+        self.viewers     = {}    # ip → Viewer for this process; replaced, never mutated in place
+
+    # --- Playback state (shared) ---
+
+    @staticmethod
+    def _render(st, now):
+        # While playing, `position` is the media time at server time
+        # `updated_at`. For a scheduled start updated_at is in the future and
+        # doubles as play_at: clients hold at `position` until then.
+        return {
+            'playing':     st['playing'],
+            'position':    st['position'],
+            'updated_at':  st['updated_at'] or now,
+            'play_at':     st['updated_at'] if st['playing'] and st['updated_at'] > now else None,
+            'last_action': st['last_action'],
+            'seq':         st['seq'],
+            'server_now':  now,
+        }
+
+    def state(self, now):
+        return self._render(self.store.get(self.key + ':state') or _INITIAL_STATE, now)
+
+    def play_lead(self, now):
+        """Seconds to delay a play so every active viewer receives it in time."""
+        delays = [v['rtt'] / 2 for v in self.active_viewers(now) if v['rtt'] is not None]
+        return min(max(delays, default=0.0) + PLAY_LEAD_MARGIN, PLAY_LEAD_MAX)
+
+    def apply(self, action, position, now):
+        """Apply play/pause/seek. Returns the broadcast payload, or None if unknown."""
+        if action not in ('play', 'pause', 'seek'):
+            return None
+        lead = self.play_lead(now) if action == 'play' else 0.0
+
+        # Read-modify-write under the room's shared lock so two workers
+        # can't both hand out the same seq
+        with self.store.lock(self.key):
+            st = dict(self.store.get(self.key + ':state') or _INITIAL_STATE)
+            if action == 'seek':
+                st['position'] = float(position or 0.0)
+            else:
+                st['playing'] = action == 'play'
+                if position is not None:
+                    st['position'] = float(position)
+            st['updated_at']  = now + lead
+            st['last_action'] = action
+            st['seq']        += 1
+            self.store.set(self.key + ':state', st)
+
+        self.mark_active(now)
+        return self._render(st, now)
+
+    def mark_active(self, now):
+        self.last_active = now
+        self.store.hset(ROOMS_KEY, str(self.file_id), now)
+
+    # --- Viewers ---
+
+    def _field(self, ip):
+        return f'{ip}|{NODE_ID}'
+
+    def publish_viewer(self, v, now):
+        v.published_at = now
+        self.store.hset(self.key + ':viewers', self._field(v.ip), v.entry())
+
+    def _remove_local(self, ip):
+        """Caller holds self.lock."""
+        viewers = dict(self.viewers)
+        del viewers[ip]
+        self.viewers = viewers
+        self.store.hdel(self.key + ':viewers', self._field(ip))
+
+    def touch_viewer(self, ip, latency_ms, device, now):
+        """Register or refresh a viewer. Returns (viewer, created)."""
+        v = self.viewers.get(ip)
+        if v is None:
+            with self.lock:
+                v = self.viewers.get(ip)
+                if v is None:
+                    v = Viewer(ip, now, latency_ms, device)
+                    viewers = dict(self.viewers)
+                    viewers[ip] = v
+                    self.viewers = viewers
+                    self.publish_viewer(v, now)
+                    return v, True
+        # Plain attribute stores — safe without the lock under the GIL.
+        # latency_ms is None on the socket path; there it comes from clock sync.
+        if latency_ms is not None and v.rtt is None:
+            v.latency = v.latency * (1 - LATENCY_EWMA) + latency_ms * LATENCY_EWMA
+        v.last_seen = now
+        if device:
+            v.device = device
+        if now - v.published_at >= REPUBLISH_INTERVAL:
+            self.publish_viewer(v, now)
+        return v, False
+
+    def connect_viewer(self, ip, device, now):
+        """A socket joined. Returns (viewer, created)."""
+        v, created = self.touch_viewer(ip, None, device, now)
+        with self.lock:
+            v.conns += 1
+        return v, created
+
+    def disconnect_viewer(self, ip, now):
+        """A socket left. Returns True if that was the viewer's last connection here."""
+        with self.lock:
+            v = self.viewers.get(ip)
+            if v is None:
+                return False
+            v.conns     = max(0, v.conns - 1)
+            v.last_seen = now
+            if v.conns:
+                return False
+            self._remove_local(ip)
+            return True
+
+    def expire_viewer(self, ip, now):
+        """
+        Drop a socket-less viewer whose heartbeat has lapsed. Returns None if
+        it was removed (or is already gone), else the time it next goes stale.
+        Live viewers are republished so other workers keep seeing them.
+        """
+        with self.lock:
+            v = self.viewers.get(ip)
+            if v is None:
+                return None
+            if not v.alive(now):
+                self._remove_local(ip)
+                return None
+        self.publish_viewer(v, now)
+        return max(v.last_seen, now) + VIEWER_TIMEOUT
+
+    def record_clock(self, ip, rtt, offset, now):
+        """Store a client's NTP-style estimate; one-way latency is half the RTT."""
+        v = self.viewers.get(ip)
+        if v is None:
+            return None
+        v.rtt       = rtt
+        v.offset    = offset
+        v.latency   = rtt * 500
+        v.last_seen = now
+        return v
+
+    def latency_delta(self, v, now):
+        """Latency to push if it moved by LATENCY_PUSH_MS since the last push, else None."""
+        if abs(v.latency - v.pushed_latency) < LATENCY_PUSH_MS:
+            return None
+        v.pushed_latency = v.latency
+        self.publish_viewer(v, now)
+        return round(v.latency, 1)
+
+    def active_viewers(self, now):
+        """Shared viewer entries from every worker, one per ip."""
+        by_ip = {}
+        for entry in self.store.hgetall(self.key + ':viewers').values():
+            if now - entry['last_seen'] >= SHARED_VIEWER_TTL:
+                continue
+            seen = by_ip.get(entry['ip'])
+            if seen is None or entry['first_seen'] < seen['first_seen']:
+                by_ip[entry['ip']] = entry
+        return list(by_ip.values())
+
+    def watched_elsewhere(self, ip, now):
+        """True if another worker still has a live entry for this ip."""
+        return any(entry['ip'] == ip for entry in self.active_viewers(now))
+
+    def prune_viewers(self, now):
+        with self.lock:
+            for ip in [ip for ip, v in self.viewers.items() if not v.alive(now)]:
+                self._remove_local(ip)
+        stale = [field for field, entry in self.store.hgetall(self.key + ':viewers').items()
+                 if now - entry['last_seen'] >= SHARED_VIEWER_TTL]
+        if stale:
+            self.store.hdel(self.key + ':viewers', *stale)
+        return len(self.active_viewers(now))
+
+
+class RoomRegistry:
+    def __init__(self, store):
+        self.store  = store
+        self._lock  = threading.Lock()   # only taken to add/remove local rooms
+        self._rooms = {}                 # file_id → WatchRoom; copy-on-write
+        store.subscribe('watch:reset', self._on_reset)
+
+    def get(self, file_id):
+        return self._rooms.get(file_id)
+
+    def get_or_create(self, file_id, now=None):
+        room = self._rooms.get(file_id)
+        if room is not None:
+            return room
+        now = now or time.time()
+        with self._lock:
+            room = self._rooms.get(file_id)
+            if room is None:
+                room  = WatchRoom(file_id, now, self.store)
+                rooms = dict(self._rooms)
+                rooms[file_id] = room
+                self._rooms = rooms
+        room.mark_active(now)
+        return room
+
+    def snapshot(self):
+        """Rooms served by this process. Never mutated afterwards — iterate freely."""
+        return self._rooms
+
+    def view(self, file_id):
+        """A room handle for reading shared state, local or not."""
+        return self._rooms.get(file_id) or WatchRoom(file_id, 0, self.store)
+
+    def all_viewers(self, now):
+        """{file_id: [viewer entry]} for every room on every worker."""
+        return {int(fid): self.view(int(fid)).active_viewers(now)
+                for fid in self.store.hgetall(ROOMS_KEY)}
+
+    def _drop_shared(self, file_ids):
+        for fid in file_ids:
+            self.store.delete(f'watch:{fid}:state', f'watch:{fid}:viewers', f'watch:{fid}')
+        if file_ids:
+            self.store.hdel(ROOMS_KEY, *[str(fid) for fid in file_ids])
+
+    def clear(self):
+        """Drop every room on every worker. Returns (room_count, peer_count)."""
+        viewers = self.all_viewers(time.time())
+        self._drop_shared(list(viewers))
+        self.store.publish('watch:reset', None)
+        return len(viewers), sum(len(v) for v in viewers.values())
+
+    def _on_reset(self, _):
+        with self._lock:
+            self._rooms = {}
+
+    def sweep(self, now=None):
+        """Prune stale viewers; drop rooms idle for ROOM_TIMEOUT with nobody left."""
+        now     = now or time.time()
+        expired = [int(fid) for fid, last_active in self.store.hgetall(ROOMS_KEY).items()
+                   if self.view(int(fid)).prune_viewers(now) == 0
+                   and now - last_active > ROOM_TIMEOUT]
+        if expired:
+            self._drop_shared(expired)
+            with self._lock:
+                rooms = dict(self._rooms)
+                for fid in expired:
+                    room = rooms.get(fid)
+                    if room is not None and not room.viewers:
+                        del rooms[fid]
+                self._rooms = rooms
+            logger.info(f"Cleaned up {len(expired)} inactive watch sessions")
+        return len(expired)